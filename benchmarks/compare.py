@@ -0,0 +1,43 @@
+# benchmarks/compare.py
+"""
+Compares two benchmark result files and flags regressions.
+
+    python -m benchmarks.compare old.json new.json [--threshold 1.2]
+
+Exits with status 1 if any stage got slower than the threshold ratio.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as fh:
+        report = json.load(fh)
+    return report.get("meta", {}), {(r["suite"], r["name"], r["rows"]): r for r in report["results"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=1.2, help="new/old median ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    old_meta, old = load(args.old)
+    new_meta, new = load(args.new)
+    print(f"old: {old_meta.get('commit')}  new: {new_meta.get('commit')}")
+
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key]["median"], new[key]["median"]
+        ratio = after / before if before else float("inf")
+        flag = "  REGRESSION" if ratio > args.threshold else ""
+        regressions += bool(flag)
+        suite, name, rows = key
+        print(f"{suite:<11} {name:<32} {rows:>9,}  {before:9.4f}s -> {after:9.4f}s  x{ratio:5.2f}{flag}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+# benchmarks/loadtest.py
+"""
+End-to-end HTTP load test against gunicorn.
+
+    python -m benchmarks.loadtest                                   # sync profile, defaults below
+    python -m benchmarks.loadtest --profiles sync,gthread --users 32 --duration 60
+    GUNICORN_WORKERS=8 python -m benchmarks.loadtest --profiles sync
+
+For every worker profile in gunicorn.conf.py the harness seeds a throw-away
+SQLite database, starts gunicorn on it and runs a number of virtual users for a
+fixed time. Azure login is stubbed: the harness shares gunicorn's SECRET_KEY
+and signs Flask session cookies for synthetic users itself.
+
+Each virtual user repeatedly picks a scenario by weight (state loads, summary
+and page queries, multi-month adds, edits, imports and downloads). Latency
+percentiles and throughput are reported per scenario and written as JSON.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from sqlalchemy import text
+
+from budget_app import create_app, db
+from budget_app.master_data import replace_masters
+from . import synthetic
+from .run import BenchConfig, _git_commit, _seed_entries, _workbook_bytes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_KEY = "loadtest-secret"
+
+# Scenario -> relative weight. Reads dominate, like in normal use.
+DEFAULT_MIX = {
+    "state": 20,
+    "changes": 20,
+    "entries_page": 15,
+    "summary": 15,
+    "add_batch": 10,
+    "edit": 10,
+    "download": 5,
+    "import": 2,
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def session_cookie(user):
+    """Signs a Flask session cookie the way the server would after an Azure login."""
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    return SecureCookieSessionInterface().get_signing_serializer(app).dumps({"user": user})
+
+
+def seed_database(db_uri, users, rows_per_user):
+    class SeedConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = db_uri
+
+    SeedConfig.SECRET_KEY = SECRET_KEY
+    app = create_app(SeedConfig)
+    with app.app_context():
+        # WAL lets readers run while another worker writes; the setting sticks to the file
+        db.session.execute(text("PRAGMA journal_mode=WAL"))
+        products = synthetic.products_df()
+        clients = [f"Client {i:04d}" for i in range(500)]
+        for i, user in enumerate(users):
+            replace_masters(user["oid"], clients, dict(zip(products["Product"], products["Category"])))
+            db.session.commit()
+            _seed_entries(rows_per_user, user["oid"], user["name"], seed=i)
+
+
+class _JobOutcome:
+    """Stands in for the response of a scenario that ends by polling a job."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class VirtualUser:
+    """One simulated browser: a cookie, a keep-alive connection and the IDs it can edit."""
+
+    def __init__(self, base_url, user, workbook, rng):
+        self.base_url, self.user, self.workbook, self.rng = base_url, user, workbook, rng
+        self.http = requests.Session()
+        self.http.cookies.set("session", session_cookie(user))
+        self.version = 0
+        self.entry_ids = []
+
+    def _call(self, method, path, **kwargs):
+        response = self.http.request(method, self.base_url + path, timeout=120, **kwargs)
+        response.content  # read the whole body, like the browser does
+        return response
+
+    def refresh_ids(self):
+        response = self._call("get", "/api/entries?limit=200")
+        if response.ok:
+            self.entry_ids = [row["_rid"] for row in response.json()["rows"]]
+
+    def state(self):
+        response = self._call("get", "/api/state?format=columnar")
+        if response.ok:
+            self.version = response.json()["version"]
+        return response
+
+    def changes(self):
+        response = self._call("get", f"/api/changes?since={self.version}&format=columnar")
+        if response.ok:
+            self.version = response.json()["version"]
+        return response
+
+    def entries_page(self):
+        sort = self.rng.choice(["Month", "Client", "Sales (USD)", "GP (USD)"])
+        return self._call("get", f"/api/entries?sort={sort}&dir=desc&limit=100")
+
+    def summary(self):
+        group_by = self.rng.choice(["business_unit", "section", "month", "client"])
+        return self._call("get", f"/api/summary?group_by={group_by}")
+
+    def add_batch(self):
+        months = self.rng.sample(synthetic.MONTHS, self.rng.randint(3, 12))
+        line = {
+            "business_unit": self.rng.choice(synthetic.BUSINESS_UNITS), "section": "Retail",
+            "client": f"Client {self.rng.randrange(500):04d}", "product": f"Product {self.rng.randrange(200):04d}",
+            "category": "Category 01", "sector": self.rng.choice(synthetic.SECTORS),
+            "pmt_q1": 350, "pmt_q2": 360, "pmt_q3": 370, "pmt_q4": 380, "gm_percent": 12,
+            "months": {m: {"qty": self.rng.randint(1, 500), "booked": "No"} for m in months},
+        }
+        response = self._call("post", "/api/add_batch", json={"lines": [line]})
+        if response.ok:
+            self.entry_ids.extend(response.json()["inserted"])
+        return response
+
+    def edit(self):
+        if not self.entry_ids:
+            self.refresh_ids()
+        entry_id = self.rng.choice(self.entry_ids)
+        field, value = self.rng.choice([("Qty (MT)", self.rng.randint(1, 500)), ("GP %", self.rng.randint(2, 25))])
+        response = self._call("post", "/api/update_entry", json={"entry_id": entry_id, "field": field, "value": value})
+        if response.status_code == 404:
+            # Replaced by an import in the meantime
+            self.refresh_ids()
+        return response
+
+    def download(self):
+        return self._call("get", "/api/download_current?format=xlsx")
+
+    def import_budget(self):
+        """Uploads the workbook and polls the import job until it has finished."""
+        response = self._call("post", "/api/load_budget", files={"file": ("budget.xlsx", io.BytesIO(self.workbook))},
+                              data={"sheet": "Budget"})
+        if not response.ok:
+            return response
+        job = response.json()["job"]
+        while job["status"] in ("queued", "running"):
+            time.sleep(0.2)
+            response = self._call("get", f"/api/jobs/{job['id']}")
+            if not response.ok:
+                return response
+            job = response.json()
+        self.refresh_ids()
+        return _JobOutcome(500 if job["status"] == "failed" else 200)
+
+
+SCENARIOS = {
+    "state": VirtualUser.state,
+    "changes": VirtualUser.changes,
+    "entries_page": VirtualUser.entries_page,
+    "summary": VirtualUser.summary,
+    "add_batch": VirtualUser.add_batch,
+    "edit": VirtualUser.edit,
+    "download": VirtualUser.download,
+    "import": VirtualUser.import_budget,
+}
+
+
+def run_users(base_url, users, mix, duration, workbook, seed):
+    """Runs every virtual user until the deadline; returns (scenario, seconds, status) samples."""
+    samples, lock = [], threading.Lock()
+    names, weights = zip(*[(name, weight) for name, weight in mix.items() if weight > 0])
+    deadline = time.monotonic() + duration
+
+    def loop(index):
+        rng = random.Random(seed + index)
+        vu = VirtualUser(base_url, users[index], workbook, rng)
+        vu.state()
+        vu.refresh_ids()
+        local = []
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = SCENARIOS[name](vu).status_code
+            except requests.RequestException:
+                status = 0
+            local.append((name, time.perf_counter() - start, status))
+        with lock:
+            samples.extend(local)
+
+    with ThreadPoolExecutor(max_workers=len(users)) as pool:
+        list(pool.map(loop, range(len(users))))
+    return samples
+
+
+def summarize(samples, duration):
+    def stats(latencies, statuses):
+        latencies = sorted(latencies)
+        return {
+            "requests": len(latencies),
+            "errors": sum(1 for s in statuses if s == 0 or s >= 400),
+            "throughput_rps": len(latencies) / duration,
+            "p50_ms": 1000 * percentile(latencies, 50) if latencies else None,
+            "p95_ms": 1000 * percentile(latencies, 95) if latencies else None,
+            "p99_ms": 1000 * percentile(latencies, 99) if latencies else None,
+            "mean_ms": 1000 * statistics.fmean(latencies) if latencies else None,
+        }
+
+    per_scenario = {}
+    for name in sorted({s[0] for s in samples}):
+        rows = [s for s in samples if s[0] == name]
+        per_scenario[name] = stats([r[1] for r in rows], [r[2] for r in rows])
+    return {"overall": stats([s[1] for s in samples], [s[2] for s in samples]), "scenarios": per_scenario}
+
+
+def start_gunicorn(profile, port, db_uri, work_dir, log_file):
+    env = {
+        **os.environ,
+        "GUNICORN_PROFILE": profile,
+        "DATABASE_URL": db_uri,
+        "JOB_STORE_PATH": os.path.join(work_dir, "jobs.sqlite3"),
+        "JOB_DIR": os.path.join(work_dir, "jobs"),
+        "SECRET_KEY": SECRET_KEY,
+        "PYTHONUNBUFFERED": "1",
+    }
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}", "budget_app:create_app()"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/logged_out", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start within 60 seconds")
+
+
+def stop_gunicorn(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def print_report(profile, report):
+    print(f"\n== {profile} ==")
+    print(f"{'scenario':<14} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in [*report["scenarios"].items(), ("TOTAL", report["overall"])]:
+        print(f"{name:<14} {s['requests']:>9} {s['errors']:>7} {s['throughput_rps']:>8.1f} "
+              f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f}")
+
+
+def parse_mix(value):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (value or "").split(",")):
+        name, weight = part.split("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario '{name}' (expected one of {', '.join(SCENARIOS)}).")
+        mix[name] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", default="sync", help="comma-separated gunicorn profiles (sync, gthread, gevent)")
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load per profile")
+    parser.add_argument("--rows-per-user", type=int, default=2000, help="entries seeded for every user")
+    parser.add_argument("--import-rows", type=int, default=250, help="wide rows in the uploaded workbook")
+    parser.add_argument("--mix", help="scenario weights to override, e.g. 'import=0,download=10'")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/loadtest-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    users = [{"oid": f"load-user-{i:03d}", "name": f"Load User {i:03d}"} for i in range(args.users)]
+    workbook = _workbook_bytes(synthetic.wide_budget(args.import_rows, seed=args.seed))
+    reports = {}
+    for profile in [p.strip() for p in args.profiles.split(",") if p.strip()]:
+        if profile == "gevent" and importlib.util.find_spec("gevent") is None:
+            print("[gevent] skipped: the 'gevent' package is not installed")
+            continue
+        with tempfile.TemporaryDirectory() as tmp:
+            db_uri = f"sqlite:///{os.path.join(tmp, 'loadtest.db')}?timeout=30"
+            print(f"[{profile}] seeding {args.users} users x {args.rows_per_user} entries ...")
+            seed_database(db_uri, users, args.rows_per_user)
+            with open(os.path.join(tmp, "gunicorn.log"), "w") as log_file:
+                try:
+                    process = start_gunicorn(profile, args.port, db_uri, tmp, log_file)
+                except RuntimeError as e:
+                    with open(log_file.name) as fh:
+                        tail = fh.read()[-2000:]
+                    print(f"[{profile}] skipped: {e}\n{tail}")
+                    continue
+                try:
+                    print(f"[{profile}] running {args.users} users for {args.duration:.0f}s ...")
+                    samples = run_users(f"http://127.0.0.1:{args.port}", users, mix, args.duration, workbook, args.seed)
+                finally:
+                    stop_gunicorn(process)
+        reports[profile] = summarize(samples, args.duration)
+        print_report(profile, reports[profile])
+
+    commit = _git_commit()
+    output = args.output or os.path.join(os.path.dirname(__file__), "results", f"loadtest-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fh:
+        json.dump({
+            "meta": {
+                "commit": commit,
+                "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                "users": args.users, "duration": args.duration, "rows_per_user": args.rows_per_user,
+                "mix": mix, "workers": os.environ.get("GUNICORN_WORKERS"), "threads": os.environ.get("GUNICORN_THREADS"),
+            },
+            "profiles": reports,
+        }, fh, indent=2)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# benchmarks/run.py
+"""
+Benchmarks for the data_utils pipeline and the main API routes.
+
+    python -m benchmarks.run                                  # defaults below
+    python -m benchmarks.run --sizes 1000,10000 --route-sizes 1000 --repeat 5
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+
+The routes are driven through the Flask test client against a throw-away local
+SQLite database, with the Azure login replaced by a pre-populated session.
+Results are written as JSON (one record per stage and size) so runs from
+different commits can be compared.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import insert, select
+
+from config import Config
+from budget_app import create_app, db
+from budget_app.models import BudgetEntry
+from budget_app.importer import narrow_to_records, parse_row_range, plan_row_ranges, run_in_processes, sheet_data_rows
+from budget_app.rollups import rebuild_rollups
+from budget_app.snapshots import create_snapshot
+from budget_app.data_utils import (
+    coerce_wide_schema_types, recalc_wide_schema, convert_wide_to_narrow,
+    coerce_narrow_schema_types, recalc_narrow_schema, export_df_for_save
+)
+from . import synthetic
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+DEFAULT_ROUTE_SIZES = [1_000, 10_000, 100_000]
+DEFAULT_PARSE_SIZES = [20_000, 100_000]
+BENCH_USER = {"oid": "bench-user", "name": "Bench User"}
+SCENARIO_RULES = [
+    {"quarter": 3, "field": "pmt", "op": "multiply", "value": 1.05},
+    {"section": "Broker", "field": "gp_percent", "op": "add", "value": -2},
+    {"months": ["Jan", "Feb"], "field": "qty", "op": "multiply", "value": 1.1},
+]
+
+
+def time_call(fn, setup=None, repeat=3):
+    """Runs fn(*setup()) `repeat` times; setup (e.g. copying the input) is not timed."""
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+
+def bench_data_utils(sizes, repeat):
+    results = []
+    products = synthetic.products_df()
+    for n in sizes:
+        wide = synthetic.wide_budget(n)
+        wide_coerced = coerce_wide_schema_types(wide.copy())
+        wide_recalced = recalc_wide_schema(wide_coerced.copy(), products)
+        narrow = synthetic.narrow_budget(n)
+        narrow_coerced = coerce_narrow_schema_types(narrow.copy())
+        stages = {
+            "coerce_wide_schema_types": (coerce_wide_schema_types, lambda: (wide.copy(),)),
+            "recalc_wide_schema": (recalc_wide_schema, lambda: (wide_coerced.copy(), products)),
+            "convert_wide_to_narrow": (convert_wide_to_narrow, lambda: (wide_recalced,)),
+            "coerce_narrow_schema_types": (coerce_narrow_schema_types, lambda: (narrow.copy(),)),
+            "recalc_narrow_schema": (recalc_narrow_schema, lambda: (narrow_coerced.copy(), products)),
+            "export_df_for_save": (export_df_for_save, lambda: (narrow_coerced,)),
+        }
+        for name, (fn, setup) in stages.items():
+            timing = time_call(fn, setup, repeat)
+            results.append({"suite": "data_utils", "name": name, "rows": n, **timing})
+            print(f"data_utils  {name:<28} {n:>9,} rows  median {timing['median']:.4f}s")
+    return results
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SECRET_KEY = "benchmark"
+    # Imports run inside the request, so the route timings include the work
+    JOB_WORKERS = 0
+    ADMIN_USER_IDS = {BENCH_USER["oid"]}
+
+
+def _seed_entries(n, user_id, user_name, seed=0):
+    """Inserts n synthetic entries for the benchmark user, bypassing the routes."""
+    narrow = recalc_narrow_schema(coerce_narrow_schema_types(synthetic.narrow_budget(n, seed=seed)), synthetic.products_df())
+    BudgetEntry.query.filter_by(user_id=user_id).delete()
+    for start in range(0, n, 50_000):
+        db.session.execute(insert(BudgetEntry), narrow_to_records(narrow.iloc[start:start + 50_000], user_id, user_name, 0))
+    rebuild_rollups(user_id)
+    db.session.commit()
+
+
+def _workbook_bytes(df, sheet="Budget"):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet)
+    return buffer.getvalue()
+
+
+def bench_routes(sizes, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        BenchConfig.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        BenchConfig.SNAPSHOT_DIR = os.path.join(tmp, "snapshots")
+        app = create_app(BenchConfig)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = BENCH_USER
+
+        line = {
+            "business_unit": "Fertilizers", "section": "Retail", "client": "Client 0001", "product": "Product 0001",
+            "category": "Category 01", "sector": "Agriculture", "pmt_q1": 350, "pmt_q2": 360, "pmt_q3": 370, "pmt_q4": 380,
+            "gm_percent": 12, "months": {m: {"qty": 100, "booked": "No"} for m in synthetic.MONTHS},
+        }
+        single = {**{k: v for k, v in line.items() if k != "months"}, "month_name": "Jan", "qty": 100, "pmt": 350}
+
+        def request(method, url, **kwargs):
+            response = getattr(client, method)(url, **kwargs)
+            assert response.status_code < 400, f"{url}: {response.status_code} {response.get_data(as_text=True)[:200]}"
+            response.get_data()
+
+        for n in sizes:
+            with app.app_context():
+                _seed_entries(n, BENCH_USER["oid"], BENCH_USER["name"])
+                edit_ids = db.session.execute(select(BudgetEntry._rid).limit(500)).scalars().all()
+                snapshot_id = create_snapshot(BENCH_USER["oid"], "Benchmark").id
+                db.session.commit()
+            edit_runs = itertools.count(1)
+
+            def commit_edits():
+                # A different GP % every run, so every edit changes its row
+                gp_percent = 10 + next(edit_runs) % 5
+                request("post", "/api/commit", json={"editedRows": [{"_rid": rid, "GP %": gp_percent} for rid in edit_ids]})
+
+            # Roughly 7-8 monthly entries come out of every wide row
+            workbook = _workbook_bytes(synthetic.wide_budget(max(1, n // 8)))
+            routes = {
+                "GET /api/state": lambda: request("get", "/api/state"),
+                "GET /api/state?format=columnar": lambda: request("get", "/api/state?format=columnar"),
+                "POST /api/add": lambda: request("post", "/api/add", json=single),
+                "POST /api/add_batch (12 months)": lambda: request("post", "/api/add_batch", json={"lines": [line]}),
+                "GET /api/summary (rollups)": lambda: request("get", "/api/summary?group_by=business_unit,month"),
+                "GET /api/summary (entries)": lambda: request("get", "/api/summary?group_by=business_unit,product"),
+                "GET /api/summary?currency=JOD": lambda: request("get", "/api/summary?group_by=business_unit,product&currency=JOD"),
+                "GET /api/admin/consolidation": lambda: request("get", "/api/admin/consolidation"),
+                "GET /api/admin/consolidation?format=csv": lambda: request("get", "/api/admin/consolidation?format=csv"),
+                "POST /api/commit (500 edits)": commit_edits,
+                "POST /api/scenario (3 rules)": lambda: request("post", "/api/scenario", json={"rules": SCENARIO_RULES}),
+                "POST /api/recalc": lambda: request("post", "/api/recalc"),
+                "POST /api/snapshots": lambda: request("post", "/api/snapshots", json={"name": "Benchmark"}),
+                "GET /api/snapshots/diff (to live)": lambda: request("get", f"/api/snapshots/diff?from={snapshot_id}"),
+                "POST /api/snapshots/<id>/restore": lambda: request("post", f"/api/snapshots/{snapshot_id}/restore"),
+                "GET /api/download_current": lambda: request("get", "/api/download_current"),
+                "POST /api/load_budget": lambda: request(
+                    "post", "/api/load_budget",
+                    data={"file": (io.BytesIO(workbook), "budget.xlsx"), "sheet": "Budget"},
+                    content_type="multipart/form-data"),
+            }
+            for name, fn in routes.items():
+                timing = time_call(fn, repeat=repeat)
+                results.append({"suite": "routes", "name": name, "rows": n, **timing})
+                print(f"routes      {name:<32} {n:>9,} rows  median {timing['median']:.4f}s")
+    return results
+
+
+def bench_parallel_parse(sizes, processes_list, repeat):
+    """Workbook parsing (openpyxl + conversion to the narrow schema) with 1..N processes."""
+    results = []
+    products = dict(zip(synthetic.products_df()["Product"], synthetic.products_df()["Category"]))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            layouts = {"4 sheets": [f"BU{i}" for i in range(4)], "1 sheet": ["Budget"]}
+            for layout, sheets in layouts.items():
+                path = os.path.join(tmp, f"{n}-{len(sheets)}.xlsx")
+                with pd.ExcelWriter(path, engine="openpyxl") as writer:
+                    for i, sheet in enumerate(sheets):
+                        synthetic.wide_budget(n // len(sheets), seed=i).to_excel(writer, index=False, sheet_name=sheet)
+                data_rows = sheet_data_rows(path, sheets)
+                for processes in processes_list:
+                    tasks = [(path, sheet, first, last, 5000, products)
+                             for sheet, first, last in plan_row_ranges(data_rows, processes, min_range_rows=1000)]
+                    name = f"parse {layout}, {processes} processes"
+                    timing = time_call(lambda: list(run_in_processes(parse_row_range, tasks, processes)), repeat=repeat)
+                    results.append({"suite": "parse", "name": name, "rows": n, **timing})
+                    print(f"parse       {name:<32} {n:>9,} rows  median {timing['median']:.4f}s")
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="row counts for the data_utils stages")
+    parser.add_argument("--route-sizes", default=",".join(map(str, DEFAULT_ROUTE_SIZES)), help="row counts for the route benchmarks")
+    parser.add_argument("--parse-sizes", default=",".join(map(str, DEFAULT_PARSE_SIZES)), help="wide rows for the workbook parsing benchmark")
+    parser.add_argument("--processes", default=f"1,{os.cpu_count() or 1}", help="process counts for the parsing benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-routes", action="store_true")
+    parser.add_argument("--skip-parse", action="store_true")
+    parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/<commit>.json)")
+    args = parser.parse_args(argv)
+
+    parse_sizes = lambda s: [int(v) for v in s.split(",") if v.strip()]
+    results = bench_data_utils(parse_sizes(args.sizes), args.repeat)
+    if not args.skip_routes:
+        results += bench_routes(parse_sizes(args.route_sizes), args.repeat)
+    if not args.skip_parse:
+        processes = sorted(set(parse_sizes(args.processes)))
+        results += bench_parallel_parse(parse_sizes(args.parse_sizes), processes, args.repeat)
+
+    commit = _git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(os.path.dirname(__file__), "results", f"{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
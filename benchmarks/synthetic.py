@@ -0,0 +1,91 @@
+# benchmarks/synthetic.py
+"""
+Seeded synthetic budgets for benchmarks.
+
+The same seed always produces the same data, so timings from different commits
+are measured on identical input.
+"""
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from budget_app.data_utils import IDCOL, INTERNAL_DF_COLS, WIDE_EXCEL_COLS
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+BUSINESS_UNITS = ["Fertilizers", "Chemicals", "Minerals", "Trading"]
+SECTIONS = ["Retail", "Industrial", "Export", "Broker", "Mining"]
+SECTORS = ["Agriculture", "Construction", "Energy", "Food"]
+
+
+def products_df(n_products: int = 200, n_categories: int = 12) -> pd.DataFrame:
+    """Product master with a deterministic product -> category mapping."""
+    return pd.DataFrame({
+        "Product": [f"Product {i:04d}" for i in range(n_products)],
+        "Category": [f"Category {i % n_categories:02d}" for i in range(n_products)],
+    })
+
+
+def _messy(values: np.ndarray, rng: np.random.Generator, fraction: float, fmt: str) -> np.ndarray:
+    """Formats a fraction of the numbers as spreadsheet-style strings ("1,200.50 USD", "12%")."""
+    out = values.astype(object)
+    if fraction > 0:
+        idx = np.flatnonzero(rng.random(len(values)) < fraction)
+        out[idx] = [fmt.format(v) for v in values[idx]]
+    return out
+
+
+def wide_budget(n_rows: int, seed: int = 0, messy_fraction: float = 0.05, n_clients: int = 500) -> pd.DataFrame:
+    """A wide-schema budget (one row per product line, twelve monthly quantities)."""
+    rng = np.random.default_rng(seed)
+    products = products_df()
+    prod_idx = rng.integers(0, len(products), n_rows)
+    df = pd.DataFrame({
+        "Business Unit": rng.choice(BUSINESS_UNITS, n_rows),
+        "Section": rng.choice(SECTIONS, n_rows),
+        "Client": [f"Client {i:04d}" for i in rng.integers(0, n_clients, n_rows)],
+        "Category": products["Category"].to_numpy()[prod_idx],
+        "Product": products["Product"].to_numpy()[prod_idx],
+    })
+    for q in range(1, 5):
+        df[f"PMT_Q{q} (USD)"] = _messy(rng.uniform(80, 900, n_rows).round(2), rng, messy_fraction, "{:,.2f} USD")
+    df["GP %"] = _messy(rng.uniform(2, 25, n_rows).round(1), rng, messy_fraction, "{}%")
+    for month in MONTHS:
+        # Roughly a third of the months are empty, like real budgets
+        qty = rng.uniform(1, 500, n_rows).round(1)
+        qty[rng.random(n_rows) < 0.35] = 0
+        df[f"Qty_{month} (MT)"] = qty
+    df["Sector"] = rng.choice(SECTORS, n_rows)
+    df["Booked"] = rng.choice(["Yes", "No"], n_rows)
+    for col in WIDE_EXCEL_COLS:
+        if col not in df.columns:
+            df[col] = 0.0
+    return df[WIDE_EXCEL_COLS]
+
+
+def narrow_budget(n_rows: int, seed: int = 0, messy_fraction: float = 0.05, n_clients: int = 500) -> pd.DataFrame:
+    """A narrow-schema budget (one row per product line and month), as stored in budget_entries."""
+    rng = np.random.default_rng(seed)
+    products = products_df()
+    prod_idx = rng.integers(0, len(products), n_rows)
+    qty = rng.uniform(1, 500, n_rows).round(1)
+    pmt = rng.uniform(80, 900, n_rows).round(2)
+    gp_pct = rng.uniform(2, 25, n_rows).round(1)
+    sales = (qty * pmt).round(2)
+    df = pd.DataFrame({
+        IDCOL: [str(uuid.UUID(int=int(v))) for v in rng.integers(0, 2**63, n_rows)],
+        "Business Unit": rng.choice(BUSINESS_UNITS, n_rows),
+        "Section": rng.choice(SECTIONS, n_rows),
+        "Client": [f"Client {i:04d}" for i in rng.integers(0, n_clients, n_rows)],
+        "Category": products["Category"].to_numpy()[prod_idx],
+        "Product": products["Product"].to_numpy()[prod_idx],
+        "Month": rng.integers(1, 13, n_rows),
+        "Qty (MT)": _messy(qty, rng, messy_fraction, "{:,.1f}"),
+        "PMT (USD)": _messy(pmt, rng, messy_fraction, "{:,.2f} USD"),
+        "GP %": _messy(gp_pct, rng, messy_fraction, "{}%"),
+        "Sales (USD)": sales,
+        "GP (USD)": (sales * gp_pct / 100.0).round(2),
+        "Sector": rng.choice(SECTORS, n_rows),
+        "Booked": rng.choice(["Yes", "No"], n_rows),
+    })
+    return df[[IDCOL] + INTERNAL_DF_COLS]
@@ -46,4 +46,37 @@ def create_app(config_class=Config):
     from .auth import auth_bp
     app.register_blueprint(auth_bp)
 
+    from .commands import register_commands
+    register_commands(app)
+
+    from .audit_service import init_audit
+    init_audit(app)
+
+    from .snapshots import init_snapshots
+    init_snapshots(app)
+
+    from .session_manager import init_session_store
+    init_session_store(app)
+
+    from .http_cache import init_http_cache
+    init_http_cache(app)
+
+    from .jobs import init_jobs
+    init_jobs(app)
+
+    from .master_cache import MasterCache
+    app.extensions["master_cache"] = MasterCache(app.config.get("MASTER_CACHE_SIZE", 256))
+
+    from .summary_cache import SummaryCache
+    app.extensions["summary_cache"] = SummaryCache(app.config.get("SUMMARY_CACHE_SIZE", 1024))
+
+    with app.app_context():
+        # Creates the tables that don't exist yet; existing tables are left untouched
+        # (`flask --app run upgrade-db` adds their new columns and indexes).
+        # With several workers starting at once, one of them may lose the race, which is harmless.
+        try:
+            db.create_all()
+        except Exception as e:
+            print(f"Could not create missing database tables: {str(e)}")
+
     return app
\ No newline at end of file
@@ -0,0 +1,185 @@
+# budget_app/audit_queries.py
+"""
+Reading the audit log back, and archiving old rows.
+
+Queries page through the log newest-first with a keyset on (timestamp, id),
+backed by the (user_id, timestamp) and (action, timestamp) indexes. Rows older
+than the retention period are moved into one gzip-compressed JSON Lines file
+per month (audit-YYYY-MM.jsonl.gz in AUDIT_ARCHIVE_DIR); archived months are
+still searched when a query asks for them.
+"""
+import glob
+import gzip
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, or_, select
+
+from . import db
+from .models import AuditLog
+from .entry_queries import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, QueryError, decode_cursor, encode_cursor
+
+ARCHIVE_BATCH_ROWS = 5000
+# SQL Server accepts at most 2100 parameters per statement
+DELETE_CHUNK_SIZE = 1000
+
+
+def _parse_time(value: Optional[str], name: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise QueryError(f"Invalid '{name}' timestamp; use ISO 8601 (e.g. 2025-01-31 or 2025-01-31T12:00:00).")
+
+
+def audit_row(row: Dict[str, Any], archived: bool = False) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "timestamp": row["timestamp"].isoformat() if isinstance(row["timestamp"], datetime) else row["timestamp"],
+        "user_id": row["user_id"],
+        "user_name": row["user_name"],
+        "action": row["action"],
+        "details": row["details"],
+        "archived": archived,
+    }
+
+
+class AuditFilter:
+    """The filters of one audit query, applied both in SQL and to archived rows."""
+
+    def __init__(self, args: Dict[str, Any], user_id: Optional[str]):
+        self.user_id = user_id
+        actions = args.get("action") or ""
+        self.actions = [a.strip().upper() for a in actions.split(",") if a.strip()]
+        self.start = _parse_time(args.get("from"), "from")
+        self.end = _parse_time(args.get("to"), "to")
+        try:
+            self.limit = min(max(int(args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except (TypeError, ValueError):
+            raise QueryError("Invalid page size.")
+        cursor = args.get("cursor")
+        self.before: Optional[Tuple[datetime, int]] = None
+        if cursor:
+            timestamp, row_id = decode_cursor(cursor)
+            self.before = (_parse_time(timestamp, "cursor"), int(row_id))
+
+    def conditions(self) -> List[Any]:
+        conditions = []
+        if self.user_id:
+            conditions.append(AuditLog.user_id == self.user_id)
+        if self.actions:
+            conditions.append(AuditLog.action.in_(self.actions))
+        if self.start:
+            conditions.append(AuditLog.timestamp >= self.start)
+        if self.end:
+            conditions.append(AuditLog.timestamp < self.end)
+        if self.before:
+            timestamp, row_id = self.before
+            conditions.append(or_(AuditLog.timestamp < timestamp, and_(AuditLog.timestamp == timestamp, AuditLog.id < row_id)))
+        return conditions
+
+    def matches(self, row: Dict[str, Any]) -> bool:
+        timestamp = row["timestamp"]
+        return ((not self.user_id or row["user_id"] == self.user_id)
+                and (not self.actions or row["action"] in self.actions)
+                and (not self.start or timestamp >= self.start)
+                and (not self.end or timestamp < self.end)
+                and (not self.before or (timestamp, row["id"]) < self.before))
+
+
+def _archive_path(directory: str, year: int, month: int) -> str:
+    return os.path.join(directory, f"audit-{year:04d}-{month:02d}.jsonl.gz")
+
+
+def _archive_months(directory: str) -> List[Tuple[int, int, str]]:
+    """(year, month, path) of every archive file, newest first."""
+    months = []
+    for path in glob.glob(os.path.join(directory, "audit-????-??.jsonl.gz")):
+        year, month = os.path.basename(path)[6:13].split("-")
+        months.append((int(year), int(month), path))
+    return sorted(months, reverse=True)
+
+
+def read_archive(path: str) -> Iterator[Dict[str, Any]]:
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        for line in fh:
+            row = json.loads(line)
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+            yield row
+
+
+def _archived_rows(query: AuditFilter, directory: str) -> List[Dict[str, Any]]:
+    """Archived rows matching the query, newest first; stops reading once a page is filled."""
+    found: List[Dict[str, Any]] = []
+    seen = set()
+    for year, month, path in _archive_months(directory):
+        month_start = datetime(year, month, 1)
+        if query.end and month_start >= query.end:
+            continue
+        if query.start and (datetime(year + month // 12, month % 12 + 1, 1) <= query.start):
+            break
+        if len(found) > query.limit:
+            break
+        rows = []
+        for row in read_archive(path):
+            if query.matches(row) and row["id"] not in seen:
+                seen.add(row["id"])
+                rows.append(row)
+        found.extend(sorted(rows, key=lambda r: (r["timestamp"], r["id"]), reverse=True))
+    return found
+
+
+def query_audit_log(args: Dict[str, Any], user_id: Optional[str], archive_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    One page of audit rows, newest first. user_id=None means all users (admins only).
+    Archived rows are included when archive_dir is given.
+    """
+    query = AuditFilter(args, user_id)
+    columns = (AuditLog.id, AuditLog.timestamp, AuditLog.user_id, AuditLog.user_name, AuditLog.action, AuditLog.details)
+    rows = [audit_row(row._mapping) for row in db.session.execute(
+        select(*columns).where(*query.conditions()).order_by(AuditLog.timestamp.desc(), AuditLog.id.desc()).limit(query.limit + 1)
+    )]
+    if archive_dir and len(rows) <= query.limit:
+        # Archived rows are all older than the rows still in the table
+        table_ids = {row["id"] for row in rows}
+        rows += [audit_row(row, archived=True) for row in _archived_rows(query, archive_dir) if row["id"] not in table_ids]
+    has_more = len(rows) > query.limit
+    rows = rows[:query.limit]
+    next_cursor = encode_cursor(rows[-1]["timestamp"], rows[-1]["id"]) if has_more else None
+    return {"rows": rows, "next_cursor": next_cursor}
+
+
+def archive_audit_log(cutoff: datetime, directory: str) -> Dict[str, int]:
+    """
+    Moves audit rows older than `cutoff` into the monthly archive files, then deletes
+    them from the table. Each run appends a new gzip member, which gzip readers
+    treat as one continuous file. Returns the number of rows archived per month.
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = (AuditLog.id, AuditLog.timestamp, AuditLog.user_id, AuditLog.user_name, AuditLog.action, AuditLog.details)
+    result = db.session.execute(
+        select(*columns).where(AuditLog.timestamp < cutoff).order_by(AuditLog.timestamp, AuditLog.id)
+        .execution_options(yield_per=ARCHIVE_BATCH_ROWS)
+    )
+    files, counts, archived_ids = {}, {}, []
+    try:
+        for row in result:
+            key = (row.timestamp.year, row.timestamp.month)
+            if key not in files:
+                files[key] = gzip.open(_archive_path(directory, *key), "at", encoding="utf-8")
+            record = audit_row(row._mapping)
+            del record["archived"]
+            files[key].write(json.dumps(record, separators=(",", ":")) + "\n")
+            counts[key] = counts.get(key, 0) + 1
+            archived_ids.append(row.id)
+    finally:
+        for fh in files.values():
+            fh.close()
+    # The files are complete before any row is deleted. If the delete fails, the rows stay in
+    # the table and the next run archives them again; queries skip the duplicate IDs.
+    for start in range(0, len(archived_ids), DELETE_CHUNK_SIZE):
+        db.session.execute(delete(AuditLog).where(AuditLog.id.in_(archived_ids[start:start + DELETE_CHUNK_SIZE])))
+    return {f"{year:04d}-{month:02d}": n for (year, month), n in sorted(counts.items())}
@@ -1,16 +1,55 @@
 # budget_app/audit_service.py
+"""
+Audit logging.
+
+log_action() only records the event in a per-request buffer (flask.g). The
+buffer is written with one multi-row INSERT just before the request's
+transaction commits, and dropped if it rolls back, so audit rows are only kept
+for operations that were actually saved.
+
+With AUDIT_ASYNC enabled, committed events are handed to a bounded queue
+instead and written by a background thread in batches. When the queue is full
+the request writes its events itself, so nothing is lost and memory stays bounded.
+
+Bulk operations log one summary event (see log_bulk_action) instead of one
+event per row; the affected IDs are stored compactly in the details.
+"""
+import atexit
+import base64
+import json
+import os
+import queue
+import re
+import threading
+import uuid
+import zlib
+
+from flask import g, has_app_context, session
+from sqlalchemy import event, insert
+
 from . import db
-from .models import AuditLog
-from flask import session
+from .models import AuditLog, audit_timestamp
+
+# SQL Server accepts at most 2100 parameters per statement (5 per audit row)
+INSERT_CHUNK_ROWS = 400
+# Bulk events list up to this many IDs as plain text; longer lists are compressed
+INLINE_ID_COUNT = 10
+_PACKED_IDS = re.compile(r"ids=([uz]:[A-Za-z0-9_=-]+|[^\s]*)$")
+
 
 def get_current_user():
     """Helper to get user info from the session."""
     user_info = session.get('user', {})
     return user_info.get('oid'), user_info.get('name')
 
+def _pending_events():
+    if "audit_events" not in g:
+        g.audit_events = []
+    return g.audit_events
+
 def log_action(action, details=None):
     """
-    Creates and saves an audit log entry.
+    Buffers an audit log entry for the current request.
     This should be called after a successful operation but before the final commit.
     """
     try:
@@ -19,13 +58,168 @@ def log_action(action, details=None):
             # Don't log if for some reason user isn't in session
             return
 
-        log_entry = AuditLog(
-            user_id=user_id,
-            user_name=user_name,
-            action=action,
-            details=str(details) if details else None
-        )
-        db.session.add(log_entry)
+        _pending_events().append({
+            "user_id": user_id,
+            "user_name": user_name,
+            "action": action,
+            "timestamp": audit_timestamp(),
+            "details": str(details) if details else None,
+        })
     except Exception as e:
         # If logging fails, we don't want to crash the main application
-        print(f"Error while creating audit log: {str(e)}")
\ No newline at end of file
+        print(f"Error while creating audit log: {str(e)}")
+
+def _uuid_bytes(ids):
+    """The 16-byte forms of the IDs, or None if any of them isn't a canonical UUID string."""
+    try:
+        raw = [uuid.UUID(i) for i in ids]
+    except ValueError:
+        return None
+    if any(str(u) != i for u, i in zip(raw, ids)):
+        return None
+    return b"".join(u.bytes for u in raw)
+
+def pack_ids(ids):
+    """
+    Short lists as "a,b,c". Longer ones are zlib-compressed and base64-encoded:
+    "u:" for UUIDs (packed as 16 bytes each), "z:" for a JSON list of anything else.
+    """
+    ids = [str(i) for i in ids]
+    if len(ids) <= INLINE_ID_COUNT and not any(re.search(r"[\s,]", i) for i in ids):
+        return ",".join(ids)
+    raw = _uuid_bytes(ids)
+    prefix = "u:" if raw is not None else "z:"
+    if raw is None:
+        raw = json.dumps(ids, separators=(",", ":")).encode("utf-8")
+    return prefix + base64.urlsafe_b64encode(zlib.compress(raw, 9)).decode("ascii")
+
+def unpack_ids(details):
+    """The IDs stored in the details of a bulk event ([] if there are none)."""
+    match = _PACKED_IDS.search(details or "")
+    if not match or not match.group(1):
+        return []
+    value = match.group(1)
+    if value[:2] in ("u:", "z:"):
+        raw = zlib.decompress(base64.urlsafe_b64decode(value[2:]))
+        if value.startswith("u:"):
+            return [str(uuid.UUID(bytes=raw[i:i + 16])) for i in range(0, len(raw), 16)]
+        return json.loads(raw.decode("utf-8"))
+    return value.split(",")
+
+def log_bulk_action(action, summary, ids):
+    """Logs one event for an operation on many rows, e.g. "Deleted 5000 entries ids=z:..."."""
+    log_action(action, details=f"{summary} ids={pack_ids(ids)}")
+
+def write_events(connection, events):
+    """Inserts audit events with multi-row INSERT statements."""
+    for start in range(0, len(events), INSERT_CHUNK_ROWS):
+        connection.execute(insert(AuditLog).values(events[start:start + INSERT_CHUNK_ROWS]))
+
+
+class AuditFlusher:
+    """Background writer fed by a bounded queue. Started lazily, once per (forked) process."""
+
+    def __init__(self, app, max_events=10000, batch_size=INSERT_CHUNK_ROWS, interval=1.0):
+        self.app = app
+        self.queue = queue.Queue(maxsize=max_events)
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # A gunicorn worker forked after the app was created needs its own thread
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                threading.Thread(target=self._run, name="audit-flusher", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, events):
+        """Queues events; returns the ones that didn't fit."""
+        self._ensure_started()
+        for i, item in enumerate(events):
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                return events[i:]
+        return []
+
+    def _take_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=self.interval))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                write_events(connection, batch)
+        except Exception as e:
+            print(f"Error while writing {len(batch)} audit log entries: {str(e)}")
+
+    def drain(self):
+        """Writes whatever is still queued (called at interpreter exit)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+
+def _before_commit(session):
+    # Savepoints (begin_nested) also fire this; the events wait for the real commit
+    if not has_app_context() or session.in_nested_transaction():
+        return
+    events = g.pop("audit_events", None)
+    if not events:
+        return
+    flusher = g.get("audit_flusher")
+    if flusher is not None:
+        # Queued only once the transaction has committed
+        g.audit_committed = g.get("audit_committed", []) + events
+    else:
+        write_events(session, events)
+
+def _after_commit(session):
+    if not has_app_context():
+        return
+    events = g.pop("audit_committed", None)
+    if events:
+        overflow = g.audit_flusher.submit(events)
+        if overflow:
+            with db.engine.begin() as connection:
+                write_events(connection, overflow)
+
+def _after_soft_rollback(session, previous_transaction):
+    # A savepoint (begin_nested) rolling back leaves the outer transaction, and its events, alive
+    if not has_app_context() or previous_transaction.nested:
+        return
+    g.pop("audit_events", None)
+    g.pop("audit_committed", None)
+
+def init_audit(app):
+    """Hooks the audit buffer into db.session and starts the optional background flusher."""
+    event.listen(db.session, "before_commit", _before_commit)
+    event.listen(db.session, "after_commit", _after_commit)
+    event.listen(db.session, "after_soft_rollback", _after_soft_rollback)
+    if app.config.get("AUDIT_ASYNC"):
+        flusher = AuditFlusher(app, max_events=app.config.get("AUDIT_QUEUE_SIZE", 10000))
+        atexit.register(flusher.drain)
+
+        @app.before_request
+        def _use_audit_flusher():
+            g.audit_flusher = flusher
@@ -0,0 +1,142 @@
+# budget_app/change_feed.py
+"""
+Per-user versioning of budget entries.
+
+Every transaction that changes a user's entries takes the next version number,
+stamps it on the rows it inserted or updated and leaves a tombstone for the rows
+it deleted. Clients remember the last version they saw and ask for
+/api/changes?since=<version> instead of reloading the whole budget.
+The same transaction applies the changes to the user's rollups (see rollups.py).
+
+Tombstones are kept for the last CHANGE_FEED_RETAINED_VERSIONS versions only.
+Pruning older ones raises the user's reset_version like a reset does, so a
+client further behind gets a full reload instead of missing deletions.
+"""
+from typing import Any, Dict, Iterable, Mapping
+
+from flask import current_app
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import BudgetEntry, EntryTombstone, UserDataVersion
+from .entry_wire import encode_rows, entries_statement
+from .rollups import RollupDelta, reset_rollups
+
+DEFAULT_RETAINED_VERSIONS = 1000
+
+
+def current_version(user_id: str) -> int:
+    """Returns the user's data version without loading any entries."""
+    version = db.session.execute(
+        select(UserDataVersion.version).where(UserDataVersion.user_id == user_id)
+    ).scalar()
+    return version or 0
+
+
+def next_version(user_id: str) -> int:
+    """
+    Increments and returns the user's data version inside the current transaction.
+    The row stays locked until commit, so concurrent writers of the same user are serialized.
+    """
+    table = UserDataVersion.__table__
+    bump = table.update().where(table.c.user_id == user_id).values(version=table.c.version + 1)
+    if db.session.execute(bump).rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(user_id=user_id, version=1, reset_version=0))
+            return 1
+        except IntegrityError:
+            # Another worker created the row first
+            db.session.execute(bump)
+    return db.session.execute(select(table.c.version).where(table.c.user_id == user_id)).scalar_one()
+
+
+def record_changes(user_id: str, inserted: Iterable[BudgetEntry] = (), updated: Iterable[BudgetEntry] = (),
+                   deleted_rows: Iterable[Mapping[str, Any]] = ()) -> Dict[str, Any]:
+    """
+    Stamps a new version on the changed entries, writes tombstones for the deleted ones
+    and returns the mutation response body. Call it before db.session.commit().
+    deleted_rows are the rollup columns (with _rid) of the deleted entries, read with
+    rollups.entry_rollup_rows() before deleting them.
+    """
+    inserted, updated, deleted_rows = list(inserted), list(updated), list(deleted_rows)
+    deleted_ids = [row["_rid"] for row in deleted_rows]
+    delta = RollupDelta()
+    # The edited entries' loaded values are only known until the next flush
+    with db.session.no_autoflush:
+        delta.add_entries(inserted)
+        delta.add_updated_entries(updated)
+        delta.add_records(user_id, deleted_rows, sign=-1)
+    version = next_version(user_id)
+    delta.apply()
+    for entry in inserted + updated:
+        entry.version = version
+    if deleted_ids:
+        db.session.execute(
+            EntryTombstone.__table__.insert(),
+            [{"user_id": user_id, "entry_id": rid, "version": version} for rid in deleted_ids]
+        )
+        prune_tombstones(user_id, version)
+    return {
+        "version": version,
+        "inserted": [e._rid for e in inserted],
+        "updated": [e._rid for e in updated],
+        "deleted": deleted_ids,
+        # Serialized now, while the objects are still loaded, to avoid a refresh per row after commit
+        "rows": [e.to_dict() for e in inserted + updated],
+    }
+
+
+def prune_tombstones(user_id: str, version: int) -> int:
+    """
+    Deletes the user's tombstones that are CHANGE_FEED_RETAINED_VERSIONS or more versions
+    older than `version` and raises reset_version to match. Returns how many were deleted.
+    """
+    floor = version - current_app.config.get("CHANGE_FEED_RETAINED_VERSIONS", DEFAULT_RETAINED_VERSIONS)
+    if floor <= 0:
+        return 0
+    table = UserDataVersion.__table__
+    db.session.execute(
+        table.update().where(table.c.user_id == user_id, table.c.reset_version < floor).values(reset_version=floor)
+    )
+    return db.session.execute(
+        delete(EntryTombstone).where(EntryTombstone.user_id == user_id, EntryTombstone.version <= floor)
+    ).rowcount
+
+
+def record_reset(user_id: str) -> Dict[str, Any]:
+    """
+    Records that the user's whole budget was replaced (load or clear).
+    Older tombstones are no longer needed because every client has to reload.
+    """
+    version = next_version(user_id)
+    db.session.execute(
+        UserDataVersion.__table__.update()
+        .where(UserDataVersion.user_id == user_id)
+        .values(reset_version=version)
+    )
+    EntryTombstone.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    reset_rollups(user_id)
+    return {"version": version, "reset": True}
+
+
+def changes_since(user_id: str, since: int, columnar: bool = False) -> Dict[str, Any]:
+    """
+    Returns the rows changed and the IDs deleted after `since`, or a full reload if needed.
+    With columnar=True the rows are sent in the columnar format (see entry_wire.py).
+    """
+    state = db.session.get(UserDataVersion, user_id)
+    version = state.version if state else 0
+    reset_version = state.reset_version if state else 0
+
+    if since < reset_version or since > version:
+        rows = db.session.execute(entries_statement(BudgetEntry.user_id == user_id)).all()
+        return {"version": version, "reset": True, "rows": encode_rows(rows, columnar), "deleted": []}
+
+    rows = db.session.execute(entries_statement(BudgetEntry.user_id == user_id, BudgetEntry.version > since)).all()
+    deleted = db.session.execute(
+        select(EntryTombstone.entry_id)
+        .where(EntryTombstone.user_id == user_id, EntryTombstone.version > since)
+    ).scalars().all()
+    return {"version": version, "reset": False, "rows": encode_rows(rows, columnar), "deleted": list(deleted)}
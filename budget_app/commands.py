@@ -0,0 +1,158 @@
+# budget_app/commands.py
+"""
+Maintenance commands, run with the Flask CLI:
+
+    flask --app run recalculate --user <oid>
+    flask --app run recalculate --all-users
+    flask --app run dedupe-masters
+    flask --app run upgrade-db
+    flask --app run create-indexes
+    flask --app run archive-audit [--older-than-days 365]
+    flask --app run check-rollups [--user <oid>] [--repair]
+    flask --app run rebuild-rollups --user <oid>
+    flask --app run rebuild-rollups --all-users
+"""
+from datetime import timedelta
+
+import click
+from flask import Flask
+
+from . import db
+from .recalc import recalculate_entries
+from .master_data import deduplicate_masters
+from .models import Client, Product, audit_timestamp
+from .audit_queries import archive_audit_log
+from .rollups import check_rollups, rebuild_rollups
+
+
+def add_missing_columns(models=None) -> int:
+    """
+    Adds the models' columns that existing tables don't have yet (e.g. budget_entries.version).
+    db.create_all() only creates whole tables, so existing databases need this after upgrades.
+    A new NOT NULL column needs a server default, which fills in the existing rows.
+    """
+    tables = [model.__table__ for model in models] if models else db.metadata.sorted_tables
+    inspector = db.inspect(db.engine)
+    ddl = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    added = 0
+    for table in tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise ValueError(f"{table.name}.{column.name} is NOT NULL without a server default; add it by hand.")
+            with db.engine.begin() as connection:
+                connection.execute(db.text(
+                    f"ALTER TABLE {ddl.preparer.format_table(table)} ADD {ddl.get_column_specification(column)}"
+                ))
+            added += 1
+    return added
+
+
+def create_missing_indexes(models=None) -> int:
+    """
+    Creates the models' indexes that don't exist yet. db.create_all() only creates
+    indexes together with new tables, so existing databases need this after upgrades.
+    """
+    tables = [model.__table__ for model in models] if models else db.metadata.sorted_tables
+    created = 0
+    for table in tables:
+        for index in table.indexes:
+            if not db.inspect(db.engine).has_index(table.name, index.name):
+                index.create(db.engine)
+                created += 1
+    return created
+
+
+def register_commands(app: Flask) -> None:
+    @app.cli.command("recalculate")
+    @click.option("--user", "user_id", help="Azure object ID of the user to recalculate.")
+    @click.option("--all-users", is_flag=True, help="Recalculate every user's entries in one pass.")
+    def recalculate_command(user_id, all_users):
+        """Refreshes categories and recomputes sales, GP and profit per ton."""
+        if bool(user_id) == all_users:
+            raise click.UsageError("Pass either --user or --all-users.")
+        try:
+            rows_changed = recalculate_entries(None if all_users else user_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        click.echo(f"Recalculated {rows_changed} entries.")
+
+    @app.cli.command("dedupe-masters")
+    def dedupe_masters_command():
+        """Removes duplicate clients/products and creates the (user_id, name) unique indexes."""
+        try:
+            removed = deduplicate_masters()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        create_missing_indexes([Client, Product])
+        click.echo(f"Removed {removed['clients']} duplicate clients and {removed['products']} duplicate products.")
+
+    @app.cli.command("upgrade-db")
+    def upgrade_db_command():
+        """Adds missing tables, columns and indexes to an existing database. Safe to run again."""
+        db.create_all()
+        columns = add_missing_columns()
+        click.echo(f"Added {columns} columns and created {create_missing_indexes()} indexes.")
+
+    @app.cli.command("create-indexes")
+    def create_indexes_command():
+        """Creates any missing indexes on existing tables."""
+        click.echo(f"Created {create_missing_indexes()} indexes.")
+
+    @app.cli.command("archive-audit")
+    @click.option("--older-than-days", type=int, default=None, help="Defaults to AUDIT_RETENTION_DAYS.")
+    def archive_audit_command(older_than_days):
+        """Moves old audit rows into monthly gzip archive files."""
+        days = older_than_days if older_than_days is not None else app.config["AUDIT_RETENTION_DAYS"]
+        try:
+            counts = archive_audit_log(audit_timestamp() - timedelta(days=days), app.config["AUDIT_ARCHIVE_DIR"])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for month, n in counts.items():
+            click.echo(f"{month}: {n} rows archived")
+        click.echo(f"Archived {sum(counts.values())} audit rows to {app.config['AUDIT_ARCHIVE_DIR']}.")
+
+    @app.cli.command("check-rollups")
+    @click.option("--user", "user_id", help="Only check this user (Azure object ID).")
+    @click.option("--repair", is_flag=True, help="Rebuild the rollups of the users that differ.")
+    def check_rollups_command(user_id, repair):
+        """Compares the summary rollups with the entries they were built from."""
+        mismatches = check_rollups(user_id)
+        for m in mismatches:
+            click.echo(f"{m['user_id']} {m['group']}: expected {m['expected']}, found {m['actual']}")
+        users = sorted({m["user_id"] for m in mismatches})
+        click.echo(f"{len(mismatches)} differing groups for {len(users)} users.")
+        if repair and users:
+            try:
+                for user in users:
+                    rebuild_rollups(user)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            click.echo(f"Rebuilt the rollups of {len(users)} users.")
+
+    @app.cli.command("rebuild-rollups")
+    @click.option("--user", "user_id", help="Azure object ID of the user to rebuild.")
+    @click.option("--all-users", is_flag=True, help="Rebuild every user's rollups.")
+    def rebuild_rollups_command(user_id, all_users):
+        """Recreates the summary rollups from the entries."""
+        if bool(user_id) == all_users:
+            raise click.UsageError("Pass either --user or --all-users.")
+        try:
+            groups = rebuild_rollups(None if all_users else user_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        click.echo(f"Rebuilt {groups} rollup groups.")
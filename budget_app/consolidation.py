@@ -0,0 +1,100 @@
+# budget_app/consolidation.py
+"""
+Organisation-wide consolidation of the budget across all users (admins only).
+
+One GROUP BY over every user's budget_entries, by Business Unit, Section,
+Sector, Category and Month (or a subset of them). The groups are streamed
+from the database in batches, in group order; CSV and XLSX reports go
+through the exporter's writers, so their memory depends on the batch size
+rather than on the number of entries or groups. The ix_budget_entries_consolidation
+index has the grouping columns as its key and the measures as included
+columns, so the database can aggregate from the index in key order without
+reading the table or sorting.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Sequence
+
+from sqlalchemy import func, select
+
+from .models import BudgetEntry
+from .data_utils import month_name_to_num
+from .entry_queries import QueryError
+from .exporter import iter_row_batches
+
+# Grouping dimension -> (column, report header). The default grouping uses all of them, in this order.
+CONSOLIDATION_DIMENSIONS = {
+    "business_unit": (BudgetEntry.business_unit, "Business Unit"),
+    "section": (BudgetEntry.section, "Section"),
+    "sector": (BudgetEntry.sector, "Sector"),
+    "category": (BudgetEntry.category, "Category"),
+    "month": (BudgetEntry.month, "Month"),
+}
+CONSOLIDATION_FILTERS = dict(CONSOLIDATION_DIMENSIONS, booked=(BudgetEntry.booked, "Booked"))
+MEASURE_HEADERS = ["Users", "Entries", "Qty (MT)", "Sales (USD)", "GP (USD)", "GM %"]
+CONSOLIDATION_FORMATS = ("json", "csv", "xlsx")
+
+
+def parse_dimensions(value: Any) -> List[str]:
+    dims = [d.strip() for d in (value or "").split(",") if d.strip()] or list(CONSOLIDATION_DIMENSIONS)
+    unknown = [d for d in dims if d not in CONSOLIDATION_DIMENSIONS]
+    if unknown:
+        raise QueryError(f"Cannot group by {', '.join(unknown)}.")
+    return list(dict.fromkeys(dims))
+
+
+def consolidation_statement(dims: Sequence[str], args: Mapping[str, Any]):
+    """The GROUP BY over all users' entries, filtered by request arguments and ordered by the groups."""
+    conditions = []
+    for name, (column, _) in CONSOLIDATION_FILTERS.items():
+        value = args.get(name)
+        if value in (None, ""):
+            continue
+        if name == "month":
+            value = month_name_to_num(int(value) if str(value).isdigit() else value)
+        conditions.append(column == value)
+    group_columns = [CONSOLIDATION_DIMENSIONS[d][0] for d in dims]
+    return (
+        select(
+            *[column.label(d) for column, d in zip(group_columns, dims)],
+            func.count(func.distinct(BudgetEntry.user_id)).label("users"),
+            func.count(BudgetEntry._rid).label("count"),
+            func.sum(BudgetEntry.qty_mt).label("qty"),
+            func.sum(BudgetEntry.sales_usd).label("sales"),
+            func.sum(BudgetEntry.gp_usd).label("gp"),
+        )
+        .where(*conditions)
+        .group_by(*group_columns)
+        .order_by(*group_columns)
+    )
+
+
+def report_header(dims: Sequence[str]) -> List[str]:
+    return [CONSOLIDATION_DIMENSIONS[d][1] for d in dims] + MEASURE_HEADERS
+
+
+def _report_row(row: tuple, width: int) -> tuple:
+    """Rounds a group's sums and appends its weighted GM % (total GP / total sales)."""
+    users, count, qty, sales, gp = row[width:]
+    qty, sales, gp = round(qty or 0.0, 2), round(sales or 0.0, 2), round(gp or 0.0, 2)
+    gm_percent = round(gp / sales * 100, 2) if sales else 0.0
+    return (*row[:width], users, count, qty, sales, gp, gm_percent)
+
+
+def iter_report_batches(dims: Sequence[str], args: Mapping[str, Any]) -> Iterator[List[tuple]]:
+    """Streams the report rows (see report_header) in batches, for the exporter's writers."""
+    for batch in iter_row_batches(consolidation_statement(dims, args)):
+        yield [_report_row(row, len(dims)) for row in batch]
+
+
+def consolidation_json(dims: Sequence[str], batches: Iterable[List[tuple]]) -> Dict[str, Any]:
+    """The report as {"group_by", "groups", "totals"}; the totals are summed from the groups."""
+    groups, totals = [], {"count": 0, "qty": 0.0, "sales": 0.0, "gp": 0.0}
+    for batch in batches:
+        for row in batch:
+            group = dict(zip(dims, row))
+            group.update(zip(("users", "count", "qty", "sales", "gp", "gm_percent"), row[len(dims):]))
+            groups.append(group)
+            for key in totals:
+                totals[key] += group[key]
+    totals = {key: round(value, 2) for key, value in totals.items()}
+    totals["gm_percent"] = round(totals["gp"] / totals["sales"] * 100, 2) if totals["sales"] else 0.0
+    return {"group_by": list(dims), "groups": groups, "totals": totals}
@@ -0,0 +1,147 @@
+# budget_app/currency.py
+"""
+Versioned exchange rates and server-side currency conversion.
+
+Amounts are stored in USD. Administrators publish complete sets of rates
+(units of each currency per 1 USD); every set gets the next version number and
+older sets are kept. Until one is published, Config.EXCHANGE_RATES is used as
+version 0.
+
+Summaries, entry pages and exports take ?currency=. Entry pages and exports
+multiply the money columns in the SQL projection; summaries are aggregated
+in USD once per data version (see summary_cache.py) and the cached sums are
+scaled by the rate, so switching between USD, JOD and EUR doesn't query the
+entries again. Read endpoints include the rate version in their ETag.
+"""
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence
+
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import ExchangeRate
+
+BASE_CURRENCY = "USD"
+# Entry / export columns holding USD amounts
+MONEY_LABELS = ("PMT (USD)", "Sales (USD)", "GP (USD)", "Profit per Ton")
+# Summary fields holding USD amounts (see entry_queries.summary_measures)
+MONEY_SUMMARY_FIELDS = ("sales", "gp", "booked_sales", "not_booked_sales", "booked_gp", "not_booked_gp")
+
+
+class CurrencyError(ValueError):
+    """Raised for unknown currencies and invalid rate sets."""
+
+
+class RateSet(NamedTuple):
+    version: int
+    rates: Dict[str, float]
+
+
+class Conversion(NamedTuple):
+    currency: str
+    rate: float
+    rate_version: int
+
+    @property
+    def is_base(self) -> bool:
+        return self.currency == BASE_CURRENCY
+
+
+# Published rate sets never change, so each worker keeps the ones it has read
+_rate_sets: Dict[int, RateSet] = {}
+_rate_sets_lock = threading.Lock()
+
+
+def rate_version() -> int:
+    """The version of the current rate set (0 while Config.EXCHANGE_RATES applies)."""
+    return db.session.execute(select(func.max(ExchangeRate.version))).scalar() or 0
+
+
+def current_rates() -> RateSet:
+    version = rate_version()
+    if version == 0:
+        return RateSet(0, dict(current_app.config.get("EXCHANGE_RATES", {BASE_CURRENCY: 1.0})))
+    with _rate_sets_lock:
+        cached = _rate_sets.get(version)
+    if cached is not None:
+        return cached
+    rows = db.session.execute(
+        select(ExchangeRate.currency, ExchangeRate.rate).where(ExchangeRate.version == version)
+    ).all()
+    rate_set = RateSet(version, {currency: rate for currency, rate in rows})
+    with _rate_sets_lock:
+        _rate_sets[version] = rate_set
+    return rate_set
+
+
+def publish_rates(rates: Mapping[str, Any], published_by: Optional[str] = None) -> RateSet:
+    """Stores `rates` as the next rate set in the current transaction. The caller commits."""
+    cleaned = {BASE_CURRENCY: 1.0}
+    for currency, rate in (rates or {}).items():
+        code = str(currency).strip().upper()
+        if len(code) != 3 or not code.isalpha():
+            raise CurrencyError(f"Invalid currency code '{currency}'.")
+        try:
+            rate = float(rate)
+        except (TypeError, ValueError):
+            raise CurrencyError(f"Invalid rate for {code}.")
+        if code == BASE_CURRENCY and rate != 1.0:
+            raise CurrencyError(f"The {BASE_CURRENCY} rate must be 1.")
+        if not rate > 0:
+            raise CurrencyError(f"The {code} rate must be positive.")
+        cleaned[code] = rate
+    version = rate_version() + 1
+    published_at = datetime.utcnow()
+    try:
+        with db.session.begin_nested():
+            db.session.execute(ExchangeRate.__table__.insert(), [
+                {"version": version, "currency": code, "rate": rate, "published_at": published_at, "published_by": published_by}
+                for code, rate in cleaned.items()
+            ])
+    except IntegrityError:
+        raise CurrencyError("The exchange rates were changed at the same time; reload them and try again.")
+    return RateSet(version, cleaned)
+
+
+def resolve_currency(value: Optional[str]) -> Conversion:
+    """The conversion for a ?currency= argument (USD when missing)."""
+    currency = (value or BASE_CURRENCY).strip().upper()
+    rate_set = current_rates()
+    if currency not in rate_set.rates:
+        raise CurrencyError(f"Unknown currency '{currency}' (expected one of {', '.join(sorted(rate_set.rates))}).")
+    return Conversion(currency, rate_set.rates[currency], rate_set.version)
+
+
+def convert_amount(value: Optional[float], conversion: Conversion) -> Optional[float]:
+    if value is None or conversion.is_base:
+        return value
+    return round(value * conversion.rate, 2)
+
+
+def convert_summary(summary: Dict[str, Any], conversion: Conversion) -> Dict[str, Any]:
+    """A copy of an entries_summary() result with the money fields converted (GM % is unchanged)."""
+    def convert_row(row: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: convert_amount(value, conversion) if key in MONEY_SUMMARY_FIELDS else value
+                for key, value in row.items()}
+    return {
+        **summary,
+        "totals": convert_row(summary["totals"]),
+        "groups": [convert_row(row) for row in summary["groups"]],
+        "currency": conversion.currency,
+        "rate_version": conversion.rate_version,
+    }
+
+
+def converted_column(column, label: str, conversion: Conversion):
+    """The column itself, or its value in the target currency if it holds USD amounts."""
+    if conversion.is_base or label not in MONEY_LABELS:
+        return column
+    return func.round(column * conversion.rate, 2).label(column.key)
+
+
+def currency_header(header: Sequence[str], conversion: Conversion) -> List[str]:
+    """Export column headers naming the target currency instead of USD."""
+    return [label.replace(f"({BASE_CURRENCY})", f"({conversion.currency})") for label in header]
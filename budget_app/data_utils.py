@@ -1,6 +1,7 @@
 import uuid
 import json # We will need this for to_json_records
-from typing import Dict, List, Any # And these too
+from typing import Dict, List, Any, Mapping, Union # And these too
+import numpy as np
 import pandas as pd
 
 # Constants
@@ -34,6 +35,12 @@ WIDE_EXCEL_NUMERIC_COLS = [
     "GP_Q1 (USD)", "GP_Q2 (USD)", "GP_Q3 (USD)", "GP_4 (USD)", "Total_GP (USD)"
 ]
 
+MONTHS_MAP = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12
+}
+QUARTER_PMT_COLS = ["PMT_Q1 (USD)", "PMT_Q2 (USD)", "PMT_Q3 (USD)", "PMT_Q4 (USD)"]
+
 # --- Columns for saving/exporting Excel files ---
 SAVE_EXCEL_COLS = [
     "Business Unit", "User Name", "Section", "Client", "Category", "Product", "Month",
@@ -47,12 +54,8 @@ SAVE_EXCEL_COLS = [
 
 def month_name_to_num(name: str) -> int:
     """Convert month name to number with error handling"""
-    months_map = {
-        "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
-        "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12
-    }
     if isinstance(name, str):
-        return months_map.get(name.capitalize()[:3], 1) # Handle 'January' -> 'Jan'
+        return MONTHS_MAP.get(name.capitalize()[:3], 1) # Handle 'January' -> 'Jan'
     try:
         num = int(name)
         return num if 1 <= num <= 12 else 1
@@ -83,6 +86,97 @@ def clean_numeric_string(s: Any) -> Any:
                 pass # Fall through to float conversion
     return s
 
+def _float_or_nan(s: Any) -> float:
+    try:
+        return float(s)
+    except (ValueError, TypeError):
+        return np.nan
+
+def clean_numeric_series(s: pd.Series) -> pd.Series:
+    """
+    Column-at-a-time equivalent of pd.to_numeric(s.apply(clean_numeric_string), errors="coerce").
+    Only string cells are cleaned; numbers and missing values pass through untouched.
+    """
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.to_numeric(s, errors="coerce")
+    # Cells that already parse are left alone (cleaning can't change their value);
+    # only the rest go through the string operations.
+    todo = (pd.to_numeric(s, errors="coerce").isna() & s.notna()).to_numpy()
+    if not todo.any():
+        return pd.to_numeric(s.infer_objects(), errors="coerce")
+    sub = s[todo]
+    try:
+        cleaned = sub.str.strip()
+    except AttributeError:
+        return pd.to_numeric(s.infer_objects(), errors="coerce") # No strings in the column
+    is_str = cleaned.notna()
+    cleaned = (
+        cleaned.str.replace(",", "", regex=False)
+        .str.replace("USD", "", regex=False).str.replace("%", "", regex=False)
+        .str.strip()
+    )
+    sub_values = sub.astype(object).where(~is_str, cleaned)
+
+    # Negative numbers in parentheses, e.g. "(1,200)"
+    paren = (cleaned.str.startswith("(") & cleaned.str.endswith(")")).fillna(False).astype(bool)
+    if paren.any():
+        inner = cleaned[paren].str[1:-1]
+        negated = -pd.to_numeric(inner, errors="coerce").astype(float) # float like -float(...)
+        # float() accepts a few spellings to_numeric doesn't (e.g. " 5", "1_000"); retry those one by one
+        retry = negated.isna() & inner.notna()
+        if retry.any():
+            negated[retry] = -inner[retry].map(_float_or_nan)
+        # Unparseable "(...)" strings stay as they are and become NaN below, as before
+        sub_values[paren] = negated.where(negated.notna(), cleaned[paren])
+    values = s.astype(object)
+    values[todo] = sub_values.to_numpy()
+    # Infer the cells' type like Series.apply did: integers mixed with floats (e.g. from "(1,200)")
+    # give float64, where to_numeric alone would keep int64
+    return pd.to_numeric(values.infer_objects(), errors="coerce")
+
+def months_to_num(s: pd.Series) -> pd.Series:
+    """Column-at-a-time equivalent of s.apply(month_name_to_num)."""
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        nums = s.astype(float)
+        is_str = pd.Series(False, index=s.index)
+        from_str = nums
+    else:
+        try:
+            keys = s.str.capitalize().str[:3]
+        except AttributeError:
+            keys = pd.Series(np.nan, index=s.index, dtype=object)
+        is_str = keys.notna()
+        from_str = keys.map(MONTHS_MAP).fillna(1)
+        nums = pd.to_numeric(s.astype(object).where(~is_str), errors="coerce").astype(float)
+    nums = np.trunc(nums) # int() truncates towards zero
+    from_num = nums.where(nums.between(1, 12), 1)
+    return from_str.where(is_str, from_num).astype(int)
+
+def _as_str(s: pd.Series) -> pd.Series:
+    """Column-at-a-time equivalent of s.map(str) (missing values become 'nan', 'None', ...)."""
+    out = s.astype(str).astype(object)
+    missing = s.isna()
+    if missing.any():
+        out[missing] = s[missing].map(str)
+    return out
+
+def map_categories(df: pd.DataFrame, products_df: Union[pd.DataFrame, Mapping[str, str]]) -> pd.Series:
+    """
+    Category of every row from the product master, falling back to the row's own Category
+    ("Unknown" if there is no Category column). Vectorized dictionary lookup.
+    The master can also be passed as a ready-made Product -> Category mapping.
+    """
+    if isinstance(products_df, Mapping):
+        prod_map = products_df
+    elif "Product" in products_df.columns and "Category" in products_df.columns:
+        prod_map = dict(zip(products_df["Product"].astype(str), products_df["Category"].astype(str)))
+    else:
+        prod_map = {}
+    products = _as_str(df["Product"])
+    fallback = _as_str(df["Category"]) if "Category" in df.columns else "Unknown"
+    mapped = products.map(prod_map)
+    return mapped.where(products.isin(prod_map.keys()), fallback)
+
 def coerce_narrow_schema_types(df: pd.DataFrame) -> pd.DataFrame:
     """Type coercion for the internal narrow schema DataFrame."""
     if df.empty:
@@ -96,12 +190,11 @@ def coerce_narrow_schema_types(df: pd.DataFrame) -> pd.DataFrame:
     # Apply cleaning before conversion for numeric columns
     for col in INTERNAL_NUMERIC_COLS:
         if col in df.columns:
-            df[col] = df[col].apply(clean_numeric_string)
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
+            df[col] = clean_numeric_series(df[col]).fillna(0.0)
     
     # Handle 'Month' column (ensure integer 1-12)
     if "Month" in df.columns:
-        df["Month"] = df["Month"].apply(month_name_to_num).fillna(1).astype(int)
+        df["Month"] = months_to_num(df["Month"])
         df.loc[~df["Month"].between(1, 12), "Month"] = 1 # Invalid months become 1
     
     # Ensure string types for other columns
@@ -127,8 +220,7 @@ def coerce_wide_schema_types(df: pd.DataFrame) -> pd.DataFrame:
     # Apply cleaning and convert numeric columns
     for col in WIDE_EXCEL_NUMERIC_COLS:
         if col in df.columns:
-            df[col] = df[col].apply(clean_numeric_string)
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
+            df[col] = clean_numeric_series(df[col]).fillna(0.0)
     
     # Ensure string types for other columns
     string_cols = [c for c in WIDE_EXCEL_COLS if c not in WIDE_EXCEL_NUMERIC_COLS]
@@ -140,16 +232,12 @@ def coerce_wide_schema_types(df: pd.DataFrame) -> pd.DataFrame:
     available_cols = [col for col in [IDCOL] + WIDE_EXCEL_COLS if col in df.columns]
     return df[available_cols]
 
-def recalc_wide_schema(df: pd.DataFrame, products_df: pd.DataFrame) -> pd.DataFrame:
+def recalc_wide_schema(df: pd.DataFrame, products_df: Union[pd.DataFrame, Mapping[str, str]]) -> pd.DataFrame:
     """Recalculates sales and GP for a wide-schema DataFrame."""
     if df.empty:
         return df
     
-    prod_map = dict(zip(products_df["Product"].astype(str), products_df["Category"].astype(str)))
-    df["Category"] = df.apply(
-        lambda r: prod_map.get(str(r["Product"]), str(r.get("Category", "Unknown"))), 
-        axis=1
-    )
+    df["Category"] = map_categories(df, products_df)
     
     # Calculate quarterly sales and GP
     df["Sales_Q1 (USD)"] = ((df["Qty_Jan (MT)"] + df["Qty_Feb (MT)"] + df["Qty_Mar (MT)"]) * df["PMT_Q1 (USD)"]).round(2)
@@ -172,16 +260,12 @@ def recalc_wide_schema(df: pd.DataFrame, products_df: pd.DataFrame) -> pd.DataFr
     
     return df
 
-def recalc_narrow_schema(df: pd.DataFrame, products_df: pd.DataFrame) -> pd.DataFrame:
+def recalc_narrow_schema(df: pd.DataFrame, products_df: Union[pd.DataFrame, Mapping[str, str]]) -> pd.DataFrame:
     """Recalculation for individual monthly entries (narrow schema)"""
     if df.empty:
         return df
     
-    prod_map = dict(zip(products_df["Product"].astype(str), products_df["Category"].astype(str)))
-    df["Category"] = df.apply(
-        lambda r: prod_map.get(str(r["Product"]), str(r.get("Category", "Unknown"))), 
-        axis=1
-    )
+    df["Category"] = map_categories(df, products_df)
     
     df["Sales (USD)"] = (df["Qty (MT)"] * df["PMT (USD)"]).round(2)
     df["GP (USD)"] = (df["Sales (USD)"] * df["GP %"] / 100.0).round(2)
@@ -207,7 +291,7 @@ def convert_wide_to_narrow(df_wide: pd.DataFrame) -> pd.DataFrame:
     if df_wide.empty:
         return pd.DataFrame(columns=[IDCOL] + INTERNAL_DF_COLS)
 
-    work = df_wide.copy()
+    work = df_wide # melt() doesn't modify its input, so no copy is needed
     month_qty_cols = [c for c in work.columns if c.startswith("Qty_") and c.endswith("(MT)")]
     
     if not month_qty_cols:
@@ -220,23 +304,20 @@ def convert_wide_to_narrow(df_wide: pd.DataFrame) -> pd.DataFrame:
 
     df_melted = work.melt(id_vars=id_vars, value_vars=month_qty_cols, var_name="MonthCol", value_name="Qty (MT)")
 
-    month_map_name = {"Jan":1,"Feb":2,"Mar":3,"Apr":4,"May":5,"Jun":6,"Jul":7,"Aug":8,"Sep":9,"Oct":10,"Nov":11,"Dec":12}
-    df_melted["Month"] = df_melted["MonthCol"].str.extract(r"Qty_(\w+)\s*\(MT\)", expand=False).map(month_map_name).fillna(1).astype(int)
+    # Parse the twelve column names once instead of running the regex on every melted row
+    month_cols = pd.Series(month_qty_cols)
+    month_of_col = dict(zip(month_qty_cols, month_cols.str.extract(r"Qty_(\w+)\s*\(MT\)", expand=False).map(MONTHS_MAP).fillna(1).astype(int)))
+    df_melted["Month"] = df_melted["MonthCol"].map(month_of_col).astype(int)
     
     df_melted = df_melted[df_melted["Qty (MT)"] > 0].reset_index(drop=True)
 
     if df_melted.empty:
         return pd.DataFrame(columns=[IDCOL] + INTERNAL_DF_COLS)
 
-    def get_monthly_pmt(row):
-        mo = int(row["Month"])
-        if mo in (1,2,3): return row.get("PMT_Q1 (USD)", 0.0)
-        if mo in (4,5,6): return row.get("PMT_Q2 (USD)", 0.0)
-        if mo in (7,8,9): return row.get("PMT_Q3 (USD)", 0.0)
-        if mo in (10,11,12): return row.get("PMT_Q4 (USD)", 0.0)
-        return 0.0
-    
-    df_melted["PMT (USD)"] = df_melted.apply(get_monthly_pmt, axis=1)
+    # Pick each month's quarterly PMT by indexing the four PMT columns with the quarter number
+    pmt_matrix = df_melted.reindex(columns=QUARTER_PMT_COLS, fill_value=0.0).to_numpy()
+    quarter_idx = (df_melted["Month"].to_numpy() - 1) // 3
+    df_melted["PMT (USD)"] = pd.Series(pmt_matrix[np.arange(len(df_melted)), quarter_idx], index=df_melted.index).infer_objects()
     df_melted["GP %"] = pd.to_numeric(df_melted.get("GP %", 0.0), errors="coerce").fillna(0.0)
     df_melted["Sales (USD)"] = (df_melted["Qty (MT)"] * df_melted["PMT (USD)"]).round(2)
     df_melted["GP (USD)"] = (df_melted["Sales (USD)"] * df_melted["GP %"] / 100.0).round(2)
@@ -0,0 +1,108 @@
+# budget_app/entry_edits.py
+"""
+Batched inline edits of budget entries (/api/commit "editedRows").
+
+Each edited row names an entry by its IDCOL and carries new values for any of
+the editable inputs, e.g. {"_rid": "...", "GP %": 12.5, "Qty (MT)": 40}.
+The entries are loaded with a few chunked queries, the edits are laid over
+their inputs as NumPy arrays and Sales, GP and profit per ton are recomputed
+for all of them at once with the recalculation's formulas
+(recalc.recalculated_arrays). Only entries whose stored values actually
+change are modified; the ORM flushes them as one batched UPDATE.
+"""
+import math
+from typing import Any, Dict, List, Mapping, Tuple
+
+import numpy as np
+
+from .models import BudgetEntry
+from .data_utils import IDCOL
+from .entry_service import BROKER_MINING_SECTIONS, EntryValidationError
+from .recalc import recalculated_arrays
+from .rollups import ID_CHUNK_SIZE
+
+# Editable column label -> BudgetEntry attribute
+EDITABLE_FIELDS = {
+    "Qty (MT)": "qty_mt",
+    "PMT (USD)": "pmt_usd",
+    "GP %": "gp_percent",
+    "Profit per Ton": "profit_per_ton",
+}
+MAX_EDITED_ROWS = 20000
+
+_INPUTS = tuple(EDITABLE_FIELDS.values())
+_DERIVED = ("sales_usd", "gp_usd", "profit_per_ton")
+
+
+def parse_edits(edited_rows: Any) -> Dict[str, Dict[str, float]]:
+    """Validates the edited rows into {entry id: {attribute: value}}; later edits of a row win."""
+    if not isinstance(edited_rows, list):
+        raise EntryValidationError("editedRows must be a list.")
+    if len(edited_rows) > MAX_EDITED_ROWS:
+        raise EntryValidationError(f"At most {MAX_EDITED_ROWS} rows can be edited at once.")
+    edits: Dict[str, Dict[str, float]] = {}
+    for number, row in enumerate(edited_rows, start=1):
+        if not isinstance(row, Mapping) or not row.get(IDCOL):
+            raise EntryValidationError(f"Edited row {number} must be an object with '{IDCOL}'.")
+        values = edits.setdefault(str(row[IDCOL]), {})
+        for field, value in row.items():
+            if field == IDCOL:
+                continue
+            if field not in EDITABLE_FIELDS:
+                raise EntryValidationError(f"Invalid field '{field}' for editing.")
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise EntryValidationError(f"{field} must be a valid number (row {number}).")
+            if not math.isfinite(value):
+                raise EntryValidationError(f"{field} must be a finite number (row {number}).")
+            values[EDITABLE_FIELDS[field]] = value
+    return {rid: values for rid, values in edits.items() if values}
+
+
+def _load_entries(user_id: str, entry_ids: List[str]) -> List[BudgetEntry]:
+    entries = []
+    for start in range(0, len(entry_ids), ID_CHUNK_SIZE):
+        entries += BudgetEntry.query.filter(
+            BudgetEntry.user_id == user_id, BudgetEntry._rid.in_(entry_ids[start:start + ID_CHUNK_SIZE])
+        ).all()
+    return entries
+
+
+def _column(entries: List[BudgetEntry], attribute: str) -> np.ndarray:
+    return np.array([getattr(e, attribute) or 0.0 for e in entries], dtype=np.float64)
+
+
+def apply_edits(user_id: str, edits: Mapping[str, Mapping[str, float]]) -> Tuple[List[BudgetEntry], List[str]]:
+    """
+    Applies parse_edits() output to the user's entries in the current session, without flushing.
+    Returns the entries whose values changed (for change_feed.record_changes) and the ids that
+    are not the user's entries.
+    """
+    entries = _load_entries(user_id, list(edits))
+    found = {e._rid for e in entries}
+    not_found = [rid for rid in edits if rid not in found]
+    if not entries:
+        return [], not_found
+
+    inputs = {attribute: _column(entries, attribute) for attribute in _INPUTS}
+    for i, entry in enumerate(entries):
+        for attribute, value in edits[entry._rid].items():
+            inputs[attribute][i] = value
+    is_broker = np.array([e.section in BROKER_MINING_SECTIONS for e in entries])
+    sales, gp, profit_per_ton = recalculated_arrays(
+        inputs["qty_mt"], inputs["pmt_usd"], inputs["gp_percent"], inputs["profit_per_ton"], is_broker)
+    new_values = {**inputs, "sales_usd": sales, "gp_usd": gp, "profit_per_ton": profit_per_ton}
+
+    changed = []
+    for i, entry in enumerate(entries):
+        modified = False
+        # Inputs that weren't edited keep their stored value (even NULL)
+        for attribute in {*edits[entry._rid], *_DERIVED}:
+            value = float(new_values[attribute][i])
+            if getattr(entry, attribute) != value:
+                setattr(entry, attribute, value)
+                modified = True
+        if modified:
+            changed.append(entry)
+    return changed, not_found
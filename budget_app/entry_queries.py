@@ -0,0 +1,318 @@
+# budget_app/entry_queries.py
+"""
+Server-side filtering, sorting, keyset pagination and aggregation of a user's budget entries.
+Summaries that only need the rollup dimensions are answered from entry_rollups (see rollups.py).
+"""
+import base64
+import json
+from typing import Any, Dict, List, Optional
+
+from flask import current_app
+from sqlalchemy import and_, case, func, or_, select
+
+from . import db
+from .models import BudgetEntry, EntryRollup
+from .data_utils import month_name_to_num
+from .entry_wire import ENTRY_COLUMNS, ENTRY_LABELS, encode_rows, wants_columnar
+from .rollups import ensure_rollups
+from .currency import Conversion, CurrencyError, convert_amount, converted_column, resolve_currency
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Query-string filter name -> column. Each one is backed by a (user_id, column) index.
+FILTER_COLUMNS = {
+    "business_unit": BudgetEntry.business_unit,
+    "section": BudgetEntry.section,
+    "client": BudgetEntry.client,
+    "product": BudgetEntry.product,
+    "month": BudgetEntry.month,
+}
+
+# Sortable column label (as used in the entry JSON) -> column
+SORT_COLUMNS = {
+    "Business Unit": BudgetEntry.business_unit,
+    "User Name": BudgetEntry.user_name,
+    "Section": BudgetEntry.section,
+    "Client": BudgetEntry.client,
+    "Category": BudgetEntry.category,
+    "Product": BudgetEntry.product,
+    "Month": BudgetEntry.month,
+    "Qty (MT)": BudgetEntry.qty_mt,
+    "PMT (USD)": BudgetEntry.pmt_usd,
+    "GP %": BudgetEntry.gp_percent,
+    "Sales (USD)": BudgetEntry.sales_usd,
+    "GP (USD)": BudgetEntry.gp_usd,
+    "Profit per Ton": BudgetEntry.profit_per_ton,
+    "Sector": BudgetEntry.sector,
+    "Booked": BudgetEntry.booked,
+}
+
+
+class QueryError(ValueError):
+    """Raised for invalid filter, sort or cursor parameters."""
+
+
+def filter_values(args: Dict[str, Any]) -> Dict[str, Any]:
+    """The column filters given in the request arguments (months may be given by name)."""
+    values = {}
+    for name in FILTER_COLUMNS:
+        value = args.get(name)
+        if value in (None, ""):
+            continue
+        if name == "month":
+            value = month_name_to_num(int(value) if str(value).isdigit() else value)
+        values[name] = value
+    return values
+
+
+def entry_filter_conditions(user_id: str, args: Dict[str, Any]) -> List[Any]:
+    """Builds the WHERE conditions for the user's entries from request arguments."""
+    conditions = [BudgetEntry.user_id == user_id]
+    for name, value in filter_values(args).items():
+        conditions.append(FILTER_COLUMNS[name] == value)
+
+    search = (args.get("search") or "").strip()
+    if search:
+        # Same semantics as the old client-side search: "<client> <product>" contains the text
+        haystack = func.coalesce(BudgetEntry.client, "") + " " + func.coalesce(BudgetEntry.product, "")
+        conditions.append(func.lower(haystack).contains(search.lower(), autoescape=True))
+    return conditions
+
+
+def query_conversion(args: Dict[str, Any]) -> Conversion:
+    """The ?currency= conversion, with unknown currencies reported as a QueryError."""
+    try:
+        return resolve_currency(args.get("currency"))
+    except CurrencyError as e:
+        raise QueryError(str(e))
+
+
+def encode_cursor(sort_value: Any, rid: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, rid]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        sort_value, rid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [sort_value, rid]
+    except Exception:
+        raise QueryError("Invalid cursor.")
+
+
+def keyset_condition(column, last_value: Any, last_rid: str, descending: bool):
+    """
+    The rows after (last_value, last_rid) in (column, _rid) order. NULLs sort first in ascending
+    order and last in descending order, as SQL Server and SQLite order them, and are matched
+    explicitly because comparisons with NULL are never true.
+    """
+    rid = BudgetEntry._rid
+    if last_value is None:
+        if descending:
+            return and_(column.is_(None), rid < last_rid)
+        return or_(and_(column.is_(None), rid > last_rid), column.isnot(None))
+    if descending:
+        return or_(and_(column <= last_value, or_(column < last_value, rid < last_rid)), column.is_(None))
+    return and_(column >= last_value, or_(column > last_value, rid > last_rid))
+
+
+def entries_page(user_id: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns one page of the user's filtered entries, sorted on any column.
+
+    Pagination is keyset based: the cursor holds the sort value and _rid of the last row,
+    so every page is a range read instead of an OFFSET scan. Totals for the whole filtered
+    set are returned with the first page only (they don't change between pages).
+    ?format=columnar returns the rows in the columnar format (see entry_wire.py).
+    ?currency= converts the amounts in the query itself (sorting still uses the USD values,
+    which gives the same order); the column labels stay as they are.
+    """
+    sort = args.get("sort") or "Month"
+    if sort not in SORT_COLUMNS:
+        raise QueryError(f"Cannot sort on '{sort}'.")
+    descending = str(args.get("dir", "asc")).lower() == "desc"
+    try:
+        limit = min(max(int(args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        raise QueryError("Invalid page size.")
+
+    conversion = query_conversion(args)
+    conditions = entry_filter_conditions(user_id, args)
+    # The raw column (not an expression on it), so pages are range reads of its (user_id, column) index
+    sort_column = SORT_COLUMNS[sort]
+    rid = BudgetEntry._rid
+
+    cursor = args.get("cursor")
+    page_conditions = list(conditions)
+    if cursor:
+        last_value, last_rid = decode_cursor(cursor)
+        page_conditions.append(keyset_condition(sort_column, last_value, last_rid, descending))
+
+    order = (sort_column.desc(), rid.desc()) if descending else (sort_column.asc(), rid.asc())
+    columns = [converted_column(column, label, conversion) for column, label in zip(ENTRY_COLUMNS, ENTRY_LABELS)]
+    rows = db.session.execute(
+        select(*columns, sort_column.label("sort_value"))
+        .where(*page_conditions)
+        .order_by(*order)
+        .limit(limit + 1)
+    ).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor: Optional[str] = None
+    if has_more:
+        last_row = rows[-1]
+        next_cursor = encode_cursor(last_row.sort_value, last_row._mapping["_rid"])
+
+    entry_rows = [tuple(row)[:-1] for row in rows]
+    result = {"rows": encode_rows(entry_rows, wants_columnar(args)), "next_cursor": next_cursor,
+              "currency": conversion.currency, "rate_version": conversion.rate_version}
+    if not cursor:
+        totals = filtered_totals(conditions)
+        for key in ("Sales (USD)", "GP (USD)"):
+            totals[key] = convert_amount(totals[key], conversion)
+        result["totals"] = totals
+    return result
+
+
+def filtered_totals(conditions: List[Any]) -> Dict[str, Any]:
+    """Count, total sales and total GP of the filtered entries, computed by the database."""
+    count, sales, gp = db.session.execute(
+        select(func.count(BudgetEntry._rid), func.sum(BudgetEntry.sales_usd), func.sum(BudgetEntry.gp_usd))
+        .where(*conditions)
+    ).one()
+    return {"count": count or 0, "Sales (USD)": round(sales or 0.0, 2), "GP (USD)": round(gp or 0.0, 2)}
+
+
+def filter_options(user_id: str) -> Dict[str, List[Any]]:
+    """Distinct values for the filter dropdowns, read straight from the indexes."""
+    options = {}
+    for name, column in FILTER_COLUMNS.items():
+        values = db.session.execute(
+            select(column).where(BudgetEntry.user_id == user_id, column.isnot(None)).distinct().order_by(column)
+        ).scalars().all()
+        options[name] = [v for v in values if v != ""]
+    return options
+
+
+# Dimensions the summary can group by. Quarter is derived from the month in SQL.
+SUMMARY_DIMENSIONS = {
+    "business_unit": BudgetEntry.business_unit,
+    "section": BudgetEntry.section,
+    "client": BudgetEntry.client,
+    "category": BudgetEntry.category,
+    "product": BudgetEntry.product,
+    "month": BudgetEntry.month,
+    "quarter": (BudgetEntry.month + 2) // 3,
+    "booked": BudgetEntry.booked,
+}
+
+
+def summary_measures(booked_split: bool = False) -> List[Any]:
+    """The aggregate columns of a summary query, optionally split by Booked = Yes / No."""
+    measures = [
+        func.count(BudgetEntry._rid).label("count"),
+        func.sum(BudgetEntry.qty_mt).label("qty"),
+        func.sum(BudgetEntry.sales_usd).label("sales"),
+        func.sum(BudgetEntry.gp_usd).label("gp"),
+    ]
+    if booked_split:
+        is_booked = BudgetEntry.booked == "Yes"
+        for name, column in (("qty", BudgetEntry.qty_mt), ("sales", BudgetEntry.sales_usd), ("gp", BudgetEntry.gp_usd)):
+            measures.append(func.sum(case((is_booked, column), else_=0)).label(f"booked_{name}"))
+            measures.append(func.sum(case((is_booked, 0), else_=column)).label(f"not_booked_{name}"))
+    return measures
+
+
+def summary_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Rounds the sums and adds the weighted GM % (total GP / total sales)."""
+    out = {}
+    for key, value in row.items():
+        if key in SUMMARY_DIMENSIONS:
+            out[key] = int(value) if key in ("month", "quarter") and value is not None else value
+        elif key == "count":
+            out[key] = value or 0
+        else:
+            out[key] = round(value or 0.0, 2)
+    sales = out.get("sales", 0.0)
+    out["gm_percent"] = round(out.get("gp", 0.0) / sales * 100, 2) if sales else 0.0
+    return out
+
+
+def parse_group_by(value: Optional[str]) -> List[str]:
+    dims = [d.strip() for d in (value or "").split(",") if d.strip()]
+    unknown = [d for d in dims if d not in SUMMARY_DIMENSIONS]
+    if unknown:
+        raise QueryError(f"Cannot group by {', '.join(unknown)}.")
+    return list(dict.fromkeys(dims))
+
+
+# The same dimensions over entry_rollups, which store a missing value as '' (or month 0)
+ROLLUP_MONTH = func.nullif(EntryRollup.month, 0)
+ROLLUP_SUMMARY_DIMENSIONS = {
+    "business_unit": func.nullif(EntryRollup.business_unit, ""),
+    "section": func.nullif(EntryRollup.section, ""),
+    "client": func.nullif(EntryRollup.client, ""),
+    "category": func.nullif(EntryRollup.category, ""),
+    "month": ROLLUP_MONTH,
+    "quarter": (ROLLUP_MONTH + 2) // 3,
+    "booked": func.nullif(EntryRollup.booked, ""),
+}
+
+
+def rollup_summary_measures(booked_split: bool = False) -> List[Any]:
+    """summary_measures() computed from the rollups."""
+    measures = [
+        func.sum(EntryRollup.entry_count).label("count"),
+        func.sum(EntryRollup.qty_mt).label("qty"),
+        func.sum(EntryRollup.sales_usd).label("sales"),
+        func.sum(EntryRollup.gp_usd).label("gp"),
+    ]
+    if booked_split:
+        is_booked = EntryRollup.booked == "Yes"
+        for name, column in (("qty", EntryRollup.qty_mt), ("sales", EntryRollup.sales_usd), ("gp", EntryRollup.gp_usd)):
+            measures.append(func.sum(case((is_booked, column), else_=0)).label(f"booked_{name}"))
+            measures.append(func.sum(case((is_booked, 0), else_=column)).label(f"not_booked_{name}"))
+    return measures
+
+
+def uses_rollups(dims: List[str], args: Dict[str, Any]) -> bool:
+    """True when the summary only needs dimensions and filters that entry_rollups has."""
+    if not current_app.config.get("SUMMARY_FROM_ROLLUPS", True):
+        return False
+    if (args.get("search") or "").strip() or "product" in filter_values(args):
+        return False
+    return all(d in ROLLUP_SUMMARY_DIMENSIONS for d in dims)
+
+
+def entries_summary(user_id: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Aggregates the user's (filtered) entries in the database with GROUP BY.
+    Only the groups cross the wire, so the cost for the browser depends on the number
+    of groups, not on the number of entries. Summaries without a product dimension,
+    product filter or search read the rollups instead of the entries; building them
+    for a user who has none yet writes to the session, so the caller commits.
+    """
+    dims = parse_group_by(args.get("group_by"))
+    booked_split = str(args.get("booked_split", "")).lower() in ("1", "true", "yes")
+    if uses_rollups(dims, args):
+        ensure_rollups(user_id)
+        conditions = [EntryRollup.user_id == user_id]
+        conditions += [getattr(EntryRollup, name) == value for name, value in filter_values(args).items()]
+        dimensions, measures = ROLLUP_SUMMARY_DIMENSIONS, rollup_summary_measures(booked_split)
+    else:
+        conditions = entry_filter_conditions(user_id, args)
+        dimensions, measures = SUMMARY_DIMENSIONS, summary_measures(booked_split)
+
+    totals = db.session.execute(select(*measures).where(*conditions)).mappings().one()
+    result = {"group_by": dims, "totals": summary_row(dict(totals)), "groups": []}
+    if dims:
+        dim_columns = [dimensions[d].label(d) for d in dims]
+        rows = db.session.execute(
+            select(*dim_columns, *measures)
+            .where(*conditions)
+            .group_by(*[dimensions[d] for d in dims])
+            .order_by(*[dimensions[d] for d in dims])
+        ).mappings().all()
+        result["groups"] = [summary_row(dict(r)) for r in rows]
+    return result
@@ -0,0 +1,124 @@
+# budget_app/entry_service.py
+
+import uuid
+from typing import Any, Dict, List
+
+from .models import BudgetEntry
+from .data_utils import month_name_to_num
+
+# Sections that are budgeted on profit per ton instead of PMT and GP %
+BROKER_MINING_SECTIONS = ("Broker", "Mining")
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+class EntryValidationError(ValueError):
+    """Raised when a budget line breaks the Add Entry validation rules."""
+
+
+def build_entry(data: Dict[str, Any], user_id: str, user_name: str) -> BudgetEntry:
+    """
+    Validates one narrow (single month) entry payload and builds its BudgetEntry.
+    Applies the Broker/Mining and PMT/GP % rules used by the Add Entry form.
+    """
+    try:
+        qty = float(data.get("qty"))
+    except (ValueError, TypeError):
+        raise EntryValidationError("Quantity (MT) must be a valid number and cannot be empty.")
+
+    # Block zero-quantity entries immediately
+    if qty == 0:
+        raise EntryValidationError("Quantity (MT) cannot be 0.")
+
+    section = str(data.get("section", ""))
+    sales, gp, pmt, gp_percent, profit_per_ton = 0.0, 0.0, 0.0, 0.0, 0.0
+
+    if section in BROKER_MINING_SECTIONS:
+        try:
+            profit_per_ton = float(data.get("profit_per_ton"))
+        except (ValueError, TypeError):
+            raise EntryValidationError("Profit per Ton must be a valid number and cannot be empty.")
+        if profit_per_ton == 0:
+            raise EntryValidationError("Profit per Ton cannot be 0 for Broker/Mining.")
+        gp = round(qty * profit_per_ton, 2)
+    else:
+        try:
+            pmt = float(data.get("pmt"))
+            gp_percent = float(data.get("gm_percent"))
+        except (ValueError, TypeError):
+            raise EntryValidationError("PMT and GP % must be valid numbers and cannot be empty.")
+        if pmt == 0:
+            raise EntryValidationError("PMT (USD) cannot be 0 for this section.")
+        if gp_percent == 0:
+            raise EntryValidationError("GP % cannot be 0 for this section.")
+        sales = round(qty * pmt, 2)
+        gp = round(sales * (gp_percent / 100.0), 2)
+        if qty > 0: profit_per_ton = round(gp / qty, 2)
+
+    return BudgetEntry(
+        _rid=str(uuid.uuid4()), user_id=user_id, user_name=user_name, profit_per_ton=profit_per_ton,
+        business_unit=str(data.get("business_unit", "")), section=section, client=str(data.get("client", "")),
+        category=str(data.get("category", "")), product=str(data.get("product", "")), month=month_name_to_num(data.get("month_name", "Jan")),
+        pmt_usd=pmt, gp_percent=gp_percent, qty_mt=qty, sales_usd=sales, gp_usd=gp,
+        sector=str(data.get("sector", "")), booked=str(data.get("booked", "No")),
+    )
+
+
+def expand_wide_line(line: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Expands a wide-form budget line (one product, twelve months) into narrow entry payloads.
+
+    The line carries the shared fields plus quarterly PMTs and a "months" mapping, e.g.
+    {"section": "Retail", "pmt_q1": 100, ..., "gm_percent": 8, "months": {"Jan": {"qty": 5, "booked": "Yes"}}}.
+    Months that are missing, empty or 0 are skipped, exactly like the Add Entry form does.
+    """
+    months = line.get("months") or {}
+    base = {k: v for k, v in line.items() if k not in ("months", "pmt_q1", "pmt_q2", "pmt_q3", "pmt_q4")}
+    payloads = []
+    for idx, month_name in enumerate(MONTH_NAMES):
+        month_data = months.get(month_name)
+        if month_data is None:
+            continue
+        if not isinstance(month_data, dict):
+            month_data = {"qty": month_data}
+        qty = month_data.get("qty")
+        if qty is None or str(qty).strip() == "":
+            continue
+        try:
+            if float(qty) == 0: continue
+        except (ValueError, TypeError):
+            pass  # Let build_entry report the invalid quantity
+        payload = dict(base, month_name=month_name, qty=qty, booked=month_data.get("booked", line.get("booked", "No")))
+        if str(line.get("section", "")) not in BROKER_MINING_SECTIONS:
+            payload["pmt"] = line.get(f"pmt_q{idx // 3 + 1}", line.get("pmt"))
+        payloads.append(payload)
+    return payloads
+
+
+def build_entries_from_batch(payload: Dict[str, Any], user_id: str, user_name: str) -> List[BudgetEntry]:
+    """
+    Builds every entry of a batch request, validating all of them before anything is saved.
+
+    Accepts {"lines": [wide lines]}, {"entries": [narrow payloads]} (both may be combined),
+    or a single wide line. Raises EntryValidationError naming the offending line and month.
+    """
+    lines = payload.get("lines")
+    if lines is None and "months" in payload:
+        lines = [payload]
+    narrow = [(f"Entry {i + 1}", p) for i, p in enumerate(payload.get("entries") or [])]
+    for i, line in enumerate(lines or []):
+        expanded = expand_wide_line(line)
+        if not expanded:
+            raise EntryValidationError(f"Line {i + 1}: At least one month must have a quantity.")
+        narrow.extend((f"Line {i + 1} ({p['month_name']})", p) for p in expanded)
+
+    if not narrow:
+        raise EntryValidationError("No entries provided.")
+
+    entries = []
+    for label, data in narrow:
+        try:
+            entries.append(build_entry(data, user_id, user_name))
+        except EntryValidationError as e:
+            raise EntryValidationError(f"{label}: {e}")
+    return entries
@@ -0,0 +1,55 @@
+# budget_app/entry_wire.py
+"""
+Wire formats for lists of budget entries.
+
+Entries are read with a Core select of the entry columns (no ORM objects) and
+sent either as the usual list of row objects, or, with ?format=columnar, as
+
+    {"format": "columnar", "count": N, "columns": [...labels],
+     "data": {"Qty (MT)": [...], "Client": {"dict": ["A", "B"], "codes": [0, 1, 0]}, ...}}
+
+where the repetitive text columns are dictionary encoded. The column labels are
+the same as in BudgetEntry.to_dict(); main.js decodes both formats.
+"""
+from typing import Any, Dict, List, Mapping, Sequence
+
+from sqlalchemy import select
+
+from .models import BudgetEntry, ENTRY_COLUMN_MAP
+
+ENTRY_LABELS = list(ENTRY_COLUMN_MAP)
+ENTRY_COLUMNS = [getattr(BudgetEntry, ENTRY_COLUMN_MAP[label]) for label in ENTRY_LABELS]
+# Low-cardinality text columns sent as a value dictionary plus integer codes
+DICTIONARY_COLUMNS = {"User ID", "User Name", "Business Unit", "Section", "Client", "Category", "Product", "Sector", "Booked"}
+
+
+def wants_columnar(args: Mapping[str, Any]) -> bool:
+    return str(args.get("format", "")).lower() == "columnar"
+
+
+def entries_statement(*conditions):
+    """A Core select of every entry column, in ENTRY_LABELS order."""
+    return select(*ENTRY_COLUMNS).where(*conditions)
+
+
+def _dictionary_encode(values: Sequence[Any]) -> Dict[str, List[Any]]:
+    index: Dict[Any, int] = {}
+    codes = [index.setdefault(value, len(index)) for value in values]
+    return {"dict": list(index), "codes": codes}
+
+
+def rows_to_columnar(rows: Sequence[Sequence[Any]], labels: Sequence[str] = ENTRY_LABELS) -> Dict[str, Any]:
+    """Transposes select rows (tuples in `labels` order) into the columnar payload."""
+    columns = list(zip(*rows)) if rows else [() for _ in labels]
+    data = {
+        label: _dictionary_encode(values) if label in DICTIONARY_COLUMNS else list(values)
+        for label, values in zip(labels, columns)
+    }
+    return {"format": "columnar", "count": len(rows), "columns": list(labels), "data": data}
+
+
+def encode_rows(rows: Sequence[Sequence[Any]], columnar: bool = False, labels: Sequence[str] = ENTRY_LABELS):
+    """Select rows as a columnar payload, or as a list of row objects like BudgetEntry.to_dict()."""
+    if columnar:
+        return rows_to_columnar(rows, labels)
+    return [dict(zip(labels, row)) for row in rows]
@@ -0,0 +1,126 @@
+# budget_app/exporter.py
+"""
+Streaming budget exports (XLSX, CSV and Parquet).
+
+Rows are read from the database in batches (yield_per) and written straight
+into the output format, so the user's budget is never materialised as ORM
+objects or DataFrames. CSV is sent to the client while it is being produced.
+XLSX and Parquet files need their footer written before they can be read, so
+they are built in a spooled temporary file (in memory up to a few MB, on disk
+beyond that) and streamed from there. Amounts can be exported in another
+currency; they are converted in the query (see currency.py).
+"""
+import csv
+import io
+import re
+import tempfile
+from typing import Any, Iterable, Iterator, List, Optional, Sequence
+
+from openpyxl import Workbook
+from sqlalchemy import select
+
+from . import db
+from .models import BudgetEntry, ENTRY_COLUMN_MAP
+from .data_utils import SAVE_EXCEL_COLS
+from .currency import BASE_CURRENCY, Conversion, converted_column
+
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+EXPORT_BATCH_ROWS = 5000
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# Parquet column types, by export column
+NUMERIC_EXPORT_COLS = {"Month": "int", "Qty (MT)": "float", "PMT (USD)": "float", "GP %": "float", "Sales (USD)": "float", "GP (USD)": "float"}
+
+
+class ExportError(ValueError):
+    """Raised when an export can't be produced (unknown format, missing optional dependency)."""
+
+
+def export_columns(columns: Sequence[str] = SAVE_EXCEL_COLS, conversion: Optional[Conversion] = None) -> List[Any]:
+    """The entry columns of an export, with amounts converted in the query when a conversion is given."""
+    selected = [getattr(BudgetEntry, ENTRY_COLUMN_MAP[c]) for c in columns]
+    if conversion is None:
+        return selected
+    return [converted_column(column, label, conversion) for column, label in zip(selected, columns)]
+
+
+def iter_row_batches(statement, batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[List[tuple]]:
+    """Runs a Core select and yields its rows in lists of at most `batch_rows` tuples."""
+    result = db.session.execute(statement.execution_options(yield_per=batch_rows, stream_results=True))
+    for partition in result.partitions(batch_rows):
+        yield [tuple(row) for row in partition]
+
+
+def user_entries_statement(user_id: str, columns: Sequence[str] = SAVE_EXCEL_COLS, conversion: Optional[Conversion] = None):
+    return select(*export_columns(columns, conversion)).where(BudgetEntry.user_id == user_id).order_by(BudgetEntry.month, BudgetEntry._rid)
+
+
+def has_entries(user_id: str) -> bool:
+    return db.session.execute(select(BudgetEntry._rid).where(BudgetEntry.user_id == user_id).limit(1)).first() is not None
+
+
+def iter_csv(batches: Iterable[List[tuple]], header: Sequence[str]) -> Iterator[bytes]:
+    """Yields the CSV file one encoded batch at a time (UTF-8 with BOM so Excel reads it correctly)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+
+
+def write_xlsx(batches: Iterable[List[tuple]], header: Sequence[str], fileobj, sheet: str = "Budget") -> None:
+    """Writes the rows into a write-only workbook, which keeps only the current row in memory."""
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet)
+    worksheet.append(list(header))
+    for batch in batches:
+        for row in batch:
+            worksheet.append(row)
+    workbook.save(fileobj)
+
+
+def _usd_label(label: str) -> str:
+    """Converted exports name their currency instead of USD (see currency.currency_header)."""
+    return re.sub(r"\([A-Z]{3}\)$", f"({BASE_CURRENCY})", label)
+
+
+def write_parquet(batches: Iterable[List[tuple]], header: Sequence[str], fileobj) -> None:
+    """Writes one Parquet row group per batch. Needs the optional pyarrow package."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("Parquet export requires the 'pyarrow' package.")
+    types = {"int": pa.int64(), "float": pa.float64()}
+    schema = pa.schema([(col, types.get(NUMERIC_EXPORT_COLS.get(_usd_label(col)), pa.string())) for col in header])
+    with pq.ParquetWriter(fileobj, schema, compression="snappy") as writer:
+        for batch in batches:
+            columns = list(zip(*batch)) if batch else [[] for _ in header]
+            writer.write_table(pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+
+
+def write_export_file(fmt: str, batches: Iterable[List[tuple]], header: Sequence[str], fileobj,
+                      sheet: str = "Budget") -> None:
+    """Writes an XLSX or Parquet export into a binary file object."""
+    if fmt == "xlsx":
+        write_xlsx(batches, header, fileobj, sheet)
+    elif fmt == "parquet":
+        write_parquet(batches, header, fileobj)
+    else:
+        raise ExportError(f"Unsupported export format '{fmt}'.")
+
+
+def build_export_file(fmt: str, batches: Iterable[List[tuple]], header: Sequence[str], sheet: str = "Budget"):
+    """Renders an XLSX or Parquet export into a spooled temporary file, rewound for reading."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    write_export_file(fmt, batches, header, spool, sheet)
+    spool.seek(0)
+    return spool
@@ -0,0 +1,103 @@
+# budget_app/http_cache.py
+"""
+Conditional GET and compression for the JSON API.
+
+Read endpoints decorated with @conditional get an ETag built from the user's
+data version (plus the master data version where the response includes masters,
+and the exchange rate version where amounts can be converted) and the query
+string. The versions are one primary-key lookup each, so a request whose
+If-None-Match still matches is answered with 304 before any entries are
+loaded. Browsers revalidate automatically: responses are marked
+"Cache-Control: private, no-cache".
+
+Large JSON responses are compressed with brotli (if the optional 'brotli'
+package is installed) or gzip, depending on the client's Accept-Encoding.
+"""
+import gzip
+import hashlib
+from functools import wraps
+
+from flask import current_app, request, session
+
+from .change_feed import current_version
+from .master_data import master_version
+from .currency import rate_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/csv"}
+
+
+def compute_etag(user_id: str, include_masters: bool = False, include_rates: bool = False) -> str:
+    """The (unquoted) entity tag of the current request's response for this user."""
+    parts = [user_id, request.path, request.query_string.decode("latin-1"), str(current_version(user_id))]
+    if include_masters:
+        parts.append(str(master_version(user_id)))
+    if include_rates:
+        parts.append(f"rates:{rate_version()}")
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:20]
+
+
+def conditional(include_masters: bool = False, include_rates: bool = False):
+    """Answers If-None-Match with 304 when the user's data hasn't changed since the ETag was issued."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get("user", {}).get("oid")
+            if not user_id:
+                return view(*args, **kwargs)
+            try:
+                etag = compute_etag(user_id, include_masters, include_rates)
+            except Exception:
+                # Let the view report the database error in its usual way
+                return view(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+def _accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_response(response):
+    """after_request hook: compresses JSON/CSV bodies above COMPRESS_MIN_BYTES."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    min_bytes = current_app.config.get("COMPRESS_MIN_BYTES", DEFAULT_COMPRESS_MIN_BYTES)
+    if response.calculate_content_length() < min_bytes:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if encoding == "br":
+        response.set_data(brotli.compress(body, quality=current_app.config.get("COMPRESS_BROTLI_QUALITY", 5)))
+    else:
+        response.set_data(gzip.compress(body, compresslevel=current_app.config.get("COMPRESS_GZIP_LEVEL", 6)))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_http_cache(app) -> None:
+    if app.config.get("COMPRESS_RESPONSES", True):
+        app.after_request(compress_response)
@@ -0,0 +1,290 @@
+# budget_app/importer.py
+"""
+Streaming budget import.
+
+The workbook is read row by row with openpyxl's read-only mode and handled in
+fixed-size chunks: each chunk is coerced, recalculated, converted from the wide
+to the narrow schema and inserted before the next one is read. Peak memory
+depends on the chunk size, not on the size of the file.
+
+Workbooks with several budget sheets (e.g. one per business unit), or one very
+large sheet, can instead be parsed in a pool of processes: every sheet, split
+into row ranges when there are more processes than sheets, is read and
+converted to the narrow schema in a child process, and the parent inserts the
+results as they arrive. openpyxl still has to scan the rows before a range's
+start, so splitting one sheet speeds up less than parsing separate sheets.
+"""
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from sqlalchemy import insert
+
+from . import db
+from .models import BudgetEntry, Product, ENTRY_COLUMN_MAP
+from .rollups import RollupDelta
+from .data_utils import (
+    coerce_wide_schema_types, recalc_wide_schema, convert_wide_to_narrow,
+    coerce_narrow_schema_types, recalc_narrow_schema, ensure_row_id,
+    IDCOL, INTERNAL_DF_COLS
+)
+
+# Headers that mark a sheet as the wide (one row per product, twelve months) schema
+WIDE_SCHEMA_MARKERS = ("Qty_Jan (MT)", "PMT_Q1 (USD)")
+# Headers that mark a sheet as a budget sheet at all (used when importing every sheet)
+BUDGET_SHEET_MARKERS = WIDE_SCHEMA_MARKERS + ("Qty (MT)",)
+# Sheets with fewer data rows than this are never split into row ranges
+DEFAULT_MIN_RANGE_ROWS = 10000
+
+
+class BudgetImportError(ValueError):
+    """Raised when the uploaded workbook can't be imported."""
+
+
+def load_products_df(user_id: str) -> pd.DataFrame:
+    """The user's product -> category master as a DataFrame (always with both columns)."""
+    rows = db.session.query(Product.name, Product.category).filter(Product.user_id == user_id).all()
+    return pd.DataFrame(rows, columns=["Product", "Category"])
+
+
+def _header_names(header_row) -> List[str]:
+    """Column names like pandas.read_excel gives them (blank headers become 'Unnamed: i')."""
+    return [str(v).strip() if v is not None else f"Unnamed: {i}" for i, v in enumerate(header_row)]
+
+
+def _row_chunks(rows: Iterable[tuple], columns: List[str], chunk_rows: int) -> Iterator[pd.DataFrame]:
+    buffer = []
+    for row in rows:
+        if all(v is None for v in row):
+            continue  # Skip blank spreadsheet rows
+        buffer.append(row[:len(columns)])
+        if len(buffer) >= chunk_rows:
+            yield pd.DataFrame(buffer, columns=columns)
+            buffer = []
+    if buffer:
+        yield pd.DataFrame(buffer, columns=columns)
+
+
+def iter_sheet_chunks(file, sheet: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Yields the rows of one worksheet as DataFrames of at most `chunk_rows` rows."""
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        if sheet not in workbook.sheetnames:
+            raise BudgetImportError(f"Worksheet '{sheet}' not found in the workbook.")
+        rows = workbook[sheet].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        yield from _row_chunks(rows, _header_names(header), chunk_rows)
+    finally:
+        workbook.close()
+
+
+def chunk_to_narrow(chunk: pd.DataFrame, is_wide: bool, products_df: Union[pd.DataFrame, Mapping[str, str]]) -> pd.DataFrame:
+    """Runs one chunk through the same coercion/recalculation steps as the old in-memory import."""
+    if is_wide:
+        df = coerce_wide_schema_types(chunk)
+        df = recalc_wide_schema(df, products_df)
+        df = convert_wide_to_narrow(df)
+    else:
+        df = coerce_narrow_schema_types(chunk)
+        df = recalc_narrow_schema(df, products_df)
+    return ensure_row_id(df)
+
+
+def narrow_to_records(df: pd.DataFrame, user_id: str, user_name: str, version: int) -> List[Dict[str, Any]]:
+    """Converts a narrow DataFrame into insert parameter dicts for budget_entries."""
+    if df.empty:
+        return []
+    qty = df["Qty (MT)"].to_numpy(dtype=float)
+    gp = df["GP (USD)"].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        profit_per_ton = np.where(qty > 0, np.round(gp / qty, 2), 0.0)
+    out = df[[IDCOL] + INTERNAL_DF_COLS].rename(columns=ENTRY_COLUMN_MAP)
+    out["profit_per_ton"] = profit_per_ton
+    out["user_id"], out["user_name"], out["version"] = user_id, user_name, version
+    return out.to_dict("records")
+
+
+def import_budget(file, sheet: str, user_id: str, user_name: str, version: int,
+                  chunk_rows: int, products_df: Optional[Union[pd.DataFrame, Mapping[str, str]]] = None,
+                  progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+    """
+    Streams the worksheet into budget_entries, chunk by chunk, in the caller's transaction.
+    The caller is responsible for clearing the old entries and for the final commit.
+    products_df is the product master (or a Product -> Category mapping); it is read
+    from the database when not given. progress(rows_read, rows_written) is called
+    after every chunk.
+    The user's rollups are updated with the imported entries at the end.
+    Returns the number of spreadsheet rows read and entries written.
+    """
+    if products_df is None:
+        products_df = load_products_df(user_id)
+    rows_read, rows_written, is_wide = 0, 0, None
+    rollups = RollupDelta()
+    for chunk in iter_sheet_chunks(file, sheet, chunk_rows):
+        if is_wide is None:
+            is_wide = any(col in chunk.columns for col in WIDE_SCHEMA_MARKERS)
+        rows_read += len(chunk)
+        rows_written += insert_narrow(chunk_to_narrow(chunk, is_wide, products_df), user_id, user_name, version, rollups)
+        if progress is not None:
+            progress(rows_read, rows_written)
+    rollups.apply()
+    return {"rows_read": rows_read, "rows_written": rows_written}
+
+
+def insert_narrow(narrow: pd.DataFrame, user_id: str, user_name: str, version: int, rollups: RollupDelta) -> int:
+    """Inserts a narrow DataFrame into budget_entries, adding it to `rollups`. Returns the rows written."""
+    records = narrow_to_records(narrow, user_id, user_name, version)
+    if records:
+        db.session.execute(insert(BudgetEntry), records)
+        rollups.add_frame(user_id, narrow.rename(columns=ENTRY_COLUMN_MAP))
+    return len(records)
+
+
+# --- Multi-sheet and parallel imports ----------------------------------------
+
+def resolve_sheets(path: str, spec: str) -> List[str]:
+    """
+    The sheets named by an upload's sheet field: one name, a comma-separated list,
+    or "*" for every sheet whose header looks like a budget.
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        if (spec or "").strip() == "*":
+            sheets = []
+            for name in workbook.sheetnames:
+                header = next(workbook[name].iter_rows(min_row=1, max_row=1, values_only=True), None) or ()
+                if any(str(v).strip() in BUDGET_SHEET_MARKERS for v in header if v is not None):
+                    sheets.append(name)
+            if not sheets:
+                raise BudgetImportError("No budget sheets found in the workbook.")
+            return sheets
+        sheets = [name.strip() for name in (spec or "Budget").split(",") if name.strip()]
+        missing = [name for name in sheets if name not in workbook.sheetnames]
+        if missing:
+            raise BudgetImportError(f"Worksheet '{missing[0]}' not found in the workbook.")
+        return sheets
+    finally:
+        workbook.close()
+
+
+def sheet_data_rows(path: str, sheets: Sequence[str]) -> Dict[str, int]:
+    """Data rows (below the header) per sheet, from the sheets' stored dimensions."""
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        return {sheet: max((workbook[sheet].max_row or 0) - 1, 0) for sheet in sheets}
+    finally:
+        workbook.close()
+
+
+def plan_row_ranges(data_rows: Mapping[str, int], processes: int,
+                    min_range_rows: int = DEFAULT_MIN_RANGE_ROWS) -> List[Tuple[str, int, Optional[int]]]:
+    """
+    (sheet, first_row, last_row) parse tasks: one per sheet, and large sheets split
+    into contiguous row ranges while there are fewer tasks than processes. The last
+    range of a sheet is open-ended, in case the sheet's stored dimension is short.
+    """
+    spare = max(processes - len(data_rows), 0)
+    tasks = []
+    for sheet, n in data_rows.items():
+        ranges = max(1, min(1 + spare, n // max(min_range_rows, 1)))
+        spare -= ranges - 1
+        step = math.ceil(n / ranges) if n else 0
+        for i in range(ranges):
+            first = 2 + i * step
+            tasks.append((sheet, first, None if i == ranges - 1 else first + step - 1))
+    return tasks
+
+
+def parse_row_range(path: str, sheet: str, first_row: int, last_row: Optional[int], chunk_rows: int,
+                    products: Mapping[str, str]) -> Tuple[int, pd.DataFrame]:
+    """
+    Reads rows first_row..last_row (1-based, inclusive; None = to the end) of one sheet
+    and converts them to the narrow schema. Runs in a pool process, so it only takes
+    and returns picklable values. Returns the number of spreadsheet rows read and the entries.
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet]
+        header = next(worksheet.iter_rows(min_row=1, max_row=1, values_only=True), None)
+        if header is None:
+            return 0, pd.DataFrame()
+        columns = _header_names(header)
+        is_wide = any(col in columns for col in WIDE_SCHEMA_MARKERS)
+        rows_read, parts = 0, []
+        for chunk in _row_chunks(worksheet.iter_rows(min_row=first_row, max_row=last_row, values_only=True),
+                                 columns, chunk_rows):
+            rows_read += len(chunk)
+            parts.append(chunk_to_narrow(chunk, is_wide, products))
+    finally:
+        workbook.close()
+    return rows_read, pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+
+def run_in_processes(fn: Callable, tasks: Sequence[tuple], processes: int) -> Iterator[Any]:
+    """
+    Yields fn(*task) for every task, in completion order. With more than one process the
+    tasks run in a fresh pool of "spawn" processes (forking a worker that has threads and
+    open database connections isn't safe); otherwise they run here, one after another.
+    """
+    if processes <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+    pool = ProcessPoolExecutor(max_workers=min(processes, len(tasks)), mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [pool.submit(fn, *task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def import_budget_sheets(path: str, sheets: Sequence[str], user_id: str, user_name: str, version: int,
+                         chunk_rows: int, products_df: Optional[Union[pd.DataFrame, Mapping[str, str]]] = None,
+                         processes: int = 1, min_range_rows: int = DEFAULT_MIN_RANGE_ROWS,
+                         progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+    """
+    Imports several sheets of a workbook file (see import_budget for the transaction rules).
+    With processes > 1 the sheets and row ranges are parsed in parallel (see the module
+    docstring); otherwise, or if the workbook has fewer than min_range_rows rows in
+    total, each sheet is streamed in turn.
+    """
+    if products_df is None:
+        products_df = load_products_df(user_id)
+    rows_read, rows_written = 0, 0
+    if processes > 1:
+        data_rows = sheet_data_rows(path, sheets)
+        if sum(data_rows.values()) < min_range_rows:
+            processes = 1  # Starting the pool would take longer than parsing
+
+    if processes <= 1:
+        for sheet in sheets:
+            def sheet_progress(read: int, written: int, base=(rows_read, rows_written)) -> None:
+                if progress is not None:
+                    progress(base[0] + read, base[1] + written)
+            stats = import_budget(path, sheet, user_id, user_name, version, chunk_rows, products_df, sheet_progress)
+            rows_read += stats["rows_read"]
+            rows_written += stats["rows_written"]
+        return {"rows_read": rows_read, "rows_written": rows_written, "sheets": len(sheets)}
+
+    if isinstance(products_df, pd.DataFrame):
+        products = dict(zip(products_df["Product"], products_df["Category"]))
+    else:
+        products = dict(products_df)
+    tasks = [(path, sheet, first, last, chunk_rows, products)
+             for sheet, first, last in plan_row_ranges(data_rows, processes, min_range_rows)]
+    rollups = RollupDelta()
+    for range_rows, narrow in run_in_processes(parse_row_range, tasks, processes):
+        rows_read += range_rows
+        for start in range(0, len(narrow), chunk_rows):
+            rows_written += insert_narrow(narrow.iloc[start:start + chunk_rows], user_id, user_name, version, rollups)
+        if progress is not None:
+            progress(rows_read, rows_written)
+    rollups.apply()
+    return {"rows_read": rows_read, "rows_written": rows_written, "sheets": len(sheets)}
@@ -0,0 +1,361 @@
+# budget_app/jobs.py
+"""
+Background jobs for budget and master data imports and for exports.
+
+An upload is saved to JOB_DIR and answered at once with a job ID. A small
+thread pool in each worker process then does the parsing and database work
+and reports progress (rows read, rows written) on the job. Exports are
+rendered into JOB_DIR and fetched with /api/jobs/<id>/download.
+
+Job state lives in a local SQLite file (JOB_STORE_PATH) that all workers on
+the machine share, like the sqlite session store. It is kept out of the main
+database on purpose: an import writes all its rows in one transaction, and
+the progress updates must be visible (and must not wait) while it is open.
+Jobs whose worker process died are queued again when a worker starts serving
+requests; an import that never committed simply runs again from the start.
+With JOB_WORKERS = 0 jobs run inside the request that creates them.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import current_app
+
+from . import db
+from .models import BudgetEntry
+from .change_feed import record_reset
+from .importer import import_budget_sheets, resolve_sheets
+from .exporter import EXPORT_FORMATS, iter_csv, iter_row_batches, user_entries_statement, write_export_file
+from .master_cache import cached_masters
+from .master_data import read_master_workbook, replace_masters
+from .data_utils import SAVE_EXCEL_COLS
+from .currency import currency_header, resolve_currency
+from .snapshots import snapshot_before
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+FINISHED_STATUSES = (SUCCEEDED, FAILED)
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_RETENTION_HOURS = 24
+
+Progress = Callable[[int, int], None]
+
+
+class JobError(ValueError):
+    """Raised for job requests that can't be accepted (unknown kind, bad parameters)."""
+
+
+class JobStore:
+    """The jobs table, in a SQLite file shared by the workers on this machine."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, user_id TEXT NOT NULL, user_name TEXT, kind TEXT NOT NULL, "
+                "status TEXT NOT NULL, params TEXT NOT NULL, input_path TEXT, result_path TEXT, "
+                "result_name TEXT, result TEXT, rows_read INTEGER NOT NULL DEFAULT 0, "
+                "rows_written INTEGER NOT NULL DEFAULT 0, error TEXT, owner TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_user_created ON jobs (user_id, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _execute(self, sql: str, params: Tuple = ()) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(sql, params).rowcount
+
+    def create(self, job_id: str, user_id: str, user_name: Optional[str], kind: str,
+               params: Dict[str, Any], input_path: Optional[str] = None) -> Dict[str, Any]:
+        self._execute(
+            "INSERT INTO jobs (id, user_id, user_name, kind, status, params, input_path, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, user_name, kind, QUEUED, json.dumps(params), input_path, time.time())
+        )
+        return self.get(job_id)
+
+    def get(self, job_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        sql, params = "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        if user_id is not None:
+            sql, params = sql + " AND user_id = ?", params + (user_id,)
+        with closing(self._connect()) as conn:
+            row = conn.execute(sql, params).fetchone()
+        return _job_from_row(row) if row else None
+
+    def list_for_user(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit)
+            ).fetchall()
+        return [_job_from_row(row) for row in rows]
+
+    def claim(self, job_id: str, owner: str) -> bool:
+        """Marks a queued job as running; False if another worker got it first."""
+        return self._execute(
+            "UPDATE jobs SET status = ?, owner = ?, started_at = ? WHERE id = ? AND status = ?",
+            (RUNNING, owner, time.time(), job_id, QUEUED)
+        ) == 1
+
+    def set_progress(self, job_id: str, rows_read: int, rows_written: int) -> None:
+        self._execute("UPDATE jobs SET rows_read = ?, rows_written = ? WHERE id = ?", (rows_read, rows_written, job_id))
+
+    def finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None,
+               result_path: Optional[str] = None, result_name: Optional[str] = None) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, result_path = ?, result_name = ?, finished_at = ? "
+            "WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, result_path, result_name,
+             time.time(), job_id)
+        )
+
+    def requeue_orphans(self) -> int:
+        """Queues running jobs again whose worker process on this machine no longer exists."""
+        host = socket.gethostname()
+        with closing(self._connect()) as conn:
+            running = conn.execute("SELECT id, owner FROM jobs WHERE status = ?", (RUNNING,)).fetchall()
+            orphans = [(QUEUED, row["id"], RUNNING) for row in running if _owner_is_gone(row["owner"], host)]
+            conn.executemany("UPDATE jobs SET status = ?, owner = NULL, rows_read = 0, rows_written = 0 "
+                             "WHERE id = ? AND status = ?", orphans)
+        return len(orphans)
+
+    def queued_ids(self) -> List[str]:
+        with closing(self._connect()) as conn:
+            return [row["id"] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)
+            )]
+
+    def purge(self, before: float) -> List[str]:
+        """Deletes jobs that finished before `before`; returns their files for the caller to remove."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, input_path, result_path FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (*FINISHED_STATUSES, before)
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        return [path for row in rows for path in (row["input_path"], row["result_path"]) if path]
+
+
+def _job_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def _owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_is_gone(owner: Optional[str], host: str) -> bool:
+    if not owner:
+        return True
+    owner_host, _, pid = owner.rpartition(":")
+    if owner_host != host:
+        return False  # Another machine sharing the file; only it can tell
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        return False
+    return False
+
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return datetime.utcfromtimestamp(value).isoformat(timespec="seconds") + "Z" if value else None
+
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """The job as the API returns it (no file paths or worker details)."""
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "rows_read": job["rows_read"],
+        "rows_written": job["rows_written"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": _timestamp(job["created_at"]),
+        "started_at": _timestamp(job["started_at"]),
+        "finished_at": _timestamp(job["finished_at"]),
+        "download_url": f"/api/jobs/{job['id']}/download" if job["status"] == SUCCEEDED and job["result_path"] else None,
+    }
+
+
+# --- Job kinds ---------------------------------------------------------------
+# Each handler runs in an app context and returns (result, result_path, result_name).
+
+def run_budget_import(job: Dict[str, Any], progress: Progress, directory: str):
+    """
+    Replaces the user's budget with the uploaded workbook, in one transaction, after an
+    automatic snapshot of the old one. The sheet parameter may name several sheets, or "*"
+    for all budget sheets (see importer.py).
+    """
+    user_id, path, config = job["user_id"], job["input_path"], current_app.config
+    sheets = resolve_sheets(path, job["params"].get("sheet") or "Budget")
+    backup = snapshot_before(user_id, "load")
+    BudgetEntry.query.filter_by(user_id=user_id).delete()
+    changes = record_reset(user_id)
+    stats = import_budget_sheets(path, sheets, user_id, job["user_name"], changes["version"], config["IMPORT_CHUNK_ROWS"],
+                                 products_df=cached_masters(user_id).product_map,
+                                 processes=config.get("IMPORT_PROCESSES", 1),
+                                 min_range_rows=config.get("IMPORT_MIN_RANGE_ROWS", 10000), progress=progress)
+    db.session.commit()
+    message = f"Budget loaded from '{', '.join(sheets)}' ({stats['rows_written']} entries)."
+    return {**changes, **stats, "snapshot": backup.id if backup else None, "message": message}, None, None
+
+
+def run_master_import(job: Dict[str, Any], progress: Progress, directory: str):
+    user_id = job["user_id"]
+    clients, products = read_master_workbook(job["input_path"], processes=current_app.config.get("IMPORT_PROCESSES", 1))
+    progress(len(clients) + len(products), 0)
+    replace_masters(user_id, clients, products)
+    db.session.commit()
+    progress(len(clients) + len(products), len(clients) + len(products))
+    return {"masters": cached_masters(user_id).masters, "message": "Master data loaded into database."}, None, None
+
+
+def run_export(job: Dict[str, Any], progress: Progress, directory: str):
+    """Renders the user's budget into JOB_DIR as xlsx, csv or parquet, in USD or the requested currency."""
+    fmt = job["params"]["format"]
+    conversion = resolve_currency(job["params"].get("currency"))
+    header = currency_header(SAVE_EXCEL_COLS, conversion)
+    extension = EXPORT_FORMATS[fmt][1]
+    result_path = os.path.join(directory, f"{job['id']}.{extension}")
+    result_name = f"Budget_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+    def counted(batches):
+        rows = 0
+        for batch in batches:
+            rows += len(batch)
+            progress(rows, rows)
+            yield batch
+
+    batches = counted(iter_row_batches(user_entries_statement(job["user_id"], conversion=conversion)))
+    with open(result_path, "wb") as fileobj:
+        if fmt == "csv":
+            for chunk in iter_csv(batches, header):
+                fileobj.write(chunk)
+        else:
+            write_export_file(fmt, batches, header, fileobj)
+    result = {"format": fmt, "currency": conversion.currency, "rate_version": conversion.rate_version}
+    return {**result, "message": "Export ready."}, result_path, result_name
+
+
+JOB_HANDLERS = {
+    "load_budget": run_budget_import,
+    "load_masters": run_master_import,
+    "export": run_export,
+}
+
+
+class JobRunner:
+    """Runs jobs on a per-process thread pool (or inline with workers=0)."""
+
+    def __init__(self, app, store: JobStore, directory: str, workers: int = DEFAULT_JOB_WORKERS,
+                 retention_hours: int = DEFAULT_RETENTION_HOURS):
+        self.app, self.store, self.directory = app, store, directory
+        self.workers, self.retention_hours = workers, retention_hours
+        os.makedirs(directory, exist_ok=True)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._resumed = False
+
+    def enqueue(self, kind: str, user_id: str, user_name: Optional[str], params: Optional[Dict[str, Any]] = None,
+                upload=None) -> Dict[str, Any]:
+        """Creates a job (saving the uploaded file, if any) and hands it to the pool."""
+        if kind not in JOB_HANDLERS:
+            raise JobError(f"Unknown job kind '{kind}'.")
+        self.purge_expired()
+        job_id = str(uuid.uuid4())
+        input_path = None
+        if upload is not None:
+            # openpyxl only opens paths with a workbook extension
+            input_path = os.path.join(self.directory, f"{job_id}.upload.xlsx")
+            upload.save(input_path)
+        self.store.create(job_id, user_id, user_name, kind, params or {}, input_path)
+        self.submit(job_id)
+        return self.store.get(job_id)
+
+    def submit(self, job_id: str) -> None:
+        if self.workers <= 0:
+            self.run(job_id)
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="budget-job")
+        self._executor.submit(self.run, job_id)
+
+    def run(self, job_id: str) -> None:
+        if not self.store.claim(job_id, _owner_id()):
+            return
+        job = self.store.get(job_id)
+
+        def progress(rows_read: int, rows_written: int) -> None:
+            self.store.set_progress(job_id, rows_read, rows_written)
+
+        with self.app.app_context():
+            try:
+                result, result_path, result_name = JOB_HANDLERS[job["kind"]](job, progress, self.directory)
+                self.store.finish(job_id, SUCCEEDED, result=result, result_path=result_path, result_name=result_name)
+            except Exception as e:
+                db.session.rollback()
+                self.store.finish(job_id, FAILED, error=str(e))
+            finally:
+                if job["input_path"]:
+                    _remove_file(job["input_path"])
+
+    def resume(self) -> None:
+        """Requeues jobs of dead workers and starts every queued job (once per process)."""
+        with self._lock:
+            if self._resumed:
+                return
+            self._resumed = True
+        self.store.requeue_orphans()
+        for job_id in self.store.queued_ids():
+            self.submit(job_id)
+
+    def purge_expired(self) -> None:
+        for path in self.store.purge(time.time() - self.retention_hours * 3600):
+            _remove_file(path)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def init_jobs(app) -> None:
+    """Creates the job store and runner. Queued jobs are resumed with the first request a worker serves."""
+    runner = JobRunner(
+        app,
+        JobStore(app.config["JOB_STORE_PATH"]),
+        app.config["JOB_DIR"],
+        workers=app.config.get("JOB_WORKERS", DEFAULT_JOB_WORKERS),
+        retention_hours=app.config.get("JOB_RETENTION_HOURS", DEFAULT_RETENTION_HOURS),
+    )
+    app.extensions["jobs"] = runner
+    if runner.workers > 0:
+        # Not at start-up: CLI commands create the app too and must not pick up jobs
+        app.before_request(runner.resume)
+
+
+def job_runner() -> JobRunner:
+    return current_app.extensions["jobs"]
@@ -0,0 +1,77 @@
+# budget_app/master_cache.py
+"""
+Per-worker cache of each user's master data.
+
+Every gunicorn worker keeps the most recently used users' clients, products,
+Product -> Category map and the serialized masters JSON. Before a cached entry
+is used, the user's master data version is read from the database (one
+primary-key lookup); if another worker changed the masters in the meantime the
+version differs and the entry is reloaded. Cached values are shared between
+requests and must be treated as read-only.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple
+
+from flask import current_app
+
+from .master_data import list_masters, master_version
+
+DEFAULT_MAX_USERS = 256
+
+
+class CachedMasters(NamedTuple):
+    version: int
+    masters: dict  # {"clients": [...], "products": [{"Product", "Category"}, ...]}
+    product_map: Dict[str, str]
+    masters_json: str
+
+
+class MasterCache:
+    """An LRU of CachedMasters keyed by user ID, safe to share between threads."""
+
+    def __init__(self, max_users: int = DEFAULT_MAX_USERS):
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CachedMasters]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> CachedMasters:
+        # Read the version before the data: a change committed in between only causes an extra reload
+        version = master_version(user_id)
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached.version == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        masters = list_masters(user_id)
+        cached = CachedMasters(
+            version=version,
+            masters=masters,
+            product_map={p["Product"]: p["Category"] for p in masters["products"]},
+            masters_json=json.dumps(masters),
+        )
+        with self._lock:
+            self._entries[user_id] = cached
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return cached
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def cached_masters(user_id: str) -> CachedMasters:
+    """The user's master data from the current app's cache."""
+    return current_app.extensions["master_cache"].get(user_id)
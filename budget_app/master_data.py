@@ -0,0 +1,211 @@
+# budget_app/master_data.py
+"""
+Client and product master data.
+
+(user_id, name) is unique in both tables. Names are matched case-insensitively
+on every path (_key in Python, LOWER(name) in SQL), like the default SQL Server
+collation does, so "ACME" and "Acme" are the same client. When a name repeats,
+the first occurrence wins: an existing row over a new one, and the first row of
+a workbook over later ones. A master workbook is merged into the existing rows with a handful of
+set-based statements: one read per table, then bulk inserts, bulk updates and
+chunked deletes for whatever actually changed.
+
+Every change bumps the user's master data version (master_data_versions), which
+the per-worker caches in master_cache.py compare against.
+"""
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import pandas as pd
+from sqlalchemy import delete, exists, func, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import Client, MasterDataVersion, Product
+from .importer import run_in_processes
+
+DEFAULT_CATEGORY = "Uncategorized"
+# SQL Server accepts at most 2100 parameters per statement
+DELETE_CHUNK_SIZE = 1000
+
+
+def _key(name: str) -> str:
+    """The case-insensitive identity of a master name; SQL compares func.lower(name) with it."""
+    return name.strip().lower()
+
+
+def _unique_by_key(rows: Iterable[Tuple[str, ...]]) -> Dict[str, Tuple[str, ...]]:
+    """Rows whose first value is a name, by the name's _key; the first row of each name wins."""
+    unique: Dict[str, Tuple[str, ...]] = {}
+    for row in rows:
+        unique.setdefault(_key(row[0]), row)
+    return unique
+
+
+def master_version(user_id: str) -> int:
+    """The user's master data version (0 if the masters were never changed)."""
+    version = db.session.execute(
+        select(MasterDataVersion.version).where(MasterDataVersion.user_id == user_id)
+    ).scalar()
+    return version or 0
+
+
+def bump_master_version(user_id: str) -> None:
+    """Increments the user's master data version inside the current transaction."""
+    table = MasterDataVersion.__table__
+    bump = table.update().where(table.c.user_id == user_id).values(version=table.c.version + 1)
+    if db.session.execute(bump).rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(user_id=user_id, version=1))
+        except IntegrityError:
+            # Another worker created the row first
+            db.session.execute(bump)
+
+
+def list_masters(user_id: str) -> dict:
+    """The user's clients (sorted) and products, in the shape the front end expects."""
+    clients = db.session.execute(select(Client.name).where(Client.user_id == user_id).order_by(Client.name)).scalars().all()
+    products = db.session.execute(select(Product.name, Product.category).where(Product.user_id == user_id)).all()
+    return {"clients": list(clients), "products": [{"Product": name, "Category": category} for name, category in products]}
+
+
+def _insert_if_missing(model, user_id: str, name: str, **values) -> bool:
+    """
+    INSERT ... SELECT ... WHERE NOT EXISTS in a single statement. Returns False if
+    the name is already taken in any letter case, including when a concurrent request wins the race
+    and the unique index rejects this insert (only its savepoint is rolled back then,
+    so earlier changes in the transaction are kept).
+    """
+    columns = {"user_id": user_id, "name": name, **values}
+    taken = exists().where(model.user_id == user_id, func.lower(model.name) == _key(name))
+    statement = insert(model).from_select(
+        list(columns), select(*[literal(v) for v in columns.values()]).where(~taken)
+    )
+    try:
+        with db.session.begin_nested():
+            if db.session.execute(statement).rowcount == 0:
+                return False
+    except IntegrityError:
+        return False
+    bump_master_version(user_id)
+    return True
+
+
+def add_client(user_id: str, name: str) -> bool:
+    """Adds one client in the current transaction. Returns False if it already exists."""
+    return _insert_if_missing(Client, user_id, name)
+
+
+def add_product(user_id: str, name: str, category: str = DEFAULT_CATEGORY) -> bool:
+    """Adds one product in the current transaction. Returns False if it already exists."""
+    return _insert_if_missing(Product, user_id, name, category=category)
+
+
+def _clean_names(values: Iterable) -> List[str]:
+    return [str(v).strip() for v in values if not pd.isna(v) and str(v).strip()]
+
+
+MASTER_SHEETS = ("Clients", "Products")
+# Smaller master workbooks are parsed faster than a process pool starts
+PARALLEL_MIN_BYTES = 1024 * 1024
+
+
+def read_master_sheet(file, sheet: str) -> Tuple[str, pd.DataFrame]:
+    """One sheet of a master workbook (a path or an open pd.ExcelFile); empty if the sheet is missing."""
+    excel_file = file if isinstance(file, pd.ExcelFile) else pd.ExcelFile(file, engine="openpyxl")
+    if sheet not in excel_file.sheet_names:
+        return sheet, pd.DataFrame()
+    return sheet, pd.read_excel(excel_file, sheet_name=sheet, engine="openpyxl")
+
+
+def read_master_workbook(file, processes: int = 1) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Reads the "Clients" and "Products" sheets of a master workbook into a list of
+    client names and a product -> category dict. A missing sheet gives an empty master.
+    With processes > 1 the two sheets of a large workbook file are parsed in parallel.
+    """
+    if processes > 1 and isinstance(file, str) and os.path.getsize(file) >= PARALLEL_MIN_BYTES:
+        sheets = dict(run_in_processes(read_master_sheet, [(file, sheet) for sheet in MASTER_SHEETS], processes))
+    else:
+        excel_file = pd.ExcelFile(file, engine="openpyxl")
+        sheets = dict(read_master_sheet(excel_file, sheet) for sheet in MASTER_SHEETS)
+    clients, products = [], {}
+    clients_df, products_df = sheets["Clients"], sheets["Products"]
+    if "Client" in clients_df.columns:
+        clients = _clean_names(clients_df["Client"])
+    if "Product" in products_df.columns and "Category" in products_df.columns:
+        products_df = products_df.dropna(subset=["Product"])
+        categories = products_df["Category"].where(products_df["Category"].notna(), DEFAULT_CATEGORY)
+        for name, category in zip(products_df["Product"], categories):
+            name, category = str(name).strip(), str(category).strip() or DEFAULT_CATEGORY
+            if name:
+                products.setdefault(name, category)
+    return clients, products
+
+
+def _delete_ids(model, ids: List[int]) -> None:
+    for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+        db.session.execute(delete(model).where(model.id.in_(ids[start:start + DELETE_CHUNK_SIZE])))
+
+
+def replace_masters(user_id: str, clients: Iterable[str], products: Dict[str, str]) -> dict:
+    """
+    Makes the user's masters equal to the given clients and products, in the
+    current transaction. Unchanged rows are not touched. Returns how many rows
+    were inserted, updated and deleted in each table.
+    """
+    wanted_clients = {key: name for key, (name,) in _unique_by_key((name,) for name in clients).items()}
+    wanted_products = _unique_by_key(products.items())
+
+    existing_clients = {_key(name): (id_, name) for id_, name in
+                        db.session.execute(select(Client.id, Client.name).where(Client.user_id == user_id))}
+    existing_products = {_key(name): (id_, name, category) for id_, name, category in
+                         db.session.execute(select(Product.id, Product.name, Product.category).where(Product.user_id == user_id))}
+
+    new_clients = [{"user_id": user_id, "name": name} for key, name in wanted_clients.items() if key not in existing_clients]
+    renamed_clients = [{"id": id_, "name": wanted_clients[key]} for key, (id_, name) in existing_clients.items()
+                       if key in wanted_clients and wanted_clients[key] != name]
+    removed_clients = [id_ for key, (id_, _) in existing_clients.items() if key not in wanted_clients]
+
+    new_products = [{"user_id": user_id, "name": name, "category": category}
+                    for key, (name, category) in wanted_products.items() if key not in existing_products]
+    changed_products = [{"id": id_, "name": wanted_products[key][0], "category": wanted_products[key][1]}
+                        for key, (id_, name, category) in existing_products.items()
+                        if key in wanted_products and wanted_products[key] != (name, category)]
+    removed_products = [id_ for key, (id_, _, _) in existing_products.items() if key not in wanted_products]
+
+    # Deletes first, so a renamed duplicate can't collide with a row that is going away
+    _delete_ids(Client, removed_clients)
+    _delete_ids(Product, removed_products)
+    if renamed_clients:
+        db.session.execute(update(Client), renamed_clients)
+    if changed_products:
+        db.session.execute(update(Product), changed_products)
+    if new_clients:
+        db.session.execute(insert(Client), new_clients)
+    if new_products:
+        db.session.execute(insert(Product), new_products)
+    if new_clients or renamed_clients or removed_clients or new_products or changed_products or removed_products:
+        bump_master_version(user_id)
+    return {
+        "clients": {"inserted": len(new_clients), "updated": len(renamed_clients), "deleted": len(removed_clients)},
+        "products": {"inserted": len(new_products), "updated": len(changed_products), "deleted": len(removed_products)},
+    }
+
+
+def deduplicate_masters() -> dict:
+    """
+    Deletes rows whose name repeats another of the user's names in any letter case,
+    keeping the oldest, so the unique indexes can be created on databases that predate them.
+    """
+    removed, affected_users = {}, set()
+    for label, model in (("clients", Client), ("products", Product)):
+        name = func.lower(model.name)
+        duplicated = select(model.user_id).group_by(model.user_id, name).having(db.func.count() > 1)
+        affected_users.update(db.session.execute(duplicated).scalars())
+        keep = select(db.func.min(model.id)).group_by(model.user_id, name)
+        removed[label] = db.session.execute(delete(model).where(model.id.not_in(keep))).rowcount
+    for user_id in affected_users:
+        bump_master_version(user_id)
+    return removed
@@ -10,13 +10,47 @@ class Client(db.Model):
     user_id = db.Column(db.String(150), nullable=False, index=True)
     name = db.Column(db.String(255), nullable=False)
 
+    __table_args__ = (
+        db.Index('ux_clients_user_name', 'user_id', 'name', unique=True),
+    )
+
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(150), nullable=False, index=True)
     name = db.Column(db.String(255), nullable=False)
     category = db.Column(db.String(100), nullable=False)
-    
+
+    __table_args__ = (
+        db.Index('ux_products_user_name', 'user_id', 'name', unique=True),
+    )
+
+class MasterDataVersion(db.Model):
+    """A per-user counter that is bumped by every change to the user's clients or products."""
+    __tablename__ = 'master_data_versions'
+    user_id = db.Column(db.String(150), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Entry JSON / DataFrame column label -> BudgetEntry attribute
+ENTRY_COLUMN_MAP = {
+    IDCOL: "_rid",
+    "User ID": "user_id",
+    "User Name": "user_name",
+    "Business Unit": "business_unit",
+    "Section": "section",
+    "Client": "client",
+    "Category": "category",
+    "Product": "product",
+    "Month": "month",
+    "Qty (MT)": "qty_mt",
+    "PMT (USD)": "pmt_usd",
+    "GP %": "gp_percent",
+    "Sales (USD)": "sales_usd",
+    "GP (USD)": "gp_usd",
+    "Profit per Ton": "profit_per_ton",
+    "Sector": "sector",
+    "Booked": "booked",
+}
 
 class BudgetEntry(db.Model):
     __tablename__ = 'budget_entries'
@@ -44,6 +78,22 @@ class BudgetEntry(db.Model):
     sector = db.Column(db.String(255))
     booked = db.Column(db.String(10))
 
+    # Per-user data version of the last change to this row (see change_feed.py)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        db.Index('ix_budget_entries_user_version', 'user_id', 'version'),
+        # Backing indexes for the /api/entries filters
+        db.Index('ix_budget_entries_user_bu', 'user_id', 'business_unit'),
+        db.Index('ix_budget_entries_user_section', 'user_id', 'section'),
+        db.Index('ix_budget_entries_user_client', 'user_id', 'client'),
+        db.Index('ix_budget_entries_user_product', 'user_id', 'product'),
+        db.Index('ix_budget_entries_user_month', 'user_id', 'month'),
+        # Covering index of the cross-user consolidation report (see consolidation.py)
+        db.Index('ix_budget_entries_consolidation', 'business_unit', 'section', 'sector', 'category', 'month',
+                 mssql_include=['user_id', 'qty_mt', 'sales_usd', 'gp_usd', 'booked']),
+    )
+
     def to_dict(self):
         """Converts the database object to a dictionary for JSON serialization."""
         return {
@@ -66,14 +116,119 @@ class BudgetEntry(db.Model):
             "Booked": self.booked
         }
         
+class UserDataVersion(db.Model):
+    """A per-user counter that is bumped once by every transaction that changes budget entries."""
+    __tablename__ = 'user_data_versions'
+    user_id = db.Column(db.String(150), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # The version at which the whole budget was last replaced (load/clear), or below which
+    # tombstones were pruned. Clients that are older than this must reload everything.
+    reset_version = db.Column(db.Integer, nullable=False, default=0)
+
+class EntryTombstone(db.Model):
+    """Remembers deleted entry IDs so the change feed can report them."""
+    __tablename__ = 'entry_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(150), nullable=False)
+    entry_id = db.Column(db.String(36), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_entry_tombstones_user_version', 'user_id', 'version'),
+    )
+
+class EntryRollup(db.Model):
+    """
+    A user's entries summed per business unit, section, client, category, month and
+    booked flag, kept up to date by every change to the entries (see rollups.py).
+    Missing text values are stored as '' and a missing month as 0.
+    """
+    __tablename__ = 'entry_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(150), nullable=False)
+    business_unit = db.Column(db.String(100), nullable=False, default="")
+    section = db.Column(db.String(100), nullable=False, default="")
+    client = db.Column(db.String(255), nullable=False, default="")
+    category = db.Column(db.String(100), nullable=False, default="")
+    month = db.Column(db.Integer, nullable=False, default=0)
+    booked = db.Column(db.String(10), nullable=False, default="")
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+    qty_mt = db.Column(db.Float, nullable=False, default=0.0)
+    sales_usd = db.Column(db.Float, nullable=False, default=0.0)
+    gp_usd = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        db.Index('ux_entry_rollups_group', 'user_id', 'business_unit', 'section', 'client', 'category', 'month', 'booked',
+                 unique=True),
+    )
+
+class RollupState(db.Model):
+    """Users whose entry_rollups rows are complete; the others are built on first use."""
+    __tablename__ = 'entry_rollup_users'
+    user_id = db.Column(db.String(150), primary_key=True)
+    built_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class ExchangeRate(db.Model):
+    """One currency's rate (units per 1 USD) in a published, versioned set of rates (see currency.py)."""
+    __tablename__ = 'exchange_rates'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    published_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    published_by = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ux_exchange_rates_version_currency', 'version', 'currency', unique=True),
+    )
+
+class BudgetSnapshot(db.Model):
+    """A named copy of a user's budget, stored as a Parquet file in SNAPSHOT_DIR (see snapshots.py)."""
+    __tablename__ = 'budget_snapshots'
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.String(150), nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    # "manual", or the operation it was taken before: "load", "clear" or "restore"
+    reason = db.Column(db.String(20), nullable=False, default="manual")
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # The user's data version the snapshot was taken at
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+    size_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_budget_snapshots_user_created', 'user_id', 'created_at'),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "reason": self.reason,
+            "created_at": self.created_at.isoformat(timespec="seconds") + "Z",
+            "data_version": self.data_version,
+            "entry_count": self.entry_count,
+            "size_bytes": self.size_bytes,
+        }
+
+def audit_timestamp():
+    """Audit timestamps are stored in UTC+3 (evaluated per row, not at import time)."""
+    return datetime.utcnow() + timedelta(hours=3)
+
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(150), nullable=False, index=True)
     user_name = db.Column(db.String(255))
     action = db.Column(db.String(100), nullable=False, index=True) # e.g., 'CREATE_ENTRY', 'DELETE_CLIENT'
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow() + timedelta(hours= 3))
+    timestamp = db.Column(db.DateTime, nullable=False, default=audit_timestamp)
     details = db.Column(db.Text, nullable=True) # For extra info, like the ID of the deleted entry
 
+    __table_args__ = (
+        # Time-range queries per user and per action (/api/audit), newest first
+        db.Index('ix_audit_logs_user_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_audit_logs_action_timestamp', 'action', 'timestamp', 'id'),
+    )
+
     def __repr__(self):
         return f"<AuditLog {self.timestamp} - {self.user_name} - {self.action}>"
\ No newline at end of file
@@ -0,0 +1,115 @@
+# budget_app/recalc.py
+"""
+Set-based recalculation of budget entries.
+
+A single UPDATE refreshes each entry's category from the product master and
+recomputes sales, GP and profit per ton with the Broker/Mining rules, either
+for one user or for every user at once. No rows are loaded into Python; the
+rollups are moved by grouping the changed rows before and after the UPDATE.
+"""
+from typing import Optional
+
+import numpy as np
+
+from sqlalchemy import and_, case, func, literal, or_, select, update
+
+from . import db
+from .models import BudgetEntry, Product, UserDataVersion
+from .change_feed import next_version
+from .entry_service import BROKER_MINING_SECTIONS
+from .rollups import RollupDelta, grouped_entries
+
+
+def _differs(column, expr):
+    """True when the stored value is NULL or differs from the recomputed one."""
+    return or_(column.is_(None), column != expr)
+
+
+def recalculated_values():
+    """Recomputed column expressions, mirroring entry_service.build_entry."""
+    qty = func.coalesce(BudgetEntry.qty_mt, 0.0)
+    pmt = func.coalesce(BudgetEntry.pmt_usd, 0.0)
+    gp_percent = func.coalesce(BudgetEntry.gp_percent, 0.0)
+    profit_per_ton = func.coalesce(BudgetEntry.profit_per_ton, 0.0)
+    is_broker = BudgetEntry.section.in_(BROKER_MINING_SECTIONS)
+
+    sales_expr = func.round(qty * pmt, 2)
+    gp_expr = func.round(sales_expr * gp_percent / 100.0, 2)
+    category = select(func.max(Product.category)).where(
+        Product.user_id == BudgetEntry.user_id, Product.name == BudgetEntry.product
+    ).scalar_subquery()
+    return {
+        "category": func.coalesce(category, BudgetEntry.category),
+        "sales_usd": case((is_broker, literal(0.0)), else_=sales_expr),
+        "gp_usd": case((is_broker, func.round(qty * profit_per_ton, 2)), else_=gp_expr),
+        "profit_per_ton": case(
+            (is_broker, profit_per_ton),
+            (qty > 0, func.round(gp_expr / qty, 2)),
+            else_=literal(0.0),
+        ),
+    }
+
+
+def _round2(values: np.ndarray) -> np.ndarray:
+    """
+    ROUND(x, 2) as the database does it: halves away from zero (np.round rounds them to even),
+    including decimal halves such as 4109.105 that the float holds as slightly less.
+    """
+    scaled = np.abs(values) * 100.0
+    return np.sign(values) * np.floor(scaled + 0.5 + scaled * 1e-12) / 100.0
+
+
+def recalculated_arrays(qty: np.ndarray, pmt: np.ndarray, gp_percent: np.ndarray, profit_per_ton: np.ndarray,
+                        is_broker: np.ndarray):
+    """Sales, GP and profit per ton as recalculated_values() computes them, for NumPy arrays."""
+    sales = _round2(qty * pmt)
+    gp = _round2(sales * gp_percent / 100.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        derived_ppt = np.where(qty > 0, _round2(gp / qty), 0.0)
+    return (
+        np.where(is_broker, 0.0, sales),
+        np.where(is_broker, _round2(qty * profit_per_ton), gp),
+        np.where(is_broker, profit_per_ton, derived_ppt),
+    )
+
+
+def _bump_all_versions() -> None:
+    """Gives every user with entries a new data version (creating missing version rows)."""
+    missing = (
+        select(BudgetEntry.user_id, literal(0), literal(0))
+        .where(~select(UserDataVersion.user_id).where(UserDataVersion.user_id == BudgetEntry.user_id).exists())
+        .distinct()
+    )
+    db.session.execute(
+        UserDataVersion.__table__.insert().from_select(["user_id", "version", "reset_version"], missing)
+    )
+    db.session.execute(update(UserDataVersion).values(version=UserDataVersion.version + 1))
+
+
+def recalculate_entries(user_id: Optional[str] = None) -> int:
+    """
+    Recalculates the entries of one user (or of all users when user_id is None)
+    in the current transaction and returns how many rows actually changed.
+    Changed rows are stamped with their user's new data version.
+    """
+    if user_id:
+        next_version(user_id)
+    else:
+        _bump_all_versions()
+    version = select(UserDataVersion.version).where(UserDataVersion.user_id == BudgetEntry.user_id).scalar_subquery()
+
+    values = recalculated_values()
+    changed = or_(
+        and_(values["category"].isnot(None), _differs(BudgetEntry.category, values["category"])),
+        *[_differs(getattr(BudgetEntry, name), values[name]) for name in ("sales_usd", "gp_usd", "profit_per_ton")]
+    )
+    user_filter = [BudgetEntry.user_id == user_id] if user_id else []
+    delta = RollupDelta()
+    delta.add_groups(db.session.execute(grouped_entries(changed, *user_filter)).mappings(), sign=-1)
+    statement = update(BudgetEntry).where(changed, *user_filter).values(**values, version=version)
+    result = db.session.execute(statement.execution_options(synchronize_session=False))
+    if result.rowcount:
+        # Only the rows changed above carry the new version
+        delta.add_groups(db.session.execute(grouped_entries(BudgetEntry.version == version, *user_filter)).mappings())
+        delta.apply()
+    return result.rowcount
@@ -0,0 +1,274 @@
+# budget_app/rollups.py
+"""
+Incrementally maintained rollups of budget entries.
+
+entry_rollups holds, per user, the entry count and the summed Qty, Sales and
+GP of every (business unit, section, client, category, month, booked) group.
+Summaries that only need those dimensions read the rollups, so their cost
+depends on the number of groups instead of the number of entries.
+
+Every change to the entries applies the matching deltas in the same
+transaction: record_changes() for added, edited and deleted entries,
+record_reset() for a cleared budget, the importer per chunk and the
+recalculation for the rows it changed. The user's data version row is locked
+by then, so writers of the same user are serialized.
+
+Rollups are only maintained for users listed in entry_rollup_users. Other
+users (e.g. existing users after an upgrade) get theirs built from their
+entries the first time a summary needs them. check_rollups() compares the
+rollups with the entries and rebuild_rollups() recreates them.
+"""
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import pandas as pd
+from sqlalchemy import and_, bindparam, delete, func, inspect, or_, select, update
+
+from . import db
+from .models import BudgetEntry, EntryRollup, RollupState, UserDataVersion
+
+ROLLUP_DIMENSIONS = ("business_unit", "section", "client", "category", "month", "booked")
+ROLLUP_MEASURES = ("qty_mt", "sales_usd", "gp_usd")
+# Groups looked up with one OR-ed query; larger deltas read all of the user's rollups
+LOOKUP_CHUNK_SIZE = 100
+# SQL Server accepts at most 2100 parameters per statement
+ID_CHUNK_SIZE = 1000
+# Sums that differ by less than this are considered equal by check_rollups()
+CHECK_TOLERANCE = 0.01
+
+GroupKey = Tuple[Any, ...]  # (user_id, *ROLLUP_DIMENSIONS)
+
+
+def _normalize(dimension: str, value: Any) -> Any:
+    if dimension == "month":
+        return int(value) if value is not None else 0
+    return "" if value is None else str(value)
+
+
+def group_key(user_id: str, values: Mapping[str, Any]) -> GroupKey:
+    return (user_id, *(_normalize(d, values.get(d)) for d in ROLLUP_DIMENSIONS))
+
+
+def _entry_values(entry: BudgetEntry, old: bool = False) -> Dict[str, Any]:
+    """An entry's rollup columns, or the values they had when loaded (old=True)."""
+    state = inspect(entry)
+    values = {}
+    for name in ROLLUP_DIMENSIONS + ROLLUP_MEASURES:
+        value = getattr(entry, name)
+        if old:
+            history = state.attrs[name].history
+            if history.deleted:
+                value = history.deleted[0]
+        values[name] = value
+    return values
+
+
+class RollupDelta:
+    """Changes to the rollups, summed per group until apply() writes them."""
+
+    def __init__(self):
+        self.groups: Dict[GroupKey, List[float]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.groups)
+
+    def _add(self, key: GroupKey, count: float, qty: Any, sales: Any, gp: Any) -> None:
+        totals = self.groups.setdefault(key, [0, 0.0, 0.0, 0.0])
+        totals[0] += count
+        totals[1] += qty or 0.0
+        totals[2] += sales or 0.0
+        totals[3] += gp or 0.0
+
+    def add(self, user_id: str, values: Mapping[str, Any], sign: int = 1) -> None:
+        """Adds (sign=1) or removes (sign=-1) one entry, given its column values."""
+        self._add(group_key(user_id, values), sign,
+                  *(sign * (values.get(m) or 0.0) for m in ROLLUP_MEASURES))
+
+    def add_records(self, user_id: str, records: Iterable[Mapping[str, Any]], sign: int = 1) -> None:
+        for values in records:
+            self.add(user_id, values, sign)
+
+    def add_frame(self, user_id: str, df: pd.DataFrame, sign: int = 1) -> None:
+        """Adds a DataFrame of entries that uses the model's column names (e.g. an imported chunk)."""
+        if df.empty:
+            return
+        keys = pd.DataFrame({d: df[d] for d in ROLLUP_DIMENSIONS})
+        keys["month"] = pd.to_numeric(keys["month"], errors="coerce").fillna(0)
+        for d in ROLLUP_DIMENSIONS:
+            if d != "month":
+                keys[d] = keys[d].fillna("").astype(str)
+        measures = df[list(ROLLUP_MEASURES)].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+        grouped = pd.concat([keys, measures], axis=1).groupby(list(ROLLUP_DIMENSIONS), sort=False)
+        sums, counts = grouped.sum(), grouped.size()
+        for values, count, qty, sales, gp in zip(sums.index, counts, sums["qty_mt"], sums["sales_usd"], sums["gp_usd"]):
+            key = (user_id, *(_normalize(d, v) for d, v in zip(ROLLUP_DIMENSIONS, values)))
+            self._add(key, sign * int(count), sign * float(qty), sign * float(sales), sign * float(gp))
+
+    def add_entries(self, entries: Iterable[BudgetEntry], sign: int = 1) -> None:
+        for entry in entries:
+            self.add(entry.user_id, _entry_values(entry), sign)
+
+    def add_updated_entries(self, entries: Iterable[BudgetEntry]) -> None:
+        """Moves edited entries from their loaded values to their current ones (call before a flush)."""
+        for entry in entries:
+            self.add(entry.user_id, _entry_values(entry, old=True), -1)
+            self.add(entry.user_id, _entry_values(entry), 1)
+
+    def add_groups(self, rows: Iterable[Mapping[str, Any]], sign: int = 1) -> None:
+        """Adds rows of a grouped_entries() query."""
+        for row in rows:
+            self._add(group_key(row["user_id"], row), sign * row["entry_count"],
+                      *(sign * (row[m] or 0.0) for m in ROLLUP_MEASURES))
+
+    def apply(self) -> None:
+        """Writes the deltas of users whose rollups are maintained; empty groups are removed."""
+        changes = {key: totals for key, totals in self.groups.items()
+                   if totals[0] or any(abs(v) > 1e-9 for v in totals[1:])}
+        self.groups = {}
+        users = sorted({key[0] for key in changes})
+        for start in range(0, len(users), ID_CHUNK_SIZE):
+            chunk = users[start:start + ID_CHUNK_SIZE]
+            maintained = set(db.session.execute(
+                select(RollupState.user_id).where(RollupState.user_id.in_(chunk))
+            ).scalars())
+            if maintained:
+                _write_deltas({key: totals for key, totals in changes.items() if key[0] in maintained}, maintained)
+
+
+def _write_deltas(changes: Dict[GroupKey, List[float]], users: Sequence[str]) -> None:
+    existing = _existing_group_ids(list(changes), users)
+    table = EntryRollup.__table__
+    updates, inserts = [], []
+    for key, (count, qty, sales, gp) in changes.items():
+        if key in existing:
+            updates.append({"rollup_id": existing[key], "d_count": count, "d_qty": qty, "d_sales": sales, "d_gp": gp})
+        else:
+            inserts.append({"user_id": key[0], **dict(zip(ROLLUP_DIMENSIONS, key[1:])),
+                            "entry_count": count, "qty_mt": qty, "sales_usd": sales, "gp_usd": gp})
+    if updates:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam("rollup_id")).values(
+                entry_count=table.c.entry_count + bindparam("d_count"),
+                qty_mt=table.c.qty_mt + bindparam("d_qty"),
+                sales_usd=table.c.sales_usd + bindparam("d_sales"),
+                gp_usd=table.c.gp_usd + bindparam("d_gp"),
+            ),
+            updates,
+        )
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    db.session.execute(delete(EntryRollup).where(EntryRollup.user_id.in_(users), EntryRollup.entry_count <= 0))
+
+
+def _existing_group_ids(keys: List[GroupKey], users: Iterable[str]) -> Dict[GroupKey, int]:
+    """Rollup row IDs of the groups that already exist, by group key."""
+    if len(keys) > LOOKUP_CHUNK_SIZE:
+        where = EntryRollup.user_id.in_(users)
+    else:
+        where = or_(*[
+            and_(EntryRollup.user_id == key[0], *(getattr(EntryRollup, d) == v for d, v in zip(ROLLUP_DIMENSIONS, key[1:])))
+            for key in keys
+        ])
+    columns = (EntryRollup.id, EntryRollup.user_id, *(getattr(EntryRollup, d) for d in ROLLUP_DIMENSIONS))
+    return {tuple(row)[1:]: row.id for row in db.session.execute(select(*columns).where(where))}
+
+
+def grouped_entries(*conditions):
+    """A GROUP BY over budget_entries producing rollup rows (user_id, dimensions, count and sums)."""
+    dimensions = [
+        func.coalesce(getattr(BudgetEntry, d), 0 if d == "month" else "").label(d) for d in ROLLUP_DIMENSIONS
+    ]
+    measures = [func.coalesce(func.sum(getattr(BudgetEntry, m)), 0.0).label(m) for m in ROLLUP_MEASURES]
+    return (
+        select(BudgetEntry.user_id, *dimensions, func.count(BudgetEntry._rid).label("entry_count"), *measures)
+        .where(*conditions)
+        .group_by(BudgetEntry.user_id, *[dimension.element for dimension in dimensions])
+    )
+
+
+def entry_rollup_rows(user_id: str, entry_ids: Iterable[str]) -> List[Any]:
+    """The _rid and rollup columns of the user's entries among entry_ids (e.g. before deleting them)."""
+    entry_ids = list(entry_ids)
+    columns = [BudgetEntry._rid, *(getattr(BudgetEntry, c) for c in ROLLUP_DIMENSIONS + ROLLUP_MEASURES)]
+    rows = []
+    for start in range(0, len(entry_ids), ID_CHUNK_SIZE):
+        rows += db.session.execute(
+            select(*columns).where(BudgetEntry.user_id == user_id, BudgetEntry._rid.in_(entry_ids[start:start + ID_CHUNK_SIZE]))
+        ).mappings().all()
+    return rows
+
+
+def _lock_user(user_id: str) -> None:
+    """Takes the user's data version row lock (see change_feed.next_version) without changing it."""
+    db.session.execute(
+        update(UserDataVersion).where(UserDataVersion.user_id == user_id).values(version=UserDataVersion.version)
+    )
+
+
+def reset_rollups(user_id: str) -> None:
+    """The user's budget is empty now (load or clear): no rollups, but maintained from here on."""
+    db.session.execute(delete(EntryRollup).where(EntryRollup.user_id == user_id))
+    if db.session.get(RollupState, user_id) is None:
+        db.session.add(RollupState(user_id=user_id))
+
+
+def rebuild_rollups(user_id: Optional[str] = None) -> int:
+    """Recreates the rollups of one user (or of all users) from their entries. Returns the number of groups."""
+    user_filter = [BudgetEntry.user_id == user_id] if user_id else []
+    if user_id:
+        _lock_user(user_id)
+        db.session.execute(delete(EntryRollup).where(EntryRollup.user_id == user_id))
+        db.session.execute(delete(RollupState).where(RollupState.user_id == user_id))
+    else:
+        db.session.execute(update(UserDataVersion).values(version=UserDataVersion.version))
+        db.session.execute(delete(EntryRollup))
+        db.session.execute(delete(RollupState))
+    columns = ["user_id", *ROLLUP_DIMENSIONS, "entry_count", *ROLLUP_MEASURES]
+    result = db.session.execute(EntryRollup.__table__.insert().from_select(columns, grouped_entries(*user_filter)))
+    if user_id:
+        db.session.add(RollupState(user_id=user_id))
+    else:
+        users = select(BudgetEntry.user_id).distinct()
+        db.session.execute(RollupState.__table__.insert().from_select(["user_id"], users))
+    db.session.flush()
+    return result.rowcount
+
+
+def ensure_rollups(user_id: str) -> None:
+    """Builds the user's rollups from the entries if they aren't maintained yet. The caller commits."""
+    if db.session.get(RollupState, user_id) is not None:
+        return
+    _lock_user(user_id)
+    # Another request may have built them while we waited for the lock
+    if db.session.execute(select(RollupState.user_id).where(RollupState.user_id == user_id)).first() is None:
+        rebuild_rollups(user_id)
+
+
+def check_rollups(user_id: Optional[str] = None, tolerance: float = CHECK_TOLERANCE) -> List[Dict[str, Any]]:
+    """
+    Compares the maintained rollups with sums computed from the entries.
+    Returns one record per group that differs: {"user_id", "group", "expected", "actual"}.
+    """
+    users = select(RollupState.user_id)
+    if user_id:
+        users = users.where(RollupState.user_id == user_id)
+    expected = {
+        group_key(row["user_id"], row): (row["entry_count"], *(row[m] for m in ROLLUP_MEASURES))
+        for row in db.session.execute(grouped_entries(BudgetEntry.user_id.in_(users))).mappings()
+    }
+    columns = [EntryRollup.user_id, *(getattr(EntryRollup, d) for d in ROLLUP_DIMENSIONS),
+               EntryRollup.entry_count, *(getattr(EntryRollup, m) for m in ROLLUP_MEASURES)]
+    actual = {
+        group_key(row["user_id"], row): (row["entry_count"], *(row[m] for m in ROLLUP_MEASURES))
+        for row in db.session.execute(select(*columns).where(EntryRollup.user_id.in_(users))).mappings()
+    }
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=repr):
+        want, have = expected.get(key, (0, 0.0, 0.0, 0.0)), actual.get(key, (0, 0.0, 0.0, 0.0))
+        if want[0] != have[0] or any(abs((w or 0.0) - (h or 0.0)) > tolerance for w, h in zip(want[1:], have[1:])):
+            mismatches.append({
+                "user_id": key[0],
+                "group": dict(zip(ROLLUP_DIMENSIONS, key[1:])),
+                "expected": dict(zip(("entry_count",) + ROLLUP_MEASURES, want)),
+                "actual": dict(zip(("entry_count",) + ROLLUP_MEASURES, have)),
+            })
+    return mismatches
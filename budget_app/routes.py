@@ -1,27 +1,43 @@
 # budget_app/routes.py
 
-import io
 import json
+import os
 from datetime import datetime
-import uuid
-from .audit_service import log_action
+from .audit_service import log_action, log_bulk_action, unpack_ids
 
-import pandas as pd
 from flask import (
     Blueprint, request, jsonify, send_file, render_template,
-    session, redirect, url_for
+    session, redirect, url_for, current_app, Response, stream_with_context
 )
 
-from config import Config
-
 from . import db
-from .models import BudgetEntry, Client, Product
-from .data_utils import (
-    month_name_to_num,
-    coerce_wide_schema_types, recalc_wide_schema, convert_wide_to_narrow,
-    coerce_narrow_schema_types, recalc_narrow_schema, ensure_row_id,
-    export_df_for_save, IDCOL
+from .models import BudgetEntry
+from .change_feed import changes_since, current_version, record_changes, record_reset
+from .exporter import (
+    EXPORT_FORMATS, build_export_file, has_entries, iter_csv, iter_row_batches, user_entries_statement
+)
+from .entry_queries import QueryError, entries_page, filter_options, query_conversion
+from .summary_cache import cached_summary
+from .currency import CurrencyError, convert_summary, currency_header, current_rates, publish_rates, resolve_currency
+from .entry_service import EntryValidationError, build_entry, build_entries_from_batch
+from .entry_edits import apply_edits, parse_edits
+from .recalc import recalculate_entries
+from .scenario import ScenarioError, apply_scenario, evaluate_scenario, parse_rules
+from .rollups import ID_CHUNK_SIZE, entry_rollup_rows
+from .master_data import DEFAULT_CATEGORY, add_client, add_product
+from .master_cache import cached_masters
+from .audit_queries import query_audit_log
+from .consolidation import (
+    CONSOLIDATION_FORMATS, consolidation_json, iter_report_batches, parse_dimensions, report_header
+)
+from .entry_wire import encode_rows, entries_statement, wants_columnar
+from .http_cache import conditional
+from .jobs import JobError, job_runner, public_job
+from .snapshots import (
+    SnapshotError, SnapshotNotFound, create_snapshot, delete_snapshot, diff_snapshots, get_snapshot,
+    list_snapshots, restore_snapshot, snapshot_before
 )
+from .data_utils import SAVE_EXCEL_COLS
 
 main = Blueprint('main', __name__)
 
@@ -31,6 +47,9 @@ def get_user_id():
 def get_user_name():
     return session.get('user', {}).get('name')
 
+def is_admin(user_id):
+    return user_id in current_app.config.get("ADMIN_USER_IDS", ())
+
 @main.route("/")
 def index():
     if 'user' not in session:
@@ -38,8 +57,8 @@ def index():
     return render_template(
         "index.html", 
         user=session.get('user'),
-        # Pass the exchange rates to the template
-        exchange_rates=Config.EXCHANGE_RATES
+        # Pass the current exchange rates to the template
+        exchange_rates=current_rates().rates
     )
 
 @main.route("/logged_out")
@@ -51,48 +70,205 @@ def logged_out():
     """
 
 @main.route("/api/state")
+@conditional(include_masters=True)
 def api_get_state():
     user_id = get_user_id()
     if not user_id:
         return jsonify({"error": "User not authenticated"}), 401
     try:
-        user_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        entries_list = [entry.to_dict() for entry in user_entries]
-        user_clients = Client.query.filter_by(user_id=user_id).all()
-        client_list = sorted([c.name for c in user_clients])
-        user_products = Product.query.filter_by(user_id=user_id).all()
-        product_list = [{"Product": p.name, "Category": p.category} for p in user_products]
-        return jsonify({ "entries": entries_list, "masters": { "clients": client_list, "products": product_list } })
+        # Read the version first: anything written after it is picked up by the next /api/changes call
+        version = current_version(user_id)
+        rows = db.session.execute(entries_statement(BudgetEntry.user_id == user_id)).all()
+        entries = encode_rows(rows, columnar=wants_columnar(request.args))
+        # The masters come pre-serialized from the cache
+        body = '{"entries": %s, "version": %d, "masters": %s}' % (
+            current_app.json.dumps(entries), version, cached_masters(user_id).masters_json)
+        return current_app.response_class(body, mimetype="application/json")
     except Exception as e:
         return jsonify({"error": f"Failed to load state: {str(e)}"}), 500
 
+@main.route("/api/changes")
+@conditional()
+def api_get_changes():
+    """Returns the entries changed and deleted since the given version (or a full reload)."""
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        since = request.args.get("since", 0, type=int)
+        return jsonify(changes_since(user_id, since, columnar=wants_columnar(request.args)))
+    except Exception as e:
+        return jsonify({"error": f"Failed to load changes: {str(e)}"}), 500
+
+@main.route("/api/entries")
+@conditional(include_rates=True)
+def api_query_entries():
+    """One filtered, sorted page of the user's entries plus the filtered totals."""
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        return jsonify(entries_page(user_id, request.args))
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to query entries: {str(e)}"}), 500
+
+@main.route("/api/summary")
+@conditional(include_rates=True)
+def api_summary():
+    """
+    Totals and GROUP BY aggregates of the user's entries (see entry_queries.entries_summary),
+    in USD or ?currency=. The USD sums are cached per data version and converted per request.
+    """
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        conversion = query_conversion(request.args)
+        summary = cached_summary(user_id, request.args)
+        db.session.commit()  # Keeps rollups built on first use
+        return jsonify(convert_summary(summary, conversion))
+    except QueryError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Failed to build summary: {str(e)}"}), 500
+
+@main.route("/api/entry_filters")
+@conditional()
+def api_entry_filters():
+    """Distinct Business Units, Sections, Clients, Products and Months for the filter dropdowns."""
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        return jsonify(filter_options(user_id))
+    except Exception as e:
+        return jsonify({"error": f"Failed to load filters: {str(e)}"}), 500
+
+@main.route("/api/audit")
+def api_audit_log():
+    """
+    The audit log, newest first, filtered by ?action=, ?from=, ?to= and paged with ?cursor=.
+    Admins (ADMIN_USER_IDS) may pass ?user= or omit it for all users; everyone else sees
+    their own events. ?archived=1 also searches the archive files, ?expand_ids=1 decodes
+    the IDs stored by bulk events.
+    """
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        requested_user = request.args.get("user") or None
+        if is_admin(user_id):
+            target_user = requested_user
+        elif requested_user in (None, user_id):
+            target_user = user_id
+        else:
+            return jsonify({"error": "Only administrators can read other users' audit logs."}), 403
+        archived = request.args.get("archived", "").lower() in ("1", "true", "yes")
+        result = query_audit_log(request.args, target_user, current_app.config["AUDIT_ARCHIVE_DIR"] if archived else None)
+        if request.args.get("expand_ids", "").lower() in ("1", "true", "yes"):
+            for row in result["rows"]:
+                row["ids"] = unpack_ids(row["details"])
+        return jsonify(result)
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to read audit log: {str(e)}"}), 500
+
+@main.route("/api/exchange_rates")
+def api_exchange_rates():
+    """The current exchange rates (units per 1 USD) and their version."""
+    if not get_user_id():
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        rate_set = current_rates()
+        return jsonify({"version": rate_set.version, "rates": rate_set.rates})
+    except Exception as e:
+        return jsonify({"error": f"Failed to load exchange rates: {str(e)}"}), 500
+
+@main.route("/api/admin/exchange_rates", methods=["POST"])
+def api_publish_exchange_rates():
+    """Publishes a new version of the exchange rates: {"rates": {"JOD": 0.71, ...}}. Admins only."""
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    if not is_admin(user_id):
+        return jsonify({"error": "Only administrators can change the exchange rates."}), 403
+    try:
+        rate_set = publish_rates((request.get_json(silent=True) or {}).get("rates"), get_user_name() or user_id)
+        log_action("PUBLISH_EXCHANGE_RATES", details=f"Published exchange rates version {rate_set.version}")
+        db.session.commit()
+        return jsonify({"status": "success", "version": rate_set.version, "rates": rate_set.rates})
+    except CurrencyError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Failed to publish exchange rates: {str(e)}"}), 500
+
+@main.route("/api/admin/consolidation")
+def api_consolidation():
+    """
+    The company budget consolidated across all users, grouped by ?group_by= (default:
+    business_unit,section,sector,category,month) and filtered by those columns or ?booked=.
+    ?format=csv or xlsx downloads it, streamed like the budget export. Admins only.
+    """
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "User not authenticated"}), 401
+    if not is_admin(user_id):
+        return jsonify({"error": "Only administrators can see the consolidated budget."}), 403
+    try:
+        fmt = request.args.get("format", "json").lower()
+        if fmt not in CONSOLIDATION_FORMATS:
+            return jsonify({"error": f"Unsupported report format '{fmt}'."}), 400
+        dims = parse_dimensions(request.args.get("group_by"))
+        batches = iter_report_batches(dims, request.args)
+        if fmt == "json":
+            return jsonify(consolidation_json(dims, batches))
+        mimetype, extension = EXPORT_FORMATS[fmt]
+        download_name = f"Budget_Consolidation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+        if fmt == "csv":
+            return Response(
+                stream_with_context(iter_csv(batches, report_header(dims))), mimetype=mimetype,
+                headers={"Content-Disposition": f'attachment; filename="{download_name}"'}
+            )
+        export_file = build_export_file(fmt, batches, report_header(dims), sheet="Consolidation")
+        return send_file(export_file, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to build consolidation report: {str(e)}"}), 500
+
 @main.route("/api/add_master", methods=["POST"])
 def api_add_master():
+    """Adds a client and/or product. Only the added names are returned; the front end merges them."""
     user_id = get_user_id()
     if not user_id: return jsonify({"error": "User not authenticated"}), 401
     try:
         data = request.get_json(force=True)
-        message = ""
+        message, added = "", {}
         if "new_client" in data:
             client_name = data["new_client"].strip()
             if client_name:
-                if not Client.query.filter_by(user_id=user_id, name=client_name).first():
-                    db.session.add(Client(user_id=user_id, name=client_name))
+                if add_client(user_id, client_name):
+                    added["client"] = client_name
                     message = f"Client '{client_name}' added."
                 else: message = f"Client '{client_name}' already exists."
         if "new_product" in data:
             product_data = data["new_product"]
             product_name = product_data.get("name", "").strip()
-            product_category = product_data.get("category", "Uncategorized").strip()
+            product_category = product_data.get("category", "").strip() or DEFAULT_CATEGORY
             if product_name:
-                if not Product.query.filter_by(user_id=user_id, name=product_name).first():
-                    db.session.add(Product(user_id=user_id, name=product_name, category=product_category))
+                if add_product(user_id, product_name, product_category):
+                    added["product"] = {"Product": product_name, "Category": product_category}
                     message = f"Product '{product_name}' added."
                 else: message = f"Product '{product_name}' already exists."
         db.session.commit()
-        all_clients = sorted([c.name for c in Client.query.filter_by(user_id=user_id).all()])
-        all_products = [{"Product": p.name, "Category": p.category} for p in Product.query.filter_by(user_id=user_id).all()]
-        return jsonify({"status": "success", "message": message, "masters": {"clients": all_clients, "products": all_products}})
+        return jsonify({"status": "success", "message": message, "added": added})
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "message": f"Failed to add master data: {str(e)}"}), 500
@@ -105,65 +281,43 @@ def api_add_entry():
         
     try:
         data = request.get_json(force=True)
-        
-        # --- RESTORED AND CORRECTED VALIDATION LOGIC ---
         try:
-            qty = float(data.get("qty"))
-        except (ValueError, TypeError):
-             return jsonify({"status": "error", "message": "Quantity (MT) must be a valid number and cannot be empty."}), 400
-
-        # Block zero-quantity entries immediately
-        if qty == 0:
-            return jsonify({"status": "error", "message": "Quantity (MT) cannot be 0."}), 400
-
-        section = str(data.get("section", ""))
-        is_broker_or_mining = section in ["Broker", "Mining"]
-        sales, gp, pmt, gp_percent, profit_per_ton = 0.0, 0.0, 0.0, 0.0, 0.0
-
-        if is_broker_or_mining:
-            try:
-                profit_per_ton = float(data.get("profit_per_ton"))
-            except (ValueError, TypeError):
-                return jsonify({"status": "error", "message": "Profit per Ton must be a valid number and cannot be empty."}), 400
-            
-            # This validation now only runs if qty > 0, which is always true here.
-            if profit_per_ton == 0:
-                return jsonify({"status": "error", "message": "Profit per Ton cannot be 0 for Broker/Mining."}), 400
-            gp = round(qty * profit_per_ton, 2)
-        else:
-            try:
-                pmt = float(data.get("pmt"))
-                gp_percent = float(data.get("gm_percent"))
-            except (ValueError, TypeError):
-                return jsonify({"status": "error", "message": "PMT and GP % must be valid numbers and cannot be empty."}), 400
-
-            # This validation now only runs if qty > 0, which is always true here.
-            if pmt == 0:
-                return jsonify({"status": "error", "message": "PMT (USD) cannot be 0 for this section."}), 400
-            if gp_percent == 0:
-                 return jsonify({"status": "error", "message": "GP % cannot be 0 for this section."}), 400
-            
-            sales = round(qty * pmt, 2)
-            gp = round(sales * (gp_percent / 100.0), 2)
-            if qty > 0: profit_per_ton = round(gp / qty, 2)
-        # --- END OF RESTORED LOGIC ---
-
-        new_entry = BudgetEntry(
-            _rid=str(uuid.uuid4()), user_id=user_id, user_name=user_name, profit_per_ton=profit_per_ton,
-            business_unit=str(data.get("business_unit", "")), section=section, client=str(data.get("client", "")),
-            category=str(data.get("category", "")), product=str(data.get("product", "")), month=month_name_to_num(data.get("month_name", "Jan")),
-            pmt_usd=pmt, gp_percent=gp_percent, qty_mt=qty, sales_usd=sales, gp_usd=gp,
-            sector=str(data.get("sector", "")), booked=str(data.get("booked", "No")),
-        )
+            new_entry = build_entry(data, user_id, user_name)
+        except EntryValidationError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
         db.session.add(new_entry)
         log_action("CREATE_BUDGET_ENTRY", details=f"Created entry with ID: {new_entry._rid}")
+        changes = record_changes(user_id, inserted=[new_entry])
         db.session.commit()
-        all_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        return jsonify({"status": "success", "entries": [e.to_dict() for e in all_entries], "message": "Entry added successfully"})
+        return jsonify({"status": "success", **changes, "message": "Entry added successfully"})
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "message": f"Failed to add entry: {str(e)}"}), 500
 
+@main.route("/api/add_batch", methods=["POST"])
+def api_add_entries():
+    """
+    Adds whole budget lines (or many narrow entries) in one transaction.
+    Every entry is validated first; nothing is saved if any of them fails.
+    Only the created rows are returned.
+    """
+    user_id, user_name = get_user_id(), get_user_name()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        payload = request.get_json(force=True) or {}
+        try:
+            new_entries = build_entries_from_batch(payload, user_id, user_name)
+        except EntryValidationError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        db.session.add_all(new_entries)
+        log_bulk_action("CREATE_BUDGET_ENTRIES", f"Created {len(new_entries)} entries", [e._rid for e in new_entries])
+        changes = record_changes(user_id, inserted=new_entries)
+        db.session.commit()
+        return jsonify({"status": "success", **changes, "message": f"Added {len(new_entries)} entries successfully"})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": f"Failed to add entries: {str(e)}"}), 500
+
 @main.route("/api/update_entry", methods=["POST"])
 def api_update_entry():
     user_id = get_user_id()
@@ -185,9 +339,9 @@ def api_update_entry():
             entry.sales_usd = round(entry.qty_mt * entry.pmt_usd, 2)
             entry.gp_usd = round(entry.sales_usd * (entry.gp_percent / 100.0), 2)
             entry.profit_per_ton = round(entry.gp_usd / entry.qty_mt, 2) if entry.qty_mt > 0 else 0
+        changes = record_changes(user_id, updated=[entry])
         db.session.commit()
-        all_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        return jsonify({"status": "success", "entries": [e.to_dict() for e in all_entries]})
+        return jsonify({"status": "success", **changes})
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "message": f"Failed to update entry: {str(e)}"}), 500
@@ -199,135 +353,286 @@ def api_commit_changes():
     try:
         payload = request.get_json(force=True)
         delete_ids = set(payload.get("deleteIds", []))
+        edits = parse_edits(payload.get("editedRows") or [])
+        deleted_rows = []
         if delete_ids:
-            BudgetEntry.query.filter(BudgetEntry.user_id == user_id, BudgetEntry._rid.in_(delete_ids)).delete(synchronize_session=False)
-            for entry_id in delete_ids:
-                log_action("DELETE_ENTRY", details=f"Deleted entry with ID: {entry_id}")
+            # Only report (and tombstone) IDs that really belonged to this user
+            deleted_rows = entry_rollup_rows(user_id, delete_ids)
+            deleted_ids = [row["_rid"] for row in deleted_rows]
+            for start in range(0, len(deleted_ids), ID_CHUNK_SIZE):
+                BudgetEntry.query.filter(
+                    BudgetEntry.user_id == user_id, BudgetEntry._rid.in_(deleted_ids[start:start + ID_CHUNK_SIZE])
+                ).delete(synchronize_session=False)
+            log_bulk_action("DELETE_ENTRIES", f"Deleted {len(deleted_ids)} entries", deleted_ids)
+        # All edits are recomputed together; only the rows that really changed are written and returned
+        updated, not_found = apply_edits(user_id, {rid: v for rid, v in edits.items() if rid not in delete_ids})
+        if updated:
+            log_bulk_action("UPDATE_ENTRIES", f"Edited {len(updated)} entries", [e._rid for e in updated])
+        changes = record_changes(user_id, updated=updated, deleted_rows=deleted_rows)
         db.session.commit()
-        all_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        return jsonify({"status": "success", "entries": [e.to_dict() for e in all_entries], "message": "Changes committed successfully"})
+        return jsonify({"status": "success", **changes, "not_found": not_found, "message": "Changes committed successfully"})
+    except EntryValidationError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "error": str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "error": f"Failed to commit changes: {str(e)}"}), 400
 
 @main.route("/api/recalc", methods=["POST"])
 def api_recalculate():
+    """Refreshes categories and recomputes sales, GP and profit per ton in the database."""
     user_id = get_user_id()
     if not user_id: return jsonify({"error": "User not authenticated"}), 401
     try:
-        user_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        if not user_entries: return jsonify({"status": "success", "entries": [], "message": "No data to recalculate."})
-        user_products = Product.query.filter_by(user_id=user_id).all()
-        products_df = pd.DataFrame([{"Product": p.name, "Category": p.category} for p in user_products])
-        entries_df = pd.DataFrame([entry.to_dict() for entry in user_entries])
-        recalculated_df = recalc_narrow_schema(entries_df, products_df)
-        entry_map = {entry._rid: entry for entry in user_entries}
-        for _, row in recalculated_df.iterrows():
-            entry_to_update = entry_map.get(row[IDCOL])
-            if entry_to_update:
-                entry_to_update.sales_usd, entry_to_update.gp_usd, entry_to_update.category = row["Sales (usd)"], row["GP (usd)"], row["Category"]
+        rows_changed = recalculate_entries(user_id)
+        version = current_version(user_id)
+        log_action("RECALCULATE", details=f"Recalculated {rows_changed} entries")
         db.session.commit()
-        final_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        return jsonify({"status": "success", "entries": [e.to_dict() for e in final_entries], "message": "Data recalculated successfully"})
+        # The changed rows carry the new version, so clients pick them up through /api/changes
+        return jsonify({"status": "success", "version": version, "rows_changed": rows_changed, "message": f"Recalculated {rows_changed} entries."})
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "message": f"Failed to recalculate: {str(e)}"}), 500
 
+@main.route("/api/scenario", methods=["POST"])
+def api_evaluate_scenario():
+    """
+    What-if evaluation of adjustment rules ({"rules": [...], "group_by": "section,month"}, see
+    scenario.py): baseline, scenario and delta totals. Nothing is saved.
+    """
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        payload = request.get_json(silent=True) or {}
+        group_by = payload.get("group_by") or []
+        if isinstance(group_by, str):
+            group_by = [d.strip() for d in group_by.split(",") if d.strip()]
+        return jsonify(evaluate_scenario(user_id, parse_rules(payload.get("rules")), group_by))
+    except ScenarioError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Failed to evaluate scenario: {str(e)}"}), 500
+
+@main.route("/api/scenario/apply", methods=["POST"])
+def api_apply_scenario():
+    """Writes a scenario's rules to the user's entries with one set-based UPDATE."""
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        rules = parse_rules((request.get_json(silent=True) or {}).get("rules"))
+        result = apply_scenario(user_id, rules)
+        log_action("APPLY_SCENARIO", details=f"Applied {len(rules)} scenario rules to {result['rows_changed']} entries")
+        db.session.commit()
+        # The changed rows carry the new version, so clients pick them up through /api/changes
+        return jsonify({"status": "success", **result, "message": f"Scenario applied to {result['rows_changed']} entries."})
+    except ScenarioError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": f"Failed to apply scenario: {str(e)}"}), 500
+
 @main.route("/api/clear_data", methods=["POST"])
 def api_clear_data():
     user_id = get_user_id()
     if not user_id: return jsonify({"error": "User not authenticated"}), 401
     try:
+        backup = snapshot_before(user_id, "clear")
         BudgetEntry.query.filter_by(user_id=user_id).delete()
+        changes = record_reset(user_id)
         db.session.commit()
-        return jsonify({"status": "success", "message": "All your data has been cleared successfully.", "entries": []})
+        return jsonify({"status": "success", **changes, "snapshot": backup.id if backup else None,
+                        "message": "All your data has been cleared successfully."})
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@main.route("/api/snapshots")
+def api_list_snapshots():
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    return jsonify({"snapshots": [s.to_dict() for s in list_snapshots(user_id)]})
+
+@main.route("/api/snapshots", methods=["POST"])
+def api_create_snapshot():
+    """Saves the current budget as a named snapshot ({"name": ...}, see snapshots.py)."""
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        payload = request.get_json(silent=True) or {}
+        snapshot = create_snapshot(user_id, payload.get("name"))
+        log_action("CREATE_SNAPSHOT", details=f"Snapshot '{snapshot.name}' ({snapshot.entry_count} entries) id={snapshot.id}")
+        db.session.commit()
+        return jsonify({"status": "success", "snapshot": snapshot.to_dict()}), 201
+    except SnapshotError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": f"Failed to create snapshot: {str(e)}"}), 500
+
+@main.route("/api/snapshots/<snapshot_id>/restore", methods=["POST"])
+def api_restore_snapshot(snapshot_id):
+    """Replaces the budget with a snapshot; the current budget is snapshotted first."""
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        snapshot = get_snapshot(user_id, snapshot_id)
+        changes = restore_snapshot(snapshot, get_user_name())
+        log_action("RESTORE_SNAPSHOT", details=f"Restored snapshot '{snapshot.name}' ({changes['rows_written']} entries) id={snapshot_id}")
+        db.session.commit()
+        return jsonify({"status": "success", **changes, "message": f"Budget restored from '{snapshot.name}'."})
+    except SnapshotNotFound as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except SnapshotError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": f"Failed to restore snapshot: {str(e)}"}), 500
+
+@main.route("/api/snapshots/<snapshot_id>", methods=["DELETE"])
+def api_delete_snapshot(snapshot_id):
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        snapshot = get_snapshot(user_id, snapshot_id)
+        delete_snapshot(snapshot)
+        log_action("DELETE_SNAPSHOT", details=f"Deleted snapshot '{snapshot.name}' id={snapshot_id}")
+        db.session.commit()
+        return jsonify({"status": "success"})
+    except SnapshotNotFound as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": f"Failed to delete snapshot: {str(e)}"}), 500
+
+@main.route("/api/snapshots/diff")
+def api_diff_snapshots():
+    """
+    Column-wise diff from snapshot ?from= to snapshot ?to= (or to the live budget when ?to= is
+    missing or "live"); ?limit= caps the example rows and IDs returned.
+    """
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        from_id = request.args.get("from")
+        if not from_id: return jsonify({"status": "error", "message": "Missing ?from= snapshot."}), 400
+        limit = min(max(request.args.get("limit", 100, type=int), 0), 1000)
+        return jsonify(diff_snapshots(user_id, from_id, request.args.get("to"), limit))
+    except SnapshotNotFound as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except SnapshotError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Failed to compare snapshots: {str(e)}"}), 500
+
 @main.route("/api/load_budget", methods=["POST"])
 def api_load_budget():
+    """
+    Queues a job that replaces the user's budget with a workbook (see jobs.py and importer.py).
+    Returns the job at once; poll /api/jobs/<id> for progress and the result.
+    """
     user_id, user_name = get_user_id(), get_user_name()
     if not user_id: return jsonify({"error": "User not authenticated"}), 401
     try:
         file, sheet = request.files.get("file"), request.form.get("sheet", "Budget")
         if not file: return jsonify({"error": "No file provided"}), 400
-        df = pd.read_excel(file, sheet_name=sheet, engine="openpyxl")
-        user_products_from_db = Product.query.filter_by(user_id=user_id).all()
-        products_df = pd.DataFrame([{"Product": p.name, "Category": p.category} for p in user_products_from_db])
-        is_wide_schema = any(col in df.columns for col in ["Qty_Jan (MT)", "PMT_Q1 (usd)"])
-        if is_wide_schema:
-            df_processed = coerce_wide_schema_types(df.copy())
-            df_processed = recalc_wide_schema(df_processed, products_df)
-            df_final_narrow = convert_wide_to_narrow(df_processed)
-        else:
-            df_final_narrow = coerce_narrow_schema_types(df.copy())
-            df_final_narrow = recalc_narrow_schema(df_final_narrow, products_df)
-        df_final_narrow = ensure_row_id(df_final_narrow)
-        BudgetEntry.query.filter_by(user_id=user_id).delete()
-        new_entries = [BudgetEntry(
-            _rid=row.get(IDCOL), user_id=user_id, user_name=user_name,
-            business_unit=row.get("Business Unit"), section=row.get("Section"), client=row.get("Client"),
-            category=row.get("Category"), product=row.get("Product"), month=row.get("Month"),
-            qty_mt=row.get("Qty (MT)"), pmt_usd=row.get("PMT (usd)"), gp_percent=row.get("GP %"),
-            sales_usd=row.get("Sales (usd)"), gp_usd=row.get("GP (usd)"), sector=row.get("Sector"),
-            booked=row.get("Booked")
-        ) for _, row in df_final_narrow.iterrows()]
-        db.session.bulk_save_objects(new_entries)
-        db.session.commit()
-        all_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        return jsonify({"status": "success", "entries": [e.to_dict() for e in all_entries], "message": f"Budget loaded from '{sheet}'."})
+        job = job_runner().enqueue("load_budget", user_id, user_name, {"sheet": sheet}, upload=file)
+        return jsonify({"status": "queued", "job": public_job(job)}), 202
     except Exception as e:
-        db.session.rollback()
         return jsonify({"error": f"Failed to load budget: {str(e)}"}), 400
 
 @main.route("/api/download_current")
 def api_download_current():
+    """Exports the user's budget as xlsx (default), csv or parquet, in USD or ?currency=, streamed from the database."""
     user_id = get_user_id()
     if not user_id: return jsonify({"error": "User not authenticated"}), 401
     try:
-        user_entries = BudgetEntry.query.filter_by(user_id=user_id).all()
-        if not user_entries: return "No data to download.", 404
-        entries_df = pd.DataFrame([entry.to_dict() for entry in user_entries])
-        buffer = io.BytesIO()
-        export_df = export_df_for_save(entries_df)
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            export_df.to_excel(writer, index=False, sheet_name="Budget")
-        buffer.seek(0)
-        return send_file(buffer, as_attachment=True, download_name=f"Budget_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx", mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        fmt = request.args.get("format", "xlsx").lower()
+        if fmt not in EXPORT_FORMATS: return jsonify({"error": f"Unsupported export format '{fmt}'."}), 400
+        try:
+            conversion = resolve_currency(request.args.get("currency"))
+        except CurrencyError as e:
+            return jsonify({"error": str(e)}), 400
+        if not has_entries(user_id): return "No data to download.", 404
+        mimetype, extension = EXPORT_FORMATS[fmt]
+        download_name = f"Budget_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+        header = currency_header(SAVE_EXCEL_COLS, conversion)
+        batches = iter_row_batches(user_entries_statement(user_id, conversion=conversion))
+        if fmt == "csv":
+            return Response(
+                stream_with_context(iter_csv(batches, header)), mimetype=mimetype,
+                headers={"Content-Disposition": f'attachment; filename="{download_name}"'}
+            )
+        export_file = build_export_file(fmt, batches, header)
+        return send_file(export_file, as_attachment=True, download_name=download_name, mimetype=mimetype)
     except Exception as e:
         return jsonify({"error": f"Failed to download: {str(e)}"}), 400
 
 @main.route("/api/load_masters", methods=["POST"])
 def api_load_masters():
-    user_id = get_user_id()
+    """Queues a job that replaces the user's clients and products with a master workbook."""
+    user_id, user_name = get_user_id(), get_user_name()
     if not user_id: return jsonify({"error": "Not authenticated"}), 401
     try:
         file = request.files.get("file")
         if not file: return jsonify({"error": "No file provided"}), 400
-        excel_file = pd.ExcelFile(file)
-        Client.query.filter_by(user_id=user_id).delete()
-        Product.query.filter_by(user_id=user_id).delete()
-        if "Clients" in excel_file.sheet_names:
-            clients_df = pd.read_excel(excel_file, sheet_name="Clients", engine="openpyxl")
-            if "Client" in clients_df.columns:
-                new_clients = [Client(user_id=user_id, name=str(c)) for c in clients_df["Client"].dropna().unique()]
-                db.session.bulk_save_objects(new_clients)
-        if "Products" in excel_file.sheet_names:
-            products_df = pd.read_excel(excel_file, sheet_name="Products", engine="openpyxl")
-            if "Product" in products_df.columns and "Category" in products_df.columns:
-                products_df.dropna(subset=["Product"], inplace=True)
-                products_df["Category"].fillna("Uncategorized", inplace=True)
-                new_products = [Product(user_id=user_id, name=row["Product"], category=row["Category"]) for _, row in products_df.iterrows()]
-                db.session.bulk_save_objects(new_products)
-        db.session.commit()
-        final_clients = sorted([c.name for c in Client.query.filter_by(user_id=user_id).all()])
-        final_products = [{"Product": p.name, "Category": p.category} for p in Product.query.filter_by(user_id=user_id).all()]
-        return jsonify({"status": "success", "masters": { "clients": final_clients, "products": final_products }, "message": "Master data loaded into database."})
+        job = job_runner().enqueue("load_masters", user_id, user_name, upload=file)
+        return jsonify({"status": "queued", "job": public_job(job)}), 202
     except Exception as e:
-        db.session.rollback()
         return jsonify({"error": f"Failed to load master data: {str(e)}"}), 400
 
+@main.route("/api/jobs/export", methods=["POST"])
+def api_export_job():
+    """
+    Queues an export of the user's budget ({"format", "currency"}, both optional);
+    the file is fetched from /api/jobs/<id>/download.
+    """
+    user_id, user_name = get_user_id(), get_user_name()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    try:
+        payload = request.get_json(silent=True) or {}
+        fmt = str(payload.get("format", "xlsx")).lower()
+        if fmt not in EXPORT_FORMATS: return jsonify({"error": f"Unsupported export format '{fmt}'."}), 400
+        currency = resolve_currency(payload.get("currency")).currency
+        if not has_entries(user_id): return jsonify({"error": "No data to download."}), 404
+        job = job_runner().enqueue("export", user_id, user_name, {"format": fmt, "currency": currency})
+        return jsonify({"status": "queued", "job": public_job(job)}), 202
+    except (JobError, CurrencyError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to start export: {str(e)}"}), 500
+
+@main.route("/api/jobs")
+def api_jobs():
+    """The user's recent jobs, newest first."""
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    return jsonify({"jobs": [public_job(job) for job in job_runner().store.list_for_user(user_id)]})
+
+@main.route("/api/jobs/<job_id>")
+def api_job_status(job_id):
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    job = job_runner().store.get(job_id, user_id)
+    if not job: return jsonify({"error": "Job not found."}), 404
+    return jsonify(public_job(job))
+
+@main.route("/api/jobs/<job_id>/download")
+def api_job_download(job_id):
+    user_id = get_user_id()
+    if not user_id: return jsonify({"error": "User not authenticated"}), 401
+    job = job_runner().store.get(job_id, user_id)
+    if not job: return jsonify({"error": "Job not found."}), 404
+    if job["status"] != "succeeded" or not job["result_path"]:
+        return jsonify({"error": f"Job is {job['status']}; there is nothing to download yet.", "job": public_job(job)}), 409
+    if not os.path.exists(job["result_path"]): return jsonify({"error": "The export file has expired."}), 410
+    mimetype = EXPORT_FORMATS[job["params"]["format"]][0]
+    return send_file(job["result_path"], as_attachment=True, download_name=job["result_name"], mimetype=mimetype)
+
 @main.route("/api/save", methods=["POST"])
 def api_save():
     return jsonify({"error": "Data is saved automatically."}), 403
@@ -0,0 +1,250 @@
+# budget_app/scenario.py
+"""
+What-if scenarios over a user's budget.
+
+A scenario is a list of adjustment rules, applied in order. Each rule selects
+entries by Business Unit, Section, Client, Category, Product and months (or a
+quarter) and multiplies or adds to one input: Qty, PMT, GP % or profit per
+ton, e.g.
+
+    {"category": "Urea", "quarter": 3, "field": "pmt", "op": "multiply", "value": 1.05}
+    {"section": "Broker", "field": "gp_percent", "op": "add", "value": -2}
+
+evaluate_scenario() loads the entries' columns into NumPy arrays once, applies
+every rule as a masked array operation and recomputes Sales, GP and profit
+per ton for the affected entries with the same formulas and Broker/Mining
+rules as the recalculation (recalc.recalculated_arrays). Nothing is written;
+the result is the baseline and scenario totals and their difference.
+
+apply_scenario() writes the same changes with a single UPDATE whose SET
+expressions hold one CASE per rule, so no rows are loaded into Python.
+"""
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, case, func, literal, or_, select, true, update
+
+from . import db
+from .models import BudgetEntry
+from .change_feed import next_version
+from .data_utils import MONTHS_MAP
+from .entry_service import BROKER_MINING_SECTIONS
+from .recalc import recalculated_arrays
+from .rollups import RollupDelta, grouped_entries
+
+# Rule filter -> entry column
+SCENARIO_FILTERS = {
+    "business_unit": "business_unit",
+    "section": "section",
+    "client": "client",
+    "category": "category",
+    "product": "product",
+}
+# Adjustable input -> entry column
+SCENARIO_FIELDS = {"qty": "qty_mt", "pmt": "pmt_usd", "gp_percent": "gp_percent", "profit_per_ton": "profit_per_ton"}
+SCENARIO_OPS = ("multiply", "add")
+SCENARIO_GROUP_BY = ("business_unit", "section", "client", "category", "product", "month", "quarter", "booked")
+MAX_RULES = 50
+
+_LOADED_COLUMNS = ("business_unit", "section", "client", "category", "product", "month", "booked",
+                   "qty_mt", "pmt_usd", "gp_percent", "profit_per_ton", "sales_usd", "gp_usd")
+_TOTALS = ("qty", "sales", "gp")
+
+
+class ScenarioError(ValueError):
+    """Raised for invalid scenario rules."""
+
+
+class Rule(NamedTuple):
+    filters: Dict[str, List[str]]
+    months: Optional[List[int]]
+    column: str
+    op: str
+    value: float
+
+
+def _month_number(value: Any) -> int:
+    text = str(value).strip()
+    month = int(text) if text.isdigit() else MONTHS_MAP.get(text.capitalize()[:3])
+    if not month or not 1 <= month <= 12:
+        raise ScenarioError(f"Invalid month '{value}'.")
+    return month
+
+
+def parse_rules(raw_rules: Any) -> List[Rule]:
+    """Validates the request's rules."""
+    if not isinstance(raw_rules, list) or not raw_rules:
+        raise ScenarioError("A scenario needs a non-empty list of rules.")
+    if len(raw_rules) > MAX_RULES:
+        raise ScenarioError(f"A scenario can have at most {MAX_RULES} rules.")
+    rules = []
+    for number, raw in enumerate(raw_rules, start=1):
+        if not isinstance(raw, Mapping):
+            raise ScenarioError(f"Rule {number} must be an object.")
+        field, op = raw.get("field"), raw.get("op", "multiply")
+        if field not in SCENARIO_FIELDS:
+            raise ScenarioError(f"Rule {number}: field must be one of {', '.join(SCENARIO_FIELDS)}.")
+        if op not in SCENARIO_OPS:
+            raise ScenarioError(f"Rule {number}: op must be 'multiply' or 'add'.")
+        try:
+            value = float(raw.get("value"))
+        except (TypeError, ValueError):
+            raise ScenarioError(f"Rule {number}: value must be a number.")
+        if not np.isfinite(value):
+            raise ScenarioError(f"Rule {number}: value must be a finite number.")
+
+        filters = {}
+        for name in SCENARIO_FILTERS:
+            selected = raw.get(name)
+            if selected in (None, "", []):
+                continue
+            filters[name] = [str(v) for v in (selected if isinstance(selected, list) else [selected])]
+        months = None
+        if raw.get("months") not in (None, "", []):
+            selected = raw["months"] if isinstance(raw["months"], list) else [raw["months"]]
+            months = sorted({_month_number(m) for m in selected})
+        if raw.get("quarter") not in (None, ""):
+            try:
+                quarter = int(raw["quarter"])
+            except (TypeError, ValueError):
+                quarter = 0
+            if not 1 <= quarter <= 4:
+                raise ScenarioError(f"Rule {number}: quarter must be 1-4.")
+            quarter_months = list(range(quarter * 3 - 2, quarter * 3 + 1))
+            months = [m for m in months if m in quarter_months] if months is not None else quarter_months
+        rules.append(Rule(filters, months, SCENARIO_FIELDS[field], op, value))
+    return rules
+
+
+# --- Evaluation in memory ------------------------------------------------------
+
+def load_entry_arrays(user_id: str) -> pd.DataFrame:
+    """The user's entries as columns (text as object arrays, amounts as float64 with NULL -> 0)."""
+    rows = db.session.execute(
+        select(*(getattr(BudgetEntry, c) for c in _LOADED_COLUMNS)).where(BudgetEntry.user_id == user_id)
+    ).all()
+    df = pd.DataFrame.from_records(rows, columns=list(_LOADED_COLUMNS))
+    for column in ("qty_mt", "pmt_usd", "gp_percent", "profit_per_ton", "sales_usd", "gp_usd"):
+        df[column] = pd.to_numeric(df[column], errors="coerce").fillna(0.0).astype(np.float64)
+    df["month"] = pd.to_numeric(df["month"], errors="coerce").fillna(0).astype(np.int64)
+    return df
+
+
+def rule_mask(df: pd.DataFrame, rule: Rule) -> np.ndarray:
+    mask = np.ones(len(df), dtype=bool)
+    for name, values in rule.filters.items():
+        mask &= df[SCENARIO_FILTERS[name]].isin(values).to_numpy()
+    if rule.months is not None:
+        mask &= np.isin(df["month"].to_numpy(), rule.months)
+    return mask
+
+
+def _totals(count: int, qty: float, sales: float, gp: float) -> Dict[str, Any]:
+    out = {"count": int(count), "qty": round(float(qty), 2), "sales": round(float(sales), 2), "gp": round(float(gp), 2)}
+    out["gm_percent"] = round(out["gp"] / out["sales"] * 100, 2) if out["sales"] else 0.0
+    return out
+
+
+def _comparison(base: Dict[str, Any], scenario: Dict[str, Any]) -> Dict[str, Any]:
+    delta = {key: round(scenario[key] - base[key], 2) for key in _TOTALS + ("gm_percent",)}
+    return {"baseline": base, "scenario": scenario, "delta": delta}
+
+
+def evaluate_scenario(user_id: str, rules: Sequence[Rule], group_by: Sequence[str] = ()) -> Dict[str, Any]:
+    """
+    The effect of the rules on the user's totals (and per group of `group_by`), without writing anything.
+    Entries no rule matches keep their stored amounts.
+    """
+    unknown = [d for d in group_by if d not in SCENARIO_GROUP_BY]
+    if unknown:
+        raise ScenarioError(f"Cannot group by {', '.join(unknown)}.")
+    df = load_entry_arrays(user_id)
+    inputs = {column: df[column].to_numpy(copy=True) for column in SCENARIO_FIELDS.values()}
+    affected = np.zeros(len(df), dtype=bool)
+    for rule in rules:
+        mask = rule_mask(df, rule)
+        affected |= mask
+        values = inputs[rule.column]
+        values[mask] = values[mask] * rule.value if rule.op == "multiply" else values[mask] + rule.value
+
+    is_broker = df["section"].isin(BROKER_MINING_SECTIONS).to_numpy()
+    sales, gp, _ = recalculated_arrays(inputs["qty_mt"], inputs["pmt_usd"], inputs["gp_percent"],
+                                       inputs["profit_per_ton"], is_broker)
+    new = pd.DataFrame({
+        "qty": np.where(affected, inputs["qty_mt"], df["qty_mt"].to_numpy()),
+        "sales": np.where(affected, sales, df["sales_usd"].to_numpy()),
+        "gp": np.where(affected, gp, df["gp_usd"].to_numpy()),
+    })
+    old = pd.DataFrame({"qty": df["qty_mt"], "sales": df["sales_usd"], "gp": df["gp_usd"]})
+
+    result = {
+        "rows_affected": int(affected.sum()),
+        **_comparison(_totals(len(df), *old.sum()), _totals(len(df), *new.sum())),
+        "group_by": list(group_by),
+        "groups": [],
+    }
+    if group_by and len(df):
+        keys = {d: df["month"].add(2).floordiv(3) if d == "quarter" else df[d] for d in group_by}
+        frame = pd.DataFrame({**keys, "n": 1, **old.add_prefix("old_"), **new.add_prefix("new_")})
+        sums = frame.groupby(list(group_by), dropna=False).sum().reset_index()
+        for row in sums.to_dict("records"):
+            group = {d: None if pd.isna(row[d]) else int(row[d]) if d in ("month", "quarter") else row[d] for d in group_by}
+            group.update(_comparison(_totals(row["n"], *(row[f"old_{k}"] for k in _TOTALS)),
+                                     _totals(row["n"], *(row[f"new_{k}"] for k in _TOTALS))))
+            result["groups"].append(group)
+    return result
+
+
+# --- Applying in the database ---------------------------------------------------
+
+def rule_condition(rule: Rule):
+    conditions = [getattr(BudgetEntry, SCENARIO_FILTERS[name]).in_(values) for name, values in rule.filters.items()]
+    if rule.months is not None:
+        conditions.append(BudgetEntry.month.in_(rule.months))
+    return and_(*conditions) if conditions else true()
+
+
+def adjusted_inputs(rules: Sequence[Rule]) -> Dict[str, Any]:
+    """
+    Each input column after the rules: the stored value times (or plus) one CASE per rule on that
+    column, which is the factor (or addend) where the rule matches and 1 (or 0) elsewhere.
+    Nesting the column inside each CASE instead would double the expression with every rule.
+    """
+    inputs = {column: func.coalesce(getattr(BudgetEntry, column), 0.0) for column in SCENARIO_FIELDS.values()}
+    for rule in rules:
+        if rule.op == "multiply":
+            inputs[rule.column] = inputs[rule.column] * case((rule_condition(rule), rule.value), else_=1.0)
+        else:
+            inputs[rule.column] = inputs[rule.column] + case((rule_condition(rule), rule.value), else_=0.0)
+    return inputs
+
+
+def apply_scenario(user_id: str, rules: Sequence[Rule]) -> Dict[str, Any]:
+    """
+    Writes the rules to the user's entries in the current transaction with one UPDATE, recomputing
+    Sales, GP and profit per ton like recalc.py. Returns the new data version and the rows changed.
+    """
+    version = next_version(user_id)
+    inputs = adjusted_inputs(rules)
+    qty, pmt, gp_percent, profit_per_ton = (inputs[c] for c in ("qty_mt", "pmt_usd", "gp_percent", "profit_per_ton"))
+    is_broker = BudgetEntry.section.in_(BROKER_MINING_SECTIONS)
+    sales_expr = func.round(qty * pmt, 2)
+    gp_expr = func.round(sales_expr * gp_percent / 100.0, 2)
+    values = {column: inputs[column] for column in {rule.column for rule in rules}}
+    values.update(
+        sales_usd=case((is_broker, literal(0.0)), else_=sales_expr),
+        gp_usd=case((is_broker, func.round(qty * profit_per_ton, 2)), else_=gp_expr),
+        profit_per_ton=case((is_broker, profit_per_ton), (qty > 0, func.round(gp_expr / qty, 2)), else_=literal(0.0)),
+        version=version,
+    )
+    matched = [BudgetEntry.user_id == user_id, or_(*[rule_condition(rule) for rule in rules])]
+
+    delta = RollupDelta()
+    delta.add_groups(db.session.execute(grouped_entries(*matched)).mappings(), sign=-1)
+    result = db.session.execute(
+        update(BudgetEntry).where(*matched).values(**values).execution_options(synchronize_session=False)
+    )
+    delta.add_groups(db.session.execute(grouped_entries(BudgetEntry.user_id == user_id, BudgetEntry.version == version)).mappings())
+    delta.apply()
+    return {"version": version, "rows_changed": result.rowcount}
@@ -1,53 +1,270 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
 import uuid
 import pandas as pd
+from collections import OrderedDict
+from contextlib import closing
 from datetime import datetime
 from typing import Dict, List, Any, Optional
-from flask import request
+from flask import g, has_request_context, request
 
 # Import constants and schemas from our new data_utils module
 from .data_utils import IDCOL, INTERNAL_DF_COLS
 
-# This dictionary holds all active user sessions in memory.
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+# Defaults for the session store limits (see Config.SESSION_*)
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_IDLE_TTL = 3600
+# Rough per-session bookkeeping overhead on top of the DataFrames
+SESSION_OVERHEAD_BYTES = 2048
+
+
+def _default_masters() -> Dict[str, Any]:
+    return {
+        "clients": [
+            "Client 1", "Client 2", "Client 3", 
+        ],
+        "products": pd.DataFrame({
+            "Product": [
+                "Product 1", "Product 2", "Product 3",
+            ],
+            "Category": [
+                "Category 1", "Category 2", "Category 3", 
+            ],
+            
+        }),
+    }
+
+# Values a session builds on first access instead of up front
+LAZY_SESSION_VALUES = {
+    "entries_df": lambda: pd.DataFrame(columns=[IDCOL] + INTERNAL_DF_COLS),
+    "masters": _default_masters,
+}
+
+
+class SessionData(dict):
+    """A session dict whose DataFrames are only created when they are first used."""
+
+    def __missing__(self, key):
+        if key not in LAZY_SESSION_VALUES:
+            raise KeyError(key)
+        value = self[key] = LAZY_SESSION_VALUES[key]()
+        return value
+
+
+def estimate_session_bytes(session: Dict[str, Any]) -> int:
+    """Approximate memory held by a session, dominated by its DataFrames."""
+    size = SESSION_OVERHEAD_BYTES
+    frames = [session.get("entries_df")]
+    masters = session.get("masters")
+    if masters:
+        frames.append(masters.get("products"))
+        size += sum(len(str(c)) + 50 for c in masters.get("clients", []))
+    for df in frames:
+        if isinstance(df, pd.DataFrame):
+            size += int(df.memory_usage(index=True, deep=True).sum())
+    return size
+
+
+class MemorySessionStore:
+    """
+    In-process store, one per worker. Sessions idle for longer than idle_ttl seconds are
+    dropped, and the least recently used ones are evicted beyond max_entries or max_bytes.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 idle_ttl: int = DEFAULT_IDLE_TTL):
+        self.max_entries, self.max_bytes, self.idle_ttl = max_entries, max_bytes, idle_ttl
+        self._sessions: "OrderedDict[str, SessionData]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        # time.time() of each session's last use, like the sqlite store's last_accessed column
+        self._accessed: Dict[str, float] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[SessionData]:
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session["last_accessed"] = datetime.utcnow()
+                self._accessed[session_id] = time.time()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def save(self, session: SessionData) -> None:
+        size = estimate_session_bytes(session)
+        with self._lock:
+            session_id = session["id"]
+            self._total_bytes += size - self._sizes.get(session_id, 0)
+            self._sizes[session_id] = size
+            self._accessed[session_id] = time.time()
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._evict()
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._drop(session_id)
+
+    def _drop(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+        self._accessed.pop(session_id, None)
+        self._total_bytes -= self._sizes.pop(session_id, 0)
+
+    def _evict(self) -> None:
+        # Least recently used first, so expired sessions sit at the front
+        cutoff = time.time() - self.idle_ttl
+        while self._sessions:
+            session_id = next(iter(self._sessions))
+            expired = self._accessed[session_id] < cutoff if self.idle_ttl else False
+            if expired or len(self._sessions) > self.max_entries or self._total_bytes > self.max_bytes:
+                self._drop(session_id)
+            else:
+                break
+
+
+class SQLiteSessionStore:
+    """
+    Store in a local SQLite file that all workers on the machine share. Sessions are
+    pickled copies: the ones used in a request are written back when it ends, and
+    changes made outside a request need save_session(). The same limits as the
+    memory store apply, counted on the pickled size.
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 idle_ttl: int = DEFAULT_IDLE_TTL):
+        self.path = path
+        self.max_entries, self.max_bytes, self.idle_ttl = max_entries, max_bytes, idle_ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_sessions_last_accessed ON sessions (last_accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def __len__(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def get(self, session_id: str) -> Optional[SessionData]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE id = ? AND last_accessed >= ?",
+                (session_id, now - self.idle_ttl if self.idle_ttl else 0)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE sessions SET last_accessed = ? WHERE id = ?", (now, session_id))
+        finally:
+            conn.close()
+        session = pickle.loads(row[0])
+        session["last_accessed"] = datetime.utcnow()
+        return session
+
+    def save(self, session: SessionData) -> None:
+        data = pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, size, last_accessed) VALUES (?, ?, ?, ?)",
+                (session["id"], data, len(data), time.time())
+            )
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def delete(self, session_id: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        if self.idle_ttl:
+            conn.execute("DELETE FROM sessions WHERE last_accessed < ?", (time.time() - self.idle_ttl,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Drop the least recently used sessions until both limits hold
+        doomed = []
+        for session_id, size in conn.execute("SELECT id, size FROM sessions ORDER BY last_accessed"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((session_id,))
+            count, total = count - 1, total - size
+        conn.executemany("DELETE FROM sessions WHERE id = ?", doomed)
+
+
+# The active store; replaced by init_session_store() from the app configuration.
+SESSIONS = MemorySessionStore()
+
+def init_session_store(app) -> None:
+    """Creates the session store selected by SESSION_STORE ("memory" or "sqlite")."""
+    global SESSIONS
+    limits = {
+        "max_entries": app.config.get("SESSION_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+        "max_bytes": app.config.get("SESSION_MAX_BYTES", DEFAULT_MAX_BYTES),
+        "idle_ttl": app.config.get("SESSION_IDLE_TTL", DEFAULT_IDLE_TTL),
+    }
+    backend = (app.config.get("SESSION_STORE") or "memory").lower()
+    if backend == "sqlite":
+        SESSIONS = SQLiteSessionStore(app.config["SESSION_STORE_PATH"], **limits)
+    elif backend == "memory":
+        SESSIONS = MemorySessionStore(**limits)
+    else:
+        raise ValueError(f"Unknown SESSION_STORE '{backend}' (expected 'memory' or 'sqlite').")
+    app.extensions["session_store"] = SESSIONS
+    app.after_request(save_request_sessions)
+
+def save_request_sessions(response):
+    """after_request hook: writes the sessions the request used back to the store."""
+    for session in g.pop("sessions_used", {}).values():
+        SESSIONS.save(session)
+    return response
+
+def _used_in_request(session: Dict[str, Any]) -> Dict[str, Any]:
+    if has_request_context():
+        g.setdefault("sessions_used", {})[session["id"]] = session
+    return session
+
+def save_session(session: Dict[str, Any]) -> None:
+    """
+    Writes a changed session back to the store (re-measuring its size). Sessions used in a
+    request are saved when it ends; this is for changes made outside a request.
+    """
+    SESSIONS.save(session)
 
 def get_or_create_session(session_id: Optional[str] = None) -> Dict[str, Any]:
     """Gets or creates a new session for a user."""
-    if session_id and session_id in SESSIONS:
-        return SESSIONS[session_id]
+    if session_id:
+        session = SESSIONS.get(session_id)
+        if session is not None:
+            return _used_in_request(session)
 
     new_session_id = str(uuid.uuid4())
     
-    # Each user gets their own copy of data and masters
-    SESSIONS[new_session_id] = {
-        "id": new_session_id,
-        "entries_df": pd.DataFrame(columns=[IDCOL] + INTERNAL_DF_COLS),
-        "masters": {
-            "clients": [
-                "Client 1", "Client 2", "Client 3", 
-            ],
-            "products": pd.DataFrame({
-                "Product": [
-                    "Product 1", "Product 2", "Product 3",
-                ],
-                "Category": [
-                    "Category 1", "Category 2", "Category 3", 
-                ],
-                
-            }),
-        },
-        "last_accessed": datetime.utcnow()
-    }
-    return SESSIONS[new_session_id]
+    # Each user gets their own copy of data and masters, built when first used
+    session = SessionData(id=new_session_id, last_accessed=datetime.utcnow())
+    SESSIONS.save(session)
+    return _used_in_request(session)
 
 def get_session_from_request() -> Dict[str, Any]:
     """Helper to get the session ID from the request header."""
-    session_id = request.headers.get("X-Session-ID")
-    if not session_id:
-        return get_or_create_session()
-    
-    session = SESSIONS.get(session_id)
-    if not session:
-        return get_or_create_session()
-    
-    session["last_accessed"] = datetime.utcnow()
-    return session
\ No newline at end of file
+    return get_or_create_session(request.headers.get("X-Session-ID"))
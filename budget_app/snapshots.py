@@ -0,0 +1,307 @@
+# budget_app/snapshots.py
+"""
+Named snapshots of a user's budget.
+
+A snapshot is one zstd-compressed Parquet file in SNAPSHOT_DIR, named after
+its budget_snapshots row, with the entries' columns as Arrow columns. Taking
+one streams the entries from the database into the file in row groups;
+restoring one replaces the user's entries with the file's batches like a
+budget import (one new data version, a reset for the clients and rollups
+rebuilt from the inserted frames). Diffs align two snapshots, or a snapshot
+and the live entries, on the entry ID and compare whole columns at once.
+
+Loading a workbook, clearing the budget and restoring a snapshot take an
+automatic snapshot first when SNAPSHOT_BEFORE_REPLACE is set; only the newest
+SNAPSHOT_MAX_AUTO automatic snapshots of each user are kept.
+
+Files follow their rows' transaction: a deleted snapshot's file is removed only
+once the deletion commits, and a new snapshot's file is removed again if its
+row is rolled back (the paths wait in session.info; see init_snapshots).
+"""
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+from flask import current_app
+from sqlalchemy import event, insert, select
+
+from . import db
+from .models import BudgetEntry, BudgetSnapshot, ENTRY_COLUMN_MAP
+from .change_feed import current_version, record_reset
+from .exporter import has_entries, iter_row_batches
+from .rollups import RollupDelta
+
+# Entry columns stored in a snapshot (the user is implied by the snapshot)
+SNAPSHOT_COLUMNS = ("_rid", "business_unit", "section", "client", "category", "product", "month",
+                    "qty_mt", "pmt_usd", "gp_percent", "sales_usd", "gp_usd", "profit_per_ton", "sector", "booked")
+_INT_COLUMNS = ("month",)
+_FLOAT_COLUMNS = ("qty_mt", "pmt_usd", "gp_percent", "sales_usd", "gp_usd", "profit_per_ton")
+SNAPSHOT_REASONS = ("manual", "load", "clear", "restore")
+RESTORE_BATCH_ROWS = 50000
+DEFAULT_DIFF_LIMIT = 100
+# Entry JSON labels of the snapshot columns, for diffs
+_LABELS = {attribute: label for label, attribute in ENTRY_COLUMN_MAP.items()}
+# session.info keys of the files waiting for the transaction's outcome
+_WRITTEN, _REMOVED, _COMMITTING = "snapshot_files_written", "snapshot_files_removed", "snapshot_files_committing"
+
+
+class SnapshotError(ValueError):
+    """Raised for invalid snapshot requests and unreadable snapshot files."""
+
+
+class SnapshotNotFound(SnapshotError):
+    """Raised when a snapshot doesn't exist or belongs to another user."""
+
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SnapshotError("Budget snapshots require the 'pyarrow' package.")
+    return pa, pq
+
+
+def snapshot_schema():
+    pa, _ = _arrow()
+    types = {c: pa.int64() for c in _INT_COLUMNS}
+    types.update({c: pa.float64() for c in _FLOAT_COLUMNS})
+    return pa.schema([(c, types.get(c, pa.string())) for c in SNAPSHOT_COLUMNS])
+
+
+def snapshot_path(snapshot_id: str) -> str:
+    return os.path.join(current_app.config["SNAPSHOT_DIR"], f"{snapshot_id}.parquet")
+
+
+def _entry_batches(user_id: str) -> Iterator[Any]:
+    """The user's entries as Arrow record batches with the snapshot schema."""
+    pa, _ = _arrow()
+    schema = snapshot_schema()
+    statement = select(*(getattr(BudgetEntry, c) for c in SNAPSHOT_COLUMNS)).where(BudgetEntry.user_id == user_id)
+    for batch in iter_row_batches(statement):
+        columns = list(zip(*batch))
+        yield pa.RecordBatch.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema)
+
+
+def live_table(user_id: str):
+    pa, _ = _arrow()
+    return pa.Table.from_batches(list(_entry_batches(user_id)), schema=snapshot_schema())
+
+
+# --- Snapshot metadata -----------------------------------------------------------
+
+def list_snapshots(user_id: str) -> List[BudgetSnapshot]:
+    return BudgetSnapshot.query.filter_by(user_id=user_id).order_by(BudgetSnapshot.created_at.desc()).all()
+
+
+def get_snapshot(user_id: str, snapshot_id: str) -> BudgetSnapshot:
+    snapshot = BudgetSnapshot.query.filter_by(id=snapshot_id, user_id=user_id).first()
+    if snapshot is None:
+        raise SnapshotNotFound(f"Snapshot '{snapshot_id}' not found.")
+    return snapshot
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _pending_files(key: str) -> List[str]:
+    return db.session().info.setdefault(key, [])
+
+
+def delete_snapshot(snapshot: BudgetSnapshot) -> None:
+    """Deletes the snapshot's row in the current transaction; its file is removed once that commits."""
+    db.session.delete(snapshot)
+    _pending_files(_REMOVED).append(snapshot_path(snapshot.id))
+
+
+def prune_snapshots(user_id: str, keep: int) -> int:
+    """Deletes all but the newest `keep` automatic snapshots of the user. Returns how many were deleted."""
+    automatic = (
+        BudgetSnapshot.query.filter(BudgetSnapshot.user_id == user_id, BudgetSnapshot.reason != "manual")
+        .order_by(BudgetSnapshot.created_at.desc()).offset(keep).all()
+    )
+    for snapshot in automatic:
+        delete_snapshot(snapshot)
+    return len(automatic)
+
+
+# --- Snapshot, restore and diff -------------------------------------------------
+
+def create_snapshot(user_id: str, name: Optional[str] = None, reason: str = "manual") -> BudgetSnapshot:
+    """
+    Writes the user's current entries to a new snapshot file and adds its row to the current
+    transaction. The caller commits; the file is removed again if the transaction rolls back.
+    """
+    _, pq = _arrow()
+    config = current_app.config
+    if reason not in SNAPSHOT_REASONS:
+        raise SnapshotError(f"Invalid snapshot reason '{reason}'.")
+    name = (name or "").strip() or (f"Before {reason}" if reason != "manual" else "Snapshot")
+    if len(name) > 255:
+        raise SnapshotError("Snapshot names are limited to 255 characters.")
+    if reason == "manual":
+        limit = config.get("SNAPSHOT_MAX_MANUAL", 50)
+        if BudgetSnapshot.query.filter_by(user_id=user_id, reason="manual").count() >= limit:
+            raise SnapshotError(f"You can keep at most {limit} snapshots; delete one first.")
+
+    snapshot = BudgetSnapshot(id=str(uuid.uuid4()), user_id=user_id, name=name, reason=reason,
+                              created_at=datetime.utcnow(), data_version=current_version(user_id))
+    path = snapshot_path(snapshot.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        rows = 0
+        with pq.ParquetWriter(path + ".tmp", snapshot_schema(), compression="zstd") as writer:
+            for batch in _entry_batches(user_id):
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        os.replace(path + ".tmp", path)
+        snapshot.entry_count, snapshot.size_bytes = rows, os.path.getsize(path)
+        _pending_files(_WRITTEN).append(path)
+        db.session.add(snapshot)
+        db.session.flush()
+    except Exception:
+        _remove_file(path + ".tmp")
+        _remove_file(path)
+        raise
+    if reason != "manual":
+        prune_snapshots(user_id, config.get("SNAPSHOT_MAX_AUTO", 10))
+    return snapshot
+
+
+def snapshot_before(user_id: str, reason: str) -> Optional[BudgetSnapshot]:
+    """The automatic snapshot taken before the user's budget is replaced (None when disabled or empty)."""
+    if not current_app.config.get("SNAPSHOT_BEFORE_REPLACE", True) or not has_entries(user_id):
+        return None
+    return create_snapshot(user_id, reason=reason)
+
+
+def read_snapshot(snapshot: BudgetSnapshot):
+    """The snapshot's entries as an Arrow table."""
+    _, pq = _arrow()
+    try:
+        return pq.read_table(snapshot_path(snapshot.id), schema=snapshot_schema())
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Snapshot '{snapshot.name}' can't be read: {e}")
+
+
+def restore_snapshot(snapshot: BudgetSnapshot, user_name: Optional[str]) -> Dict[str, Any]:
+    """
+    Replaces the snapshot owner's entries with the snapshot in the current transaction, after an
+    automatic snapshot of the current entries. Returns the reset change (see change_feed.record_reset),
+    the rows written and the ID of the automatic snapshot. The caller commits.
+    """
+    user_id = snapshot.user_id
+    # Read first: the automatic snapshot may prune the one being restored
+    table = read_snapshot(snapshot)
+    backup = snapshot_before(user_id, "restore")
+    BudgetEntry.query.filter_by(user_id=user_id).delete()
+    changes = record_reset(user_id)
+    rollups = RollupDelta()
+    owner = {"user_id": user_id, "user_name": user_name, "version": changes["version"]}
+    for batch in table.to_batches(max_chunksize=RESTORE_BATCH_ROWS):
+        rollups.add_frame(user_id, batch.to_pandas())
+        db.session.execute(insert(BudgetEntry), [{**row, **owner} for row in batch.to_pylist()])
+    rollups.apply()
+    return {**changes, "rows_written": table.num_rows, "snapshot": backup.id if backup else None}
+
+
+def _frame(table) -> pd.DataFrame:
+    return table.to_pandas().set_index("_rid")
+
+
+def _totals(df: pd.DataFrame) -> Dict[str, Any]:
+    sums = df[["qty_mt", "sales_usd", "gp_usd"]].sum()
+    return {"count": len(df), "qty": round(float(sums["qty_mt"]), 2),
+            "sales": round(float(sums["sales_usd"]), 2), "gp": round(float(sums["gp_usd"]), 2)}
+
+
+def _json_value(value: Any) -> Any:
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def diff_tables(old_table, new_table, limit: int = DEFAULT_DIFF_LIMIT) -> Dict[str, Any]:
+    """
+    Added, removed and changed entries between two snapshot tables: counts, changed values per
+    column, totals on both sides and at most `limit` example IDs / changed rows of each kind.
+    """
+    old, new = _frame(old_table), _frame(new_table)
+    added, removed = new.index.difference(old.index), old.index.difference(new.index)
+    common = old.index.intersection(new.index)
+    before, after = old.loc[common], new.loc[common, old.columns]
+    # NULL on both sides is no change
+    differs = before.ne(after) & ~(before.isna() & after.isna())
+    changed = differs.any(axis=1)
+    per_column = differs.sum()
+
+    rows = []
+    sample = changed[changed].index[:limit]
+    for rid, flags in zip(sample, differs.loc[sample].itertuples(index=False)):
+        row_changes = {
+            _LABELS[column]: [_json_value(before.at[rid, column]), _json_value(after.at[rid, column])]
+            for column, flag in zip(differs.columns, flags) if flag
+        }
+        rows.append({_LABELS["_rid"]: rid, "changes": row_changes})
+
+    old_totals, new_totals = _totals(old), _totals(new)
+    return {
+        "added": len(added),
+        "removed": len(removed),
+        "changed": int(changed.sum()),
+        "unchanged": int(len(common) - changed.sum()),
+        "columns": {_LABELS[column]: int(count) for column, count in per_column.items() if count},
+        "totals": {
+            "from": old_totals,
+            "to": new_totals,
+            "delta": {key: round(new_totals[key] - old_totals[key], 2) for key in old_totals},
+        },
+        "added_ids": list(added[:limit]),
+        "removed_ids": list(removed[:limit]),
+        "changed_rows": rows,
+    }
+
+
+def diff_snapshots(user_id: str, from_id: str, to_id: Optional[str] = None, limit: int = DEFAULT_DIFF_LIMIT) -> Dict[str, Any]:
+    """Diff from one of the user's snapshots to another, or to the live entries when to_id is None or "live"."""
+    old_table = read_snapshot(get_snapshot(user_id, from_id))
+    live = to_id in (None, "", "live")
+    new_table = live_table(user_id) if live else read_snapshot(get_snapshot(user_id, to_id))
+    return {"from": from_id, "to": "live" if live else to_id, **diff_tables(old_table, new_table, limit)}
+
+
+# --- Files and transactions -----------------------------------------------------
+
+def _before_commit(session):
+    # Savepoints (begin_nested) also fire this and after_commit; the files wait for the real commit
+    if session.in_nested_transaction():
+        return
+    session.info[_COMMITTING] = True
+
+def _after_commit(session):
+    if not session.info.pop(_COMMITTING, False):
+        return
+    session.info.pop(_WRITTEN, None)
+    for path in session.info.pop(_REMOVED, ()):
+        _remove_file(path)
+
+def _after_soft_rollback(session, previous_transaction):
+    # A savepoint rolling back leaves the outer transaction, and its snapshot rows, alive
+    if previous_transaction.nested:
+        return
+    for path in session.info.pop(_WRITTEN, ()):
+        _remove_file(path)
+    session.info.pop(_REMOVED, None)
+    session.info.pop(_COMMITTING, None)
+
+def init_snapshots(app):
+    """Ties snapshot files to the outcome of db.session's transactions."""
+    event.listen(db.session, "before_commit", _before_commit)
+    event.listen(db.session, "after_commit", _after_commit)
+    event.listen(db.session, "after_soft_rollback", _after_soft_rollback)
@@ -6,6 +6,7 @@ lucide.createIcons();
 // Application State
 const AppState = {
     entries: [],
+    version: 0,
     masters: {
         clients: [],
         products: [],
@@ -23,6 +24,9 @@ const AppState = {
 };
 let sessionId = null;
 
+// Sort order and keyset cursor of the Manage Data table
+const TableState = { sort: 'Month', dir: 'asc', cursor: null, requestSeq: 0 };
+
 function rebuildMasterLookups() {
     AppState.masters.productMap = {};
     (AppState.masters.products || []).forEach(product => {
@@ -33,6 +37,47 @@ function rebuildMasterLookups() {
     console.log("Master product->category lookup map has been rebuilt.");
 }
 
+// Turns an entries payload into row objects. The server sends either a list of rows or,
+// for ?format=columnar, {columns, count, data} with dictionary-encoded text columns.
+function decodeEntries(payload) {
+    if (!payload || Array.isArray(payload)) return payload || [];
+    const columns = payload.columns.map(name => {
+        const column = payload.data[name];
+        return Array.isArray(column) ? column : column.codes.map(code => column.dict[code]);
+    });
+    const rows = new Array(payload.count);
+    for (let i = 0; i < payload.count; i++) {
+        const row = {};
+        for (let c = 0; c < columns.length; c++) row[payload.columns[c]] = columns[c][i];
+        rows[i] = row;
+    }
+    return rows;
+}
+
+// Applies a change-feed payload ({version, rows, deleted, reset}) to AppState.entries in place.
+function applyEntryChanges(changes) {
+    const rows = decodeEntries(changes.rows);
+    if (changes.reset) {
+        AppState.entries = rows;
+    } else {
+        const deleted = new Set(changes.deleted || []);
+        const changedRows = new Map(rows.map(row => [row._rid, row]));
+        const patched = [];
+        AppState.entries.forEach(entry => {
+            if (deleted.has(entry._rid)) return;
+            if (changedRows.has(entry._rid)) {
+                patched.push(changedRows.get(entry._rid));
+                changedRows.delete(entry._rid);
+            } else {
+                patched.push(entry);
+            }
+        });
+        changedRows.forEach(row => patched.push(row));
+        AppState.entries = patched;
+    }
+    AppState.version = changes.version ?? AppState.version;
+}
+
 // Utility Functions
 const Utils = {
     formatCurrency: (amount) => {
@@ -72,9 +117,13 @@ const Utils = {
         lucide.createIcons();
         setTimeout(() => { if (notification.parentElement) { notification.remove(); } }, 7000);
     },
-    showLoading: (show = true) => {
+    showLoading: (show = true, message = 'Processing...') => {
         document.getElementById('loadingOverlay').classList.toggle('hidden', !show);
-    }
+        document.getElementById('loadingMessage').textContent = message;
+    },
+    jobProgressMessage: (job) => job.status === 'queued'
+        ? 'Waiting to start...'
+        : `Processing... ${job.rows_read.toLocaleString()} rows read, ${job.rows_written.toLocaleString()} saved`
 };
 
 // API Functions
@@ -90,8 +139,9 @@ const API = {
     },
     async loadState() {
         try {
-            const data = await this._fetchWithSession('/api/state');
-            AppState.entries = data.entries || [];
+            const data = await this._fetchWithSession('/api/state?format=columnar');
+            AppState.entries = decodeEntries(data.entries);
+            AppState.version = data.version || 0;
             AppState.masters.clients = data.masters?.clients || [];
             AppState.masters.products = data.masters?.products || [];
             rebuildMasterLookups();
@@ -101,21 +151,87 @@ const API = {
             throw error;
         }
     },
+    async syncChanges() {
+        const data = await this._fetchWithSession(`/api/changes?since=${AppState.version}&format=columnar`);
+        applyEntryChanges(data);
+        return data;
+    },
+    // Patches AppState with a mutation response. If another tab or device changed the
+    // budget in between, the versions don't line up and the missed changes are fetched first.
+    async applyMutation(data) {
+        if (data.reset || data.version !== AppState.version + 1) {
+            await this.syncChanges();
+        } else {
+            applyEntryChanges({ ...data, reset: false });
+        }
+    },
+    async queryEntries(params) {
+        const query = new URLSearchParams(Object.entries(params).filter(([, v]) => v !== '' && v !== null && v !== undefined));
+        query.set('format', 'columnar');
+        try {
+            const page = await this._fetchWithSession(`/api/entries?${query}`);
+            return { ...page, rows: decodeEntries(page.rows) };
+        } catch (error) {
+            Utils.showNotification('Failed to load entries: ' + error.message, 'error');
+            throw error;
+        }
+    },
+    async loadSummary(params = {}) {
+        try {
+            return await this._fetchWithSession(`/api/summary?${new URLSearchParams(params)}`);
+        } catch (error) {
+            Utils.showNotification('Failed to load summary: ' + error.message, 'error');
+            throw error;
+        }
+    },
+    // Polls a background job (see jobs.py) until it has finished. Returns the finished job,
+    // or throws with the job's error; onProgress gets every intermediate state.
+    async waitForJob(job, onProgress = () => {}) {
+        let delay = 500;
+        while (job.status === 'queued' || job.status === 'running') {
+            onProgress(job);
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 1.5, 3000);
+            job = await this._fetchWithSession(`/api/jobs/${job.id}`);
+        }
+        if (job.status === 'failed') throw new Error(job.error || 'The job failed');
+        return job;
+    },
+    // Renders the budget export in the background and returns the URL of the finished file.
+    // Amounts are converted on the server when a currency other than USD is given.
+    async exportFile(format = 'xlsx', currency = 'USD') {
+        const data = await this._fetchWithSession('/api/jobs/export', { method: 'POST', body: JSON.stringify({ format, currency }) });
+        const job = await this.waitForJob(data.job, j => Utils.showLoading(true, Utils.jobProgressMessage(j)));
+        return job.download_url;
+    },
+    async loadFilterOptions() {
+        return this._fetchWithSession('/api/entry_filters');
+    },
     async addEntry(entryData) {
         try {
             const data = await this._fetchWithSession('/api/add', { method: 'POST', body: JSON.stringify(entryData) });
-            AppState.entries = data.entries || [];
+            await this.applyMutation(data);
             return data;
         } catch (error) {
             Utils.showNotification('Failed to add entry: ' + error.message, 'error');
             throw error;
         }
     },
+    async addEntries(batch) {
+        try {
+            const data = await this._fetchWithSession('/api/add_batch', { method: 'POST', body: JSON.stringify(batch) });
+            await this.applyMutation(data);
+            return data;
+        } catch (error) {
+            Utils.showNotification('Failed to add entries: ' + error.message, 'error');
+            throw error;
+        }
+    },
     async commitChanges(editedRows, deleteIds) {
         try {
             Utils.showLoading(true);
             const data = await this._fetchWithSession('/api/commit', { method: 'POST', body: JSON.stringify({ editedRows, deleteIds }) });
-            AppState.entries = data.entries || [];
+            await this.applyMutation(data);
             Utils.showNotification('Changes saved successfully', 'success');
             return data;
         } catch (error) {
@@ -125,12 +241,31 @@ const API = {
             Utils.showLoading(false);
         }
     },
+    async recalculate() {
+        try {
+            Utils.showLoading(true);
+            const data = await this._fetchWithSession('/api/recalc', { method: 'POST' });
+            // Recalculated rows are stamped with the new version, so the change feed returns them
+            await this.syncChanges();
+            Utils.showNotification(data.message, 'success');
+            return data;
+        } catch (error) {
+            Utils.showNotification('Failed to recalculate: ' + error.message, 'error');
+            throw error;
+        } finally {
+            Utils.showLoading(false);
+        }
+    },
     async addMasterData(masterData) {
         try {
             Utils.showLoading(true);
             const data = await this._fetchWithSession('/api/add_master', { method: 'POST', body: JSON.stringify(masterData) });
-            AppState.masters.clients = data.masters.clients || [];
-            AppState.masters.products = data.masters.products || [];
+            if (data.added?.client) {
+                AppState.masters.clients = [...AppState.masters.clients, data.added.client].sort();
+            }
+            if (data.added?.product) {
+                AppState.masters.products = [...AppState.masters.products, data.added.product];
+            }
             rebuildMasterLookups();
             UI.initializeForm();
             Utils.showNotification(data.message, 'success');
@@ -149,7 +284,7 @@ const API = {
                 method: 'POST',
                 body: JSON.stringify({ entry_id: entryId, field: field, value: value })
             });
-            AppState.entries = data.entries || [];
+            await this.applyMutation(data);
             Utils.showNotification('Entry updated successfully!', 'success');
             return data;
         } catch (error) {
@@ -348,72 +483,111 @@ const UI = {
         document.getElementById('previewTotalGP').textContent = u(totalGP, 0) + ' USD';
     },
     
-    updateStats() {
-        const totalEntries = AppState.entries.length;
-        const totalSales = AppState.entries.reduce((sum, entry) => sum + (parseFloat(entry['Sales (USD)']) || 0), 0);
-        const totalGP = AppState.entries.reduce((sum, entry) => sum + (parseFloat(entry['GP (USD)']) || 0), 0);
-        const avgGM = totalSales > 0 ? (totalGP / totalSales) * 100 : 0;
-        document.getElementById('totalEntries').textContent = totalEntries;
-        document.getElementById('totalSales').textContent = Utils.formatNumber(totalSales, 0) + ' USD';
-        document.getElementById('totalGP').textContent = Utils.formatNumber(totalGP, 0) + ' USD';
-        document.getElementById('avgGM').textContent = Utils.formatNumber(avgGM, 1) + '%';
+    // Dashboard totals are aggregated by the database (/api/summary), not summed in the browser.
+    async updateStats() {
+        let totals;
+        try {
+            totals = (await API.loadSummary()).totals;
+        } catch (error) {
+            return;
+        }
+        document.getElementById('totalEntries').textContent = totals.count;
+        document.getElementById('totalSales').textContent = Utils.formatNumber(totals.sales, 0) + ' USD';
+        document.getElementById('totalGP').textContent = Utils.formatNumber(totals.gp, 0) + ' USD';
+        document.getElementById('avgGM').textContent = Utils.formatNumber(totals.gm_percent, 1) + '%';
     },
     
-    initializeFilters() {
-        const businessUnits = [...new Set(AppState.entries.map(e => e['Business Unit']).filter(Boolean))];
-        const sections = [...new Set(AppState.entries.map(e => e.Section).filter(Boolean))];
-        const clients = [...new Set(AppState.entries.map(e => e.Client).filter(Boolean))];
-        const products = [...new Set(AppState.entries.map(e => e.Product).filter(Boolean))];
-        this.populateFilter('filterBU', businessUnits, '(All Business Units)');
-        this.populateFilter('filterSection', sections, '(All Sections)');
-        this.populateFilter('filterClient', clients, '(All Clients)');
-        this.populateFilter('filterProduct', products, '(All Products)');
-        ['filterBU', 'filterSection', 'filterClient', 'filterProduct', 'filterSearch'].forEach(id => {
+    async initializeFilters() {
+        try {
+            const options = await API.loadFilterOptions();
+            this.populateFilter('filterBU', options.business_unit || [], '(All Business Units)');
+            this.populateFilter('filterSection', options.section || [], '(All Sections)');
+            this.populateFilter('filterClient', options.client || [], '(All Clients)');
+            this.populateFilter('filterProduct', options.product || [], '(All Products)');
+            this.populateFilter('filterMonth', options.month || [], '(All Months)', Utils.monthNumToName);
+        } catch (error) {
+            console.error('Failed to load filter options:', error);
+        }
+        ['filterBU', 'filterSection', 'filterClient', 'filterProduct', 'filterMonth'].forEach(id => {
             const el = document.getElementById(id);
             if (el && !el.dataset.listenerAttached) {
-                el.addEventListener('input', this.renderDataTable.bind(this));
+                el.addEventListener('input', () => this.renderDataTable());
                 el.dataset.listenerAttached = 'true';
             }
         });
+        const searchEl = document.getElementById('filterSearch');
+        if (searchEl && !searchEl.dataset.listenerAttached) {
+            // Debounced: the server is queried once typing pauses, not on every keystroke
+            let timer = null;
+            searchEl.addEventListener('input', () => {
+                clearTimeout(timer);
+                timer = setTimeout(() => this.renderDataTable(), 300);
+            });
+            searchEl.dataset.listenerAttached = 'true';
+        }
+        document.querySelectorAll('#tbl th[data-sort]').forEach(th => {
+            if (th.dataset.listenerAttached) return;
+            th.addEventListener('click', () => {
+                const column = th.dataset.sort;
+                TableState.dir = (TableState.sort === column && TableState.dir === 'asc') ? 'desc' : 'asc';
+                TableState.sort = column;
+                this.renderDataTable();
+            });
+            th.dataset.listenerAttached = 'true';
+        });
+        const btnLoadMore = document.getElementById('btnLoadMore');
+        if (btnLoadMore && !btnLoadMore.dataset.listenerAttached) {
+            btnLoadMore.addEventListener('click', () => this.renderDataTable(true));
+            btnLoadMore.dataset.listenerAttached = 'true';
+        }
     },
     
-    populateFilter(selectId, options, defaultText) {
+    populateFilter(selectId, options, defaultText, formatLabel = (v) => v) {
         const select = document.getElementById(selectId);
+        const previous = select.value;
         select.innerHTML = `<option value="">${defaultText}</option>`;
-        options.sort().forEach(option => {
+        options.forEach(option => {
             const optionElement = document.createElement('option');
             optionElement.value = option;
-            optionElement.textContent = option;
+            optionElement.textContent = formatLabel(option);
             select.appendChild(optionElement);
         });
+        // Keep the user's current selection if it still exists
+        if ([...select.options].some(o => o.value === String(previous))) select.value = previous;
     },
     
-    getFilteredEntries() {
-        const filters = {
-            businessUnit: document.getElementById('filterBU').value,
+    getFilterParams() {
+        return {
+            business_unit: document.getElementById('filterBU').value,
             section: document.getElementById('filterSection').value,
             client: document.getElementById('filterClient').value,
             product: document.getElementById('filterProduct').value,
-            search: document.getElementById('filterSearch').value.toLowerCase()
+            month: document.getElementById('filterMonth').value,
+            search: document.getElementById('filterSearch').value
         };
-        return AppState.entries.filter(entry => {
-            if (filters.businessUnit && entry['Business Unit'] !== filters.businessUnit) return false;
-            if (filters.section && entry.Section !== filters.section) return false;
-            if (filters.client && entry.Client !== filters.client) return false;
-            if (filters.product && entry.Product !== filters.product) return false;
-            if (filters.search && !`${entry.Client} ${entry.Product}`.toLowerCase().includes(filters.search)) return false;
-            return true;
-        });
     },
     
-    renderDataTable() {
-        const filteredEntries = this.getFilteredEntries();
+    // Renders the Manage Data table from /api/entries. Filtering, sorting and totals happen
+    // on the server; `append` loads the next page after the rows already shown.
+    async renderDataTable(append = false) {
+        const requestSeq = ++TableState.requestSeq;
+        const params = { ...this.getFilterParams(), sort: TableState.sort, dir: TableState.dir };
+        if (append && TableState.cursor) params.cursor = TableState.cursor;
+        let page;
+        try {
+            page = await API.queryEntries(params);
+        } catch (error) {
+            return;
+        }
+        // A newer request was started while this one was in flight
+        if (requestSeq !== TableState.requestSeq) return;
+
         const tbody = document.getElementById('dataTableBody');
-        tbody.innerHTML = '';
-        filteredEntries.forEach(entry => {
+        if (!append) tbody.innerHTML = '';
+        const u = Utils.formatNumber;
+        (page.rows || []).forEach(entry => {
             const row = document.createElement('tr');
             row.className = 'table-row transition-all duration-150';
-            const u = Utils.formatNumber;
             const isBrokerOrMining = (entry.Section === 'Broker' || entry.Section === 'Mining');
 
             row.innerHTML = `
@@ -436,18 +610,21 @@ const UI = {
             tbody.appendChild(row);
         });
         
-        const filteredSales = filteredEntries.reduce((sum, entry) => sum + (parseFloat(entry['Sales (USD)']) || 0), 0);
-        const filteredGP = filteredEntries.reduce((sum, entry) => sum + (parseFloat(entry['GP (USD)']) || 0), 0);
+        TableState.cursor = page.next_cursor || null;
+        document.getElementById('btnLoadMore').classList.toggle('hidden', !TableState.cursor);
         
-        document.getElementById('filteredCount').textContent = filteredEntries.length;
-        document.getElementById('filteredSales').textContent = Utils.formatNumber(filteredSales, 0) + ' USD';
-        document.getElementById('filteredGP').textContent = Utils.formatNumber(filteredGP, 0) + ' USD';
+        if (page.totals) {
+            document.getElementById('filteredCount').textContent = page.totals.count;
+            document.getElementById('filteredSales').textContent = Utils.formatNumber(page.totals['Sales (USD)'], 0) + ' USD';
+            document.getElementById('filteredGP').textContent = Utils.formatNumber(page.totals['GP (USD)'], 0) + ' USD';
+        }
         
         const selectAllCheckbox = document.getElementById('selectAll');
-        if (selectAllCheckbox) {
+        if (selectAllCheckbox && !selectAllCheckbox.dataset.listenerAttached) {
             selectAllCheckbox.addEventListener('change', (e) => {
                 document.querySelectorAll('.entry-checkbox').forEach(cb => cb.checked = e.target.checked);
             });
+            selectAllCheckbox.dataset.listenerAttached = 'true';
         }
     },
 
@@ -630,7 +807,14 @@ const EventHandlers = {
                         sector: document.getElementById('sector').value
                     };
                     
-                    const entriesToAdd = [];
+                    // One wide-form line: the server expands it into monthly entries in a single transaction.
+                    const line = {
+                        ...baseData,
+                        pmt_q1: pmtQ1, pmt_q2: pmtQ2, pmt_q3: pmtQ3, pmt_q4: pmtQ4,
+                        gm_percent: isBrokerOrMining ? 0 : gm_percent,
+                        profit_per_ton: isBrokerOrMining ? profitPerTon_USD : 0,
+                        months: {}
+                    };
                     for (const monthName of ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']) {
                         const qtyInput = document.getElementById(`qty${monthName}`);
                         if (qtyInput.value.trim() !== '') {
@@ -638,21 +822,12 @@ const EventHandlers = {
                             if (qty === 0) continue; // Skip zero-quantity entries, already validated
 
                             const isBooked = document.getElementById(`check${monthName}`).checked;
-                            if (isBrokerOrMining) {
-                                entriesToAdd.push({ ...baseData, month_name: monthName, qty, pmt: 0, gm_percent: 0, profit_per_ton: profitPerTon_USD, booked: isBooked ? "Yes" : "No" });
-                            } else {
-                                const quarter = monthQuarterMap[monthName];
-                                const pmtForMonth = pmtMap[quarter];
-                                entriesToAdd.push({ ...baseData, month_name: monthName, qty, pmt: pmtForMonth, gm_percent, profit_per_ton: 0, booked: isBooked ? "Yes" : "No" });
-                            }
+                            line.months[monthName] = { qty, booked: isBooked ? "Yes" : "No" };
                         }
                     }
                     
-                    let entriesAdded = 0;
-                    for (const entryData of entriesToAdd) {
-                        await API.addEntry(entryData);
-                        entriesAdded++;
-                    }
+                    const result = await API.addEntries({ lines: [line] });
+                    const entriesAdded = (result.inserted || []).length;
                     
                     if (entriesAdded > 0) {
                         Utils.showNotification(`Successfully added ${entriesAdded} monthly entries`, 'success');
@@ -723,14 +898,15 @@ const EventHandlers = {
                     if (data.error || data.status === 'error') {
                         Utils.showNotification(data.error || data.message, 'error');
                     } else {
-                        AppState.masters.clients = data.masters.clients || [];
-                        AppState.masters.products = data.masters.products || [];
+                        const job = await API.waitForJob(data.job, j => Utils.showLoading(true, Utils.jobProgressMessage(j)));
+                        AppState.masters.clients = job.result.masters.clients || [];
+                        AppState.masters.products = job.result.masters.products || [];
                         rebuildMasterLookups();
                         UI.initializeForm();
                         UI.updateMasterDataDisplay();
                         Utils.showNotification('Master data uploaded successfully', 'success');
                     }
-                } catch (error) { Utils.showNotification('Failed to upload master data', 'error'); } 
+                } catch (error) { Utils.showNotification('Failed to upload master data: ' + error.message, 'error'); } 
                 finally { Utils.showLoading(false); }
             });
             btnUploadMasters.dataset.listenerAttached = 'true';
@@ -751,14 +927,15 @@ const EventHandlers = {
                     const data = await response.json();
                     if (data.error) Utils.showNotification(data.error, 'error');
                     else {
-                        AppState.entries = data.entries || [];
+                        const job = await API.waitForJob(data.job, j => Utils.showLoading(true, Utils.jobProgressMessage(j)));
+                        await API.applyMutation(job.result);
                         UI.updateStats();
                         UI.initializeFilters();
                         UI.renderDataTable();
-                        Utils.showNotification('Budget file loaded successfully', 'success');
+                        Utils.showNotification(job.result.message || 'Budget file loaded successfully', 'success');
                         if(window.ClientFileHandler) window.ClientFileHandler.resetFileHandle();
                     }
-                } catch (error) { Utils.showNotification('Failed to load budget file', 'error'); } 
+                } catch (error) { Utils.showNotification('Failed to load budget file: ' + error.message, 'error'); } 
                 finally { Utils.showLoading(false); }
             });
             btnUploadBudget.dataset.listenerAttached = 'true';
@@ -773,6 +950,7 @@ const EventHandlers = {
                         const data = await API._fetchWithSession('/api/clear_data', { method: 'POST' });
                         if (data.status === 'success') {
                             AppState.entries = [];
+                            AppState.version = data.version ?? AppState.version;
                             UI.updateStats();
                             UI.initializeFilters();
                             UI.renderDataTable();
@@ -853,7 +1031,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const writeFile = async (fileHandle) => {
         try {
             Utils.showLoading(true);
-            const response = await fetch('/api/download_current');
+            const response = await fetch(await API.exportFile('xlsx'));
             if (!response.ok) throw new Error('Failed to fetch file data from server.');
             const blob = await response.blob();
             const writable = await fileHandle.createWritable();
@@ -894,18 +1072,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
-    const fallbackDownload = () => {
-        const link = document.createElement('a');
-        link.href = '/api/download_current';
-        link.download = `Budget_Export.xlsx`;
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
+    const fallbackDownload = async () => {
+        try {
+            Utils.showLoading(true);
+            const link = document.createElement('a');
+            link.href = await API.exportFile('xlsx');
+            link.download = `Budget_Export.xlsx`;
+            document.body.appendChild(link);
+            link.click();
+            document.body.removeChild(link);
+        } catch (err) {
+            Utils.showNotification('Failed to download: ' + err.message, 'error');
+        } finally {
+            Utils.showLoading(false);
+        }
     };
     
     window.ClientFileHandler = { resetFileHandle: () => { currentFileHandle = null; console.log("File handle has been reset."); } };
 
     const hasFSApi = 'showSaveFilePicker' in window;
-    document.getElementById('btnSave').addEventListener('click', async (e) => { e.preventDefault(); if (hasFSApi) { await handleSave(); } else { fallbackDownload(); } });
-    document.getElementById('btnSaveAs').addEventListener('click', async (e) => { e.preventDefault(); if (hasFSApi) { await handleSaveAs(); } else { fallbackDownload(); } });
+    document.getElementById('btnSave').addEventListener('click', async (e) => { e.preventDefault(); if (hasFSApi) { await handleSave(); } else { await fallbackDownload(); } });
+    document.getElementById('btnSaveAs').addEventListener('click', async (e) => { e.preventDefault(); if (hasFSApi) { await handleSaveAs(); } else { await fallbackDownload(); } });
 });
\ No newline at end of file
@@ -0,0 +1,70 @@
+# budget_app/summary_cache.py
+"""
+Per-worker cache of /api/summary results in USD.
+
+Entries are keyed by user and by the summary's arguments (without ?currency=)
+and tagged with the user's data version; the version is read before every use
+(one primary-key lookup), so a change made by any worker makes the next
+request aggregate again. Converted summaries are derived from the cached USD
+sums (see currency.convert_summary), so asking for another currency never
+reaches the entries. Cached values are shared between requests and must be
+treated as read-only.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Tuple
+
+from flask import current_app
+
+from .change_feed import current_version
+from .entry_queries import entries_summary
+
+DEFAULT_MAX_ENTRIES = 1024
+# Arguments that don't change the USD aggregate
+IGNORED_ARGS = ("currency",)
+
+CacheKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class SummaryCache:
+    """An LRU of (data version, summary) keyed by user and summary arguments, safe to share between threads."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(user_id: str, args: Mapping[str, Any]) -> CacheKey:
+        return user_id, tuple(sorted((k, str(v)) for k, v in args.items() if k not in IGNORED_ARGS))
+
+    def get(self, user_id: str, args: Mapping[str, Any]) -> Dict[str, Any]:
+        key = self.key(user_id, args)
+        # Read the version before the data: a change committed in between only causes an extra aggregation
+        version = current_version(user_id)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        summary = entries_summary(user_id, args)
+        with self._lock:
+            self._entries[key] = (version, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return summary
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def cached_summary(user_id: str, args: Mapping[str, Any]) -> Dict[str, Any]:
+    """entries_summary() in USD, from the current app's cache."""
+    return current_app.extensions["summary_cache"].get(user_id, args)
@@ -1,6 +1,7 @@
 # config.py
 
 import os
+import tempfile
 from dotenv import load_dotenv
 import urllib.parse
 
@@ -29,8 +30,77 @@ class Config:
     DB_PASSWORD = os.environ.get("DB_PASSWORD")
     DB_DRIVER = os.environ.get("DB_DRIVER")
     
+    # Number of spreadsheet rows converted and inserted at a time by budget imports.
+    # Peak import memory is proportional to this, not to the size of the file.
+    IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", 5000))
+    # Processes used to parse an import's sheets (and row ranges of sheets with at least
+    # IMPORT_MIN_RANGE_ROWS rows) in parallel. 1 streams the sheets in the job's own thread.
+    IMPORT_PROCESSES = int(os.environ.get("IMPORT_PROCESSES", 1))
+    IMPORT_MIN_RANGE_ROWS = int(os.environ.get("IMPORT_MIN_RANGE_ROWS", 10000))
+
+    # /api/summary reads the per-user rollups (see budget_app/rollups.py) when the requested
+    # grouping and filters allow it. Set to 0 to always aggregate the entries themselves.
+    SUMMARY_FROM_ROLLUPS = os.environ.get("SUMMARY_FROM_ROLLUPS", "1") == "1"
+
+    # /api/changes keeps deleted-entry tombstones for each user's last CHANGE_FEED_RETAINED_VERSIONS
+    # versions; clients that are further behind get a full reload.
+    CHANGE_FEED_RETAINED_VERSIONS = int(os.environ.get("CHANGE_FEED_RETAINED_VERSIONS", 1000))
+
+    # Number of users whose master data (clients/products) each worker keeps cached.
+    MASTER_CACHE_SIZE = int(os.environ.get("MASTER_CACHE_SIZE", 256))
+
+    # Audit events are written by the request by default. With AUDIT_ASYNC they are
+    # queued (at most AUDIT_QUEUE_SIZE per worker) and written by a background thread.
+    AUDIT_ASYNC = os.environ.get("AUDIT_ASYNC", "").lower() in ("1", "true", "yes")
+    AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", 10000))
+
+    # Azure object IDs (comma-separated) allowed to read every user's audit log and the
+    # consolidated budget of all users (/api/admin/consolidation).
+    ADMIN_USER_IDS = {oid.strip() for oid in os.environ.get("ADMIN_USER_IDS", "").split(",") if oid.strip()}
+    # Audit rows older than AUDIT_RETENTION_DAYS are moved to monthly gzip files in AUDIT_ARCHIVE_DIR
+    # by `flask --app run archive-audit`.
+    AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", 365))
+    AUDIT_ARCHIVE_DIR = os.environ.get("AUDIT_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_archive"))
+
+    # Session store for session_manager: "memory" (per worker) or "sqlite" (a file shared by
+    # the workers on one machine). Sessions idle for SESSION_IDLE_TTL seconds are dropped and
+    # the least recently used ones are evicted beyond SESSION_MAX_ENTRIES or SESSION_MAX_BYTES.
+    SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+    SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", os.path.join(tempfile.gettempdir(), "budget_sessions.sqlite3"))
+    SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", 1000))
+    SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", 256 * 1024 * 1024))
+    SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", 3600))
+
+    # JSON/CSV responses of at least COMPRESS_MIN_BYTES are sent gzip-compressed, or brotli
+    # when the optional 'brotli' package is installed and the browser accepts it.
+    COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1").lower() in ("1", "true", "yes")
+    COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+    COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 5))
+
+    # Budget/master imports and background exports run as jobs on JOB_WORKERS threads per
+    # worker process (0 runs them inside the request). Job state is kept in a local SQLite
+    # file, uploads and finished exports in JOB_DIR; both are removed after JOB_RETENTION_HOURS.
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+    JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(tempfile.gettempdir(), "budget_jobs.sqlite3"))
+    JOB_DIR = os.environ.get("JOB_DIR", os.path.join(tempfile.gettempdir(), "budget_jobs"))
+    JOB_RETENTION_HOURS = int(os.environ.get("JOB_RETENTION_HOURS", 24))
+    
+    # Number of /api/summary results (per user and arguments, in USD) each worker keeps cached.
+    SUMMARY_CACHE_SIZE = int(os.environ.get("SUMMARY_CACHE_SIZE", 1024))
+
+    # Budget snapshots are zstd-compressed Parquet files in SNAPSHOT_DIR (see snapshots.py). Loading a
+    # workbook, clearing the budget and restoring a snapshot take an automatic snapshot first unless
+    # SNAPSHOT_BEFORE_REPLACE is off; the newest SNAPSHOT_MAX_AUTO of them are kept per user, next to at
+    # most SNAPSHOT_MAX_MANUAL named ones.
+    SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"))
+    SNAPSHOT_BEFORE_REPLACE = os.environ.get("SNAPSHOT_BEFORE_REPLACE", "1").lower() in ("1", "true", "yes")
+    SNAPSHOT_MAX_AUTO = int(os.environ.get("SNAPSHOT_MAX_AUTO", 10))
+    SNAPSHOT_MAX_MANUAL = int(os.environ.get("SNAPSHOT_MAX_MANUAL", 50))
+
     # Exchange Rates Configuration
     # All rates are defined as 1 USD to the target currency.
+    # These apply until an administrator publishes a rate set (POST /api/admin/exchange_rates).
     EXCHANGE_RATES = {
         'USD': 1.0,
         'JOD': 0.71,  # As specified: 1 USD = 0.71 JOD
@@ -38,14 +108,15 @@ class Config:
     }
     
     # 1. URL-encode the password to handle any special characters safely.
-    encoded_password = urllib.parse.quote_plus(DB_PASSWORD)
+    encoded_password = urllib.parse.quote_plus(DB_PASSWORD or "")
     
     # 2. For the driver name, the ODBC standard requires replacing spaces with a '+'.
-    safe_driver = DB_DRIVER.replace(' ', '+')
+    safe_driver = (DB_DRIVER or "").replace(' ', '+')
 
     # 3. Construct the final SQLAlchemy Database URI (the connection string).
     # All parameters after the '?' must be separated by an ampersand '&'.
-    SQLALCHEMY_DATABASE_URI = (
+    # DATABASE_URL overrides it, e.g. "sqlite:///budget.db" for local runs and benchmarks.
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL") or (
         f"mssql+pyodbc://{DB_USER}:{encoded_password}@{DB_SERVER}:1433/"
         f"{DB_NAME}?driver={safe_driver}&timeout=60&charset=utf8"  # <-- Semicolons (;) changed to ampersands (&)
     )
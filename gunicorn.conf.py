@@ -1,5 +1,27 @@
 # gunicorn.conf.py
+import os
+
 # Binds the server to the port provided by Azure
-bind = "0.0.0.0:8000"
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Worker profiles, selected with GUNICORN_PROFILE (compare them with benchmarks/loadtest.py):
+#   sync    - one request at a time per worker process (the original setup)
+#   gthread - several threads per worker; good when requests mostly wait on the database
+#   gevent  - cooperative greenlets; needs the 'gevent' package. pyodbc calls still block
+#             the whole worker, so this mainly helps with many slow clients.
+PROFILES = {
+    "sync": {"worker_class": "sync", "workers": 4, "threads": 1},
+    "gthread": {"worker_class": "gthread", "workers": 2, "threads": 8},
+    "gevent": {"worker_class": "gevent", "workers": 2, "threads": 1},
+}
+profile_name = os.environ.get("GUNICORN_PROFILE", "sync").lower()
+if profile_name not in PROFILES:
+    raise ValueError(f"Unknown GUNICORN_PROFILE '{profile_name}' (expected one of {', '.join(PROFILES)}).")
+profile = PROFILES[profile_name]
+
+worker_class = profile["worker_class"]
 # Sets the number of worker processes to handle requests
-workers = 4
\ No newline at end of file
+workers = int(os.environ.get("GUNICORN_WORKERS", profile["workers"]))
+threads = int(os.environ.get("GUNICORN_THREADS", profile["threads"]))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))